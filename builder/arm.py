@@ -0,0 +1,459 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import http.client
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlencode, urlsplit
+
+import loggers
+
+ARM_ENDPOINT = os.environ.get('BUILDER_ARM_ENDPOINT', 'https://management.azure.com').rstrip('/')
+ARM_POOL_SIZE = int(os.environ.get('BUILDER_ARM_POOL_SIZE', '8'))
+ARM_TIMEOUT = 60
+
+GALLERY_API_VERSION = '2022-03-03'
+RESOURCES_API_VERSION = '2021-04-01'
+
+# refresh the token this many seconds before it actually expires
+TOKEN_EXPIRY_MARGIN = 300
+
+# maps az option aliases to a single (long) option name
+OPTION_ALIASES = {
+    '-g': '--resource-group',
+    '-r': '--gallery-name',
+    '-i': '--gallery-image-definition',
+    '-e': '--gallery-image-version',
+    '-n': '--name',
+    '-l': '--location',
+    '-f': '--template-file',
+    '-p': '--parameters',
+    '-s': '--sku',
+}
+
+# aliases that mean something different for a specific command
+COMMAND_OPTION_ALIASES = {
+    ('sig', 'image-definition', 'create'): {'-p': '--publisher', '-f': '--offer'},
+}
+
+# options that don't take a value
+OPTION_FLAGS = ['--only-show-errors', '--no-prompt', '--no-wait']
+
+log = loggers.getLogger(__name__)
+
+
+class ArmError(Exception):
+    '''An error response returned by Azure Resource Manager'''
+
+    def __init__(self, status, code, message, retry_after=None):
+        self.status = status
+        self.code = code
+        self.message = message
+        self.retry_after = retry_after
+        super().__init__(f'({code}) {message}\nCode: {code}\nMessage: {message}')
+
+
+class TransportUnavailable(Exception):
+    '''The arm transport can not be used (i.e. no token), callers should fall back to the az cli'''
+
+
+class TransportError(Exception):
+    '''A request couldn't be sent or its response couldn't be read (i.e. the connection was reset), it may succeed if
+    it's sent again'''
+
+
+def _parse_args(args):
+    '''Splits az cli args (without the az executable) into the command words and a dict of options'''
+    words = []
+    i = 0
+    while i < len(args) and not args[i].startswith('-'):
+        words.append(args[i])
+        i += 1
+
+    words = tuple(words)
+    aliases = {**OPTION_ALIASES, **COMMAND_OPTION_ALIASES.get(words, {})}
+
+    opts = {}
+    while i < len(args):
+        name = aliases.get(args[i], args[i])
+        if name in OPTION_FLAGS or i + 1 >= len(args):
+            opts[name] = True
+            i += 1
+        else:
+            opts[name] = args[i + 1]
+            i += 2
+    return words, opts
+
+
+# ----------------
+# session
+# ----------------
+
+_token = {}
+_token_lock = threading.Lock()
+
+_pool = queue.LifoQueue(maxsize=ARM_POOL_SIZE)
+
+_stats = {'requests': 0, 'connections': 0, 'tokens': 0}
+
+# set to the reason the transport can't be used (i.e. not logged in) so we only find out once
+_unavailable = None
+
+
+def _config_dir():
+    return Path(os.environ.get('AZURE_CONFIG_DIR', Path.home() / '.azure'))
+
+
+def _profile():
+    '''Returns the default subscription from the az cli profile (the same thing az account show returns)'''
+    profile_path = _config_dir() / 'azureProfile.json'
+    if not profile_path.is_file():
+        return None
+    with open(profile_path, 'r', encoding='utf-8-sig') as f:
+        profile = json.load(f)
+    return next((s for s in profile.get('subscriptions', []) if s.get('isDefault')), None)
+
+
+def _disable(reason):
+    global _unavailable
+    _unavailable = reason
+    raise TransportUnavailable(reason)
+
+
+def _get_token():
+    '''Returns a cached arm access token, requesting a new one from the az cli when it's missing or about to expire'''
+    with _token_lock:
+        if _token and _token['expires_on'] - TOKEN_EXPIRY_MARGIN > time.time():
+            return _token['token']
+
+        token = os.environ.get('BUILDER_ARM_TOKEN', None)
+        if token:
+            _token.update({'token': token, 'expires_on': time.time() + 3600})
+            return token
+
+        az = shutil.which('az')
+        if not az:
+            _disable('az cli not found, can not get an access token')
+
+        proc = subprocess.run([az, 'account', 'get-access-token', '--resource', f'{ARM_ENDPOINT}/'],
+                              capture_output=True, text=True)
+        if proc.returncode != 0 or not proc.stdout:
+            _disable(proc.stderr if proc.stderr else 'could not get an access token from the az cli')
+
+        try:
+            result = json.loads(proc.stdout)
+        except json.decoder.JSONDecodeError:
+            _disable('could not decode the access token from the az cli')
+        expires_on = result.get('expires_on', None)
+        expires_on = float(expires_on) if expires_on else time.time() + 1800
+
+        _token.update({'token': result['accessToken'], 'expires_on': expires_on})
+        _stats['tokens'] += 1
+
+        return _token['token']
+
+
+def _new_connection():
+    url = urlsplit(ARM_ENDPOINT)
+    _stats['connections'] += 1
+    if url.scheme == 'http':
+        return http.client.HTTPConnection(url.netloc, timeout=ARM_TIMEOUT)
+    return http.client.HTTPSConnection(url.netloc, timeout=ARM_TIMEOUT)
+
+
+def _send(method, path, body=None, retry=True):
+    '''Sends a request over a pooled (keep-alive) connection and returns the status, headers, and parsed body'''
+    headers = {'Authorization': f'Bearer {_get_token()}', 'Accept': 'application/json'}
+    payload = None
+    if body is not None:
+        payload = json.dumps(body).encode()
+        headers['Content-Type'] = 'application/json'
+
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _new_connection()
+
+    try:
+        conn.request(method, path, body=payload, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+    except (http.client.HTTPException, ConnectionError, OSError) as e:
+        conn.close()
+        if retry:  # stale keep-alive connection, try once more on a new one
+            return _send(method, path, body, retry=False)
+        raise TransportError(f'{method} {path} failed: {type(e).__name__}: {e}') from e
+
+    _stats['requests'] += 1
+
+    if response.status == 401 and retry:  # token was revoked or expired early
+        with _token_lock:
+            _token.clear()
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+        return _send(method, path, body, retry=False)
+
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+    try:
+        result = json.loads(data) if data else None
+    except json.decoder.JSONDecodeError as e:
+        raise TransportError(f'{method} {path} returned a response that isn\'t json (status {response.status})') from e
+    return response.status, response.headers, result
+
+
+def _check(status, result, headers=None, missing_ok=False):
+    '''Returns the response body, or raises an ArmError for an error response. A missing resource (ResourceNotFound)
+    is only returned as None if missing_ok, like the az cli's show commands, every other 404 (i.e. a put to a missing
+    resource group) is an error'''
+    if status == 404 and missing_ok and _error_code(result) == 'ResourceNotFound':
+        return None
+    if status >= 400:
+        error = result.get('error', {}) if isinstance(result, dict) else {}
+        retry_after = headers.get('Retry-After', None) if headers else None
+        raise ArmError(status, error.get('code', f'HttpStatus{status}'), error.get('message', 'arm request failed'),
+                       float(retry_after) if retry_after and retry_after.isdigit() else None)
+    return result
+
+
+def _error_code(result):
+    return (result.get('error', None) or {}).get('code', None) if isinstance(result, dict) else None
+
+
+def _relative(url):
+    '''Strips the endpoint from an absolute url returned in an async operation header'''
+    parts = urlsplit(url)
+    return f'{parts.path}?{parts.query}' if parts.query else parts.path
+
+
+def _wait(headers):
+    '''Polls a long-running operation until it completes'''
+    operation = headers.get('Azure-AsyncOperation', None)
+    if not operation:
+        return
+    while True:
+        time.sleep(int(headers.get('Retry-After', 1)))
+        status, headers, result = _send('GET', _relative(operation))
+        result = _check(status, result, headers)
+        state = result.get('status', 'Succeeded') if result else 'Succeeded'
+        if state.lower() == 'succeeded':
+            return
+        if state.lower() in ['failed', 'canceled']:
+            error = result.get('error', {})
+            raise ArmError(status, error.get('code', state), error.get('message', f'operation {state.lower()}'))
+
+
+def _request(method, path, api_version, body=None, flatten=False, query=None):
+    url = f'{path}?{urlencode(dict(query or {}, **{"api-version": api_version}))}'
+    status, headers, result = _send(method, url, body)
+    result = _check(status, result, headers, missing_ok=method == 'GET')
+
+    if method in ['PUT', 'PATCH'] and status in [201, 202]:
+        _wait(headers)
+        status, headers, result = _send('GET', url)
+        result = _check(status, result, headers)
+
+    if method == 'GET' and isinstance(result, dict) and 'value' in result and 'nextLink' in result:
+        items = result['value']
+        while result.get('nextLink', None):
+            status, headers, result = _send('GET', _relative(result['nextLink']))
+            items.extend(_check(status, result, headers)['value'])
+        result = {'value': items}
+
+    if flatten:  # the az cli returns resources with their properties moved to the top level
+        result = _flatten(result)
+
+    return result
+
+
+def _flatten(resource):
+    if isinstance(resource, dict) and 'value' in resource:
+        return [_flatten(r) for r in resource['value']]
+    if isinstance(resource, dict) and 'properties' in resource:
+        flat = {k: v for k, v in resource.items() if k != 'properties'}
+        flat.update(resource['properties'])
+        return flat
+    return resource
+
+
+# ----------------
+# commands
+# ----------------
+
+
+def _subscription(opts):
+    sub = opts.get('--subscription', None)
+    if sub:
+        return sub
+    account = _profile()
+    if not account:
+        raise TransportUnavailable('no subscription specified and no default subscription in the az cli profile')
+    return account['id']
+
+
+def _gallery_path(opts):
+    return (f'/subscriptions/{_subscription(opts)}/resourceGroups/{opts["--resource-group"]}'
+            f'/providers/Microsoft.Compute/galleries/{opts["--gallery-name"]}')
+
+
+def _group_path(opts, name):
+    return f'/subscriptions/{_subscription(opts)}/resourcegroups/{name}'
+
+
+def _account_show(opts):
+    account = _profile()
+    if not account:
+        raise TransportUnavailable('no default subscription in the az cli profile')
+    return account
+
+
+def _group_show(opts):
+    return _request('GET', _group_path(opts, opts['--name']), RESOURCES_API_VERSION)
+
+
+def _group_create(opts):
+    body = {'location': opts['--location']}
+    return _request('PUT', _group_path(opts, opts['--name']), RESOURCES_API_VERSION, body)
+
+
+def _img_def_show(opts):
+    path = f'{_gallery_path(opts)}/images/{opts["--gallery-image-definition"]}'
+    return _request('GET', path, GALLERY_API_VERSION, flatten=True)
+
+
+def _img_def_create(opts):
+    location = opts.get('--location', None)
+    if not location:  # the az cli defaults to the location of the resource group
+        group = _request('GET', _group_path(opts, opts['--resource-group']), RESOURCES_API_VERSION)
+        if group is None:
+            raise ArmError(404, 'ResourceGroupNotFound', f'Resource group \'{opts["--resource-group"]}\' could not be found.')
+        location = group['location']
+
+    properties = {
+        'osType': opts['--os-type'],
+        'osState': 'Generalized',
+        'hyperVGeneration': opts.get('--hyper-v-generation', 'V1'),
+        'identifier': {
+            'publisher': opts['--publisher'],
+            'offer': opts['--offer'],
+            'sku': opts['--sku']
+        }
+    }
+
+    if opts.get('--description', None):
+        properties['description'] = opts['--description']
+
+    if opts.get('--features', None):
+        properties['features'] = [{'name': f.split('=')[0], 'value': f.split('=')[1]} for f in opts['--features'].split()]
+
+    path = f'{_gallery_path(opts)}/images/{opts["--gallery-image-definition"]}'
+    return _request('PUT', path, GALLERY_API_VERSION, {'location': location, 'properties': properties}, flatten=True)
+
+
+def _img_def_list(opts):
+    return _request('GET', f'{_gallery_path(opts)}/images', GALLERY_API_VERSION, flatten=True)
+
+
+def _img_ver_list(opts):
+    path = f'{_gallery_path(opts)}/images/{opts["--gallery-image-definition"]}/versions'
+    return _request('GET', path, GALLERY_API_VERSION, flatten=True)
+
+
+def _img_ver_show(opts):
+    path = f'{_gallery_path(opts)}/images/{opts["--gallery-image-definition"]}/versions/{opts["--gallery-image-version"]}'
+    query = {'$expand': opts['--expand']} if opts.get('--expand', None) else None
+    return _request('GET', path, GALLERY_API_VERSION, flatten=True, query=query)
+
+
+def _img_ver_update(opts):
+    update = opts.get('--set', '')
+    if not update.startswith('tags.') or '=' not in update:
+        raise TransportUnavailable('only tags can be updated with the arm transport')
+
+    key, value = update[len('tags.'):].split('=', 1)
+
+    path = f'{_gallery_path(opts)}/images/{opts["--gallery-image-definition"]}/versions/{opts["--gallery-image-version"]}'
+    version = _request('GET', path, GALLERY_API_VERSION)
+    if version is None:
+        raise ArmError(404, 'ResourceNotFound', f'The image version {opts["--gallery-image-version"]} was not found.')
+
+    tags = version.get('tags', None) or {}
+    tags[key] = value
+
+    return _request('PATCH', path, GALLERY_API_VERSION, {'tags': tags}, flatten=True)
+
+
+def _deployment_body(opts) -> dict:
+    template_file = opts['--template-file']
+    if not template_file.lower().endswith('.json'):
+        raise TransportUnavailable('bicep templates must be deployed with the az cli')
+
+    with open(template_file, 'r') as f:
+        template = json.load(f)
+
+    parameters = {}
+    params = opts.get('--parameters', None)
+    if params:
+        with open(params[1:] if params.startswith('@') else params, 'r') as f:
+            parameters = json.load(f).get('parameters', {})
+
+    return {'properties': {'mode': 'Incremental', 'template': template, 'parameters': parameters}}
+
+
+def _deployment_group_create(opts):
+    body = _deployment_body(opts)
+    path = f'{_group_path(opts, opts["--resource-group"])}/providers/Microsoft.Resources/deployments/{opts["--name"]}'
+    return _request('PUT', path, RESOURCES_API_VERSION, body)
+
+
+def _deployment_sub_create(opts):
+    body = dict(_deployment_body(opts), location=opts['--location'])
+    path = f'/subscriptions/{_subscription(opts)}/providers/Microsoft.Resources/deployments/{opts["--name"]}'
+    return _request('PUT', path, RESOURCES_API_VERSION, body)
+
+
+COMMANDS = {
+    ('account', 'show'): _account_show,
+    ('group', 'show'): _group_show,
+    ('group', 'create'): _group_create,
+    ('sig', 'image-definition', 'show'): _img_def_show,
+    ('sig', 'image-definition', 'create'): _img_def_create,
+    ('sig', 'image-definition', 'list'): _img_def_list,
+    ('sig', 'image-version', 'show'): _img_ver_show,
+    ('sig', 'image-version', 'list'): _img_ver_list,
+    ('sig', 'image-version', 'update'): _img_ver_update,
+    ('deployment', 'group', 'create'): _deployment_group_create,
+    ('deployment', 'sub', 'create'): _deployment_sub_create,
+}
+
+
+def supports(args) -> bool:
+    '''Returns True if the az cli command (without the az executable) can be sent with the arm transport'''
+    if _unavailable:
+        return False
+    words, opts = _parse_args(args)
+    return words in COMMANDS and '--no-wait' not in opts
+
+
+def request(args):
+    '''Sends the arm rest request equivalent to an az cli command (without the az executable) and returns the json response'''
+    words, opts = _parse_args(args)
+    return COMMANDS[words](opts)
+
+
+def stats() -> dict:
+    '''Returns the number of requests sent, connections opened, and tokens requested by the arm transport'''
+    return dict(_stats)
@@ -0,0 +1,124 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import loggers
+
+# set to false to run every async az command with the same config directory
+POOL = os.environ.get('BUILDER_AZ_CONFIG_POOL', 'true').lower() not in ['0', 'false', 'no']
+
+# minutes before the snapshot of the profile is taken again (and the config directories cloned from it replaced),
+# so token refreshes and logins made with the az cli's own config directory are picked up
+MAX_AGE = int(os.environ.get('BUILDER_AZ_CONFIG_MAX_AGE', '30'))
+
+log = loggers.getLogger(__name__)
+
+
+def source_dir() -> Path:
+    '''Returns the config directory the az cli uses by default (AZURE_CONFIG_DIR or ~/.azure)'''
+    return Path(os.environ.get('AZURE_CONFIG_DIR', None) or Path.home() / '.azure')
+
+
+class Pool:
+    '''Hands out private copies of the az cli config directory to concurrent az commands, so they don't contend for
+    the locks on its config and token cache files. Every copy is cloned from one snapshot of the profile's files (the
+    profile, config, and token cache) taken once, directories (i.e. extensions and the bicep binary) are linked
+    instead of copied. Copies are reused by later commands and replaced when the snapshot is older than max_age'''
+
+    def __init__(self, source=None, root=None, max_age=MAX_AGE):
+        self.source = Path(source) if source else source_dir()
+        self.max_age = max_age * 60
+        self._root = Path(root) if root else None
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._taken = 0.0
+        self._generation = 0
+        self._idle = []
+        self._count = 0
+        self._stats = {'snapshots': 0, 'clones': 0, 'reuses': 0, 'in_use': 0, 'peak': 0}
+
+    def _take_snapshot(self):
+        files = {}
+        links = []
+        for entry in self.source.iterdir():
+            if entry.is_dir():
+                links.append(entry)
+            elif entry.is_file() and not entry.name.endswith('.lockfile'):
+                files[entry.name] = entry.read_bytes()
+        self._snapshot = (files, links)
+        self._taken = time.monotonic()
+        self._generation += 1
+        # the idle copies were cloned from the old snapshot, copies still in use are removed when they're released
+        for path in self._idle:
+            shutil.rmtree(path, ignore_errors=True)
+        self._idle = []
+        self._stats['snapshots'] += 1
+        log.info(f'Took snapshot {self._generation} of az cli config directory {self.source} ({len(files)} files)')
+
+    def _clone(self) -> Path:
+        if self._root is None:
+            self._root = Path(tempfile.mkdtemp(prefix='az-config-'))
+            atexit.register(shutil.rmtree, self._root, True)
+
+        self._count += 1
+        path = self._root / f'{self._generation}-{self._count}'
+        path.mkdir(parents=True)
+
+        files, links = self._snapshot
+        for name, content in files.items():
+            (path / name).write_bytes(content)
+        for link in links:
+            os.symlink(link, path / link.name, target_is_directory=True)
+
+        self._stats['clones'] += 1
+        return path
+
+    def acquire(self) -> tuple:
+        '''Returns a config directory (and its generation) for a command to use until it's released, or None if the
+        az cli's config directory doesn't exist (i.e. not logged in yet)'''
+        with self._lock:
+            if not self.source.is_dir():
+                return None
+
+            if self._snapshot is None or time.monotonic() - self._taken > self.max_age:
+                self._take_snapshot()
+
+            if self._idle:
+                path = self._idle.pop()
+                self._stats['reuses'] += 1
+            else:
+                path = self._clone()
+
+            self._stats['in_use'] += 1
+            self._stats['peak'] = max(self._stats['peak'], self._stats['in_use'])
+            return path, self._generation
+
+    def release(self, lease):
+        '''Returns a config directory from acquire to the pool, copies cloned from an old snapshot are removed'''
+        if lease is None:
+            return
+        path, generation = lease
+        with self._lock:
+            self._stats['in_use'] -= 1
+            if generation == self._generation:
+                self._idle.append(path)
+                return
+        shutil.rmtree(path, ignore_errors=True)
+
+    def env(self, lease) -> dict:
+        '''Returns the environment for an az command that uses the config directory from acquire'''
+        return None if lease is None else dict(os.environ, AZURE_CONFIG_DIR=str(lease[0]))
+
+    def stats(self) -> dict:
+        '''Returns the number of snapshots taken, copies cloned and reused, and the most copies in use at once'''
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle))
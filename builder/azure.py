@@ -4,21 +4,50 @@
 # ------------------------------------
 
 import asyncio
+import copy
 import json
 import os
 import shutil
 import subprocess
 import sys
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
 
+import arm
+import azconfig
+import bicep
+import layers
 import loggers
+import stream
+import throttle
+import tracing
 
 IMAGE_PARAMS_FILE = 'image.parameters.json'
 RESOURCE_NOT_FOUND = 'Code: ResourceNotFound'
 DEFAULT_PARAMS = ['name', 'location', 'version', 'tempResourceGroup', 'buildResourceGroup', 'gallery', 'replicaLocations']
 
+# seconds between checks of a builder container's state while waiting for it to finish
+BUILDER_POLL_INTERVAL = int(os.environ.get('BUILDER_POLL_INTERVAL', '60'))
+
+# minutes to wait for a builder container to finish before it's reported as failed
+BUILDER_WAIT_TIMEOUT = int(os.environ.get('BUILDER_WAIT_TIMEOUT', '720'))
+
+# checks in a row a deployed builder's container group can be missing for before it's reported as failed
+BUILDER_MISSING_CHECKS = 3
+
+# 'arm' sends supported commands as arm rest requests over a pooled session, 'cli' always runs the az cli
+TRANSPORT = os.environ.get('BUILDER_AZ_TRANSPORT', 'arm').lower()
+
 log = loggers.getLogger(__name__)
 
+# adapts the number of async az commands in flight to throttling and retries throttled and transient failures
+_controller = throttle.Controller()
+
+# private copies of the az cli config directory for concurrent async az commands
+_configs = azconfig.Pool() if azconfig.POOL else None
+
 
 def error_exit(message):
     log.error(message)
@@ -34,6 +63,19 @@ def _deployment_group_create_cmd(group_name, template_file, params_file, image):
             '-p', f'@{params_file}', '--no-prompt', '--subscription', image['subscription']]
 
 
+def _deployment_sub_create_cmd(name, location, template_file, params_file, subscription):
+    return ['deployment', 'sub', 'create', '-n', name, '-l', location, '-f', template_file,
+            '-p', f'@{params_file}', '--no-prompt', '--subscription', subscription]
+
+
+def _group_show_cmd(group_name, subscription):
+    return ['group', 'show', '-n', group_name, '--subscription', subscription]
+
+
+def _container_show_cmd(group_name, image):
+    return ['container', 'show', '-g', group_name, '-n', _builder_name(image), '--subscription', image['subscription']]
+
+
 def _img_def_show_cmd(image):
     return ['sig', 'image-definition', 'show', '--only-show-errors', '-g', image['gallery']['resourceGroup'],
             '-r', image['gallery']['name'], '-i', image['name'], '--subscription', image['gallery']['subscription']]
@@ -44,6 +86,16 @@ def _img_ver_show_cmd(image):
             '-r', image['gallery']['name'], '-i', image['name'], '-e', image['version'], '--subscription', image['gallery']['subscription']]
 
 
+def _img_def_list_cmd(gallery):
+    return ['sig', 'image-definition', 'list', '--only-show-errors', '-g', gallery['resourceGroup'],
+            '-r', gallery['name'], '--subscription', gallery['subscription']]
+
+
+def _img_ver_list_cmd(gallery, definition):
+    return ['sig', 'image-version', 'list', '--only-show-errors', '-g', gallery['resourceGroup'],
+            '-r', gallery['name'], '-i', definition, '--subscription', gallery['subscription']]
+
+
 def _img_def_create_cmd(image):
     return ['sig', 'image-definition', 'create', '--only-show-errors', '-g', image['gallery']['resourceGroup'],
             '-r', image['gallery']['name'], '-i', image['name'], '-p', image['publisher'], '-f', image['offer'],
@@ -51,6 +103,113 @@ def _img_def_create_cmd(image):
             '--hyper-v-generation', 'V2', '--features', 'SecurityType=TrustedLaunch', '--subscription', image['gallery']['subscription']]
 
 
+@lru_cache(maxsize=None)
+def _az_path():
+    return shutil.which('az')
+
+
+def _use_arm(args):
+    '''Returns True if the command should be sent with the arm transport instead of the az cli'''
+    return TRANSPORT == 'arm' and arm.supports(args[1:])
+
+
+def _is_deployment(args):
+    '''Returns True if the command creates a deployment, which is only retried when the error's http status is known'''
+    return args[1:2] == ['deployment'] and 'create' in args[2:4]
+
+
+def _builder_name(image):
+    '''Returns the name of the builder container group (see templates/builder.bicep)'''
+    return image['name'].replace('_', '-')
+
+
+def _builder_group(image):
+    '''Returns the name of the resource group the builder is deployed to'''
+    if 'tempResourceGroup' in image and image['tempResourceGroup']:
+        return image['tempResourceGroup']
+    return image['buildResourceGroup']
+
+
+def _builder_exit_code(container_group):
+    '''Returns the exit code of a builder container group's container, or None if it's still running'''
+    if not container_group:
+        return None
+    for container in container_group.get('containers', []):
+        state = (container.get('instanceView', None) or {}).get('currentState', None) or {}
+        if state.get('state', '').lower() == 'terminated':
+            return state.get('exitCode', None)
+    return None
+
+
+def _builder_result(image, container_group, missing, minutes, timeout):
+    '''Returns the builder's exit code once it finished, 1 if its container group has been missing for
+    BUILDER_MISSING_CHECKS checks in a row (i.e. it was deleted or never created) or it hasn't finished within timeout
+    minutes, otherwise None'''
+    exit_code = _builder_exit_code(container_group)
+    if exit_code is not None:
+        log.info(f'{image["name"]} builder finished with exit code {exit_code}')
+        return exit_code
+    if missing >= BUILDER_MISSING_CHECKS:
+        log.error(f'The container group of the {image["name"]} builder was not found in {_builder_group(image)}')
+        return 1
+    if minutes >= timeout:
+        log.error(f'The {image["name"]} builder did not finish within {timeout} minutes')
+        return 1
+    return None
+
+
+def _inventory_for(image, inventory):
+    '''Returns the inventory if it is a snapshot of the image's gallery, otherwise None'''
+    if inventory and inventory['gallery'].lower() == image['gallery']['name'].lower() \
+            and inventory['subscription'] == image['gallery']['subscription']:
+        return inventory
+    return None
+
+
+def _inventory_definition(inventory, image):
+    return inventory['definitions'].get(image['name'].lower(), None)
+
+
+def _inventory_version(inventory, image):
+    return inventory['versions'].get((image['name'].lower(), image['version']), None)
+
+
+def _inventory_versions(inventory, image):
+    name = image['name'].lower()
+    return [v for k, v in inventory['versions'].items() if k[0] == name]
+
+
+def _inventory_add_definition(inventory, imgdef):
+    if inventory and imgdef:
+        inventory['definitions'][imgdef['name'].lower()] = imgdef
+
+
+def _img_ver_tag_cmd(image, key, value):
+    return ['sig', 'image-version', 'update', '--only-show-errors', '-g', image['gallery']['resourceGroup'],
+            '-r', image['gallery']['name'], '-i', image['name'], '-e', image['version'],
+            '--set', f'tags.{key}={value}', '--subscription', image['gallery']['subscription']]
+
+
+def _img_ver_replicate_cmd(image, regions):
+    return ['sig', 'image-version', 'update', '--only-show-errors', '-g', image['gallery']['resourceGroup'],
+            '-r', image['gallery']['name'], '-i', image['name'], '-e', image['version'],
+            '--target-regions'] + list(regions) + ['--no-wait', '--subscription', image['gallery']['subscription']]
+
+
+def _img_ver_status_cmd(image):
+    return _img_ver_show_cmd(image) + ['--expand', 'ReplicationStatus']
+
+
+def _command_name(args) -> str:
+    '''Returns the az command without its arguments (i.e. sig image-version show) for traces'''
+    words = []
+    for arg in args[1:]:
+        if arg.startswith('-') or arg.startswith('@'):
+            break
+        words.append(arg)
+    return ' '.join(words)
+
+
 def _parse_command(command):
     '''Parses a command (string or list of args), adds the required arguments, and replaces executable with full path'''
     if isinstance(command, list):
@@ -60,7 +219,7 @@ def _parse_command(command):
     else:
         raise ValueError(f'az command must be a string or list, not {type(command)}')
 
-    az = shutil.which('az')
+    az = _az_path() or 'az'
 
     if args[0] == 'az':
         args.pop(0)
@@ -75,11 +234,31 @@ def cli(command, log_command=True):
     '''Runs an azure cli command and returns the json response'''
     args = _parse_command(command)
 
+    with tracing.span('az', command=_command_name(args)):
+        return _cli(args, log_command)
+
+
+def _cli(args, log_command=True):
+    if _use_arm(args):
+        try:
+            if log_command:
+                log.info(f'Sending az cli command with arm transport: {" ".join(args)}')
+            tracing.annotate(transport='arm')
+            return arm.request(args[1:])
+        except arm.ArmError as e:
+            error_exit(str(e))
+        except arm.TransportUnavailable as e:
+            log.warning(f'arm transport unavailable, falling back to the az cli: {e}')
+        except arm.TransportError as e:
+            log.warning(f'arm request failed, running the command with the az cli: {e}')
+
     try:
         if log_command:
             log.info(f'Running az cli command: {" ".join(args)}')
 
+        tracing.annotate(transport='cli')
         proc = subprocess.run(args, capture_output=True, check=True, text=True)
+        tracing.annotate(exit_code=proc.returncode)
 
         if proc.returncode == 0 and not proc.stdout:
             return None
@@ -91,6 +270,8 @@ def cli(command, log_command=True):
 
     except subprocess.CalledProcessError as e:
 
+        tracing.annotate(exit_code=e.returncode)
+
         if e.stderr and RESOURCE_NOT_FOUND in e.stderr:
             return None
 
@@ -100,32 +281,43 @@ def cli(command, log_command=True):
         error_exit('{}: {}'.format('Could not decode response json', proc.stderr if proc.stderr else proc.stdout if proc.stdout else proc))
 
 
-def get_sub():
+def _run(session, command):
+    '''Runs the command through the session, if there is one, so it can be memoized'''
+    return session.cli(command) if session else cli(command)
+
+
+def get_sub(session=None):
     '''Returns the current subscription id from the azure cli'''
-    sub = cli('az account show')
+    sub = _run(session, 'az account show')
     return sub['id']
 
 
-def ensure_image_def_version(image):
-    '''Ensures that the image definition exists and the version does not exist in the gallery'''
+def ensure_image_def_version(image, inventory=None, session=None):
+    '''Ensures that the image definition exists and the version does not exist in the gallery.
+    If a gallery inventory is provided, it is used instead of querying azure for the definition and version'''
     image_name = image['name']
     image_version = image['version']
 
+    inventory = _inventory_for(image, inventory)
+
     build = False
 
     log.info(f'Validating image definition and version for {image_name}')
     log.info(f'Checking if image definition exists for {image_name}')
-    imgdef = cli(_img_def_show_cmd(image))
+    imgdef = _inventory_definition(inventory, image) if inventory else _run(session, _img_def_show_cmd(image))
 
     if imgdef:  # image definition exists, check if the version already exists
 
         log.info(f'Found existing image definition for {image_name}')
         log.info(f'Checking if image version {image_version} exists for {image_name}')
-        imgver = cli(_img_ver_show_cmd(image))
+        imgver = _inventory_version(inventory, image) if inventory else _run(session, _img_ver_show_cmd(image))
 
         if imgver:
             log.info(f'Found existing image version {image_version} for {image_name}')
-            log.warning(f'{image_name} was not built because version {image_version} already exists. Please update the version number or delete the existing image version and try again.')
+            if layers.is_layer(image):  # layer versions are keyed by their content and refresh period
+                log.info(f'{image_name} was not built because its content is unchanged from version {image_version} (published this refresh period)')
+            else:
+                log.warning(f'{image_name} was not built because version {image_version} already exists. Please update the version number or delete the existing image version and try again.')
         else:  # image version does not exist, add it to the list of images to create
             log.info(f'Image version {image_version} does not exist for {image_name}')
             build = True
@@ -134,13 +326,35 @@ def ensure_image_def_version(image):
 
         log.info(f'Image definition does not exist for {image_name}')
         log.info(f'Creating image definition for {image_name}')
-        imgdef = cli(_img_def_create_cmd(image))
+        imgdef = _run(session, _img_def_create_cmd(image))
+        _inventory_add_definition(inventory, imgdef)
 
         build = True
 
     return build, imgdef
 
 
+def list_image_definitions(gallery):
+    '''Returns all the image definitions in the gallery'''
+    return cli(_img_def_list_cmd(gallery)) or []
+
+
+def list_image_versions(gallery, definition, session=None):
+    '''Returns all the image versions for an image definition in the gallery'''
+    return _run(session, _img_ver_list_cmd(gallery, definition)) or []
+
+
+def image_versions(image, inventory=None, session=None):
+    '''Returns all the versions of the image's definition, from the gallery inventory if one is provided'''
+    inventory = _inventory_for(image, inventory)
+    return _inventory_versions(inventory, image) if inventory else list_image_versions(image['gallery'], image['name'], session)
+
+
+def tag_image_version(image, key, value):
+    '''Adds or updates a tag on the image version in the gallery'''
+    return cli(_img_ver_tag_cmd(image, key, value))
+
+
 def save_params_file(image, params, filename):
     params_json = {
         '$schema': 'https://schema.management.azure.com/schemas/2019-04-01/deploymentParameters.json#',
@@ -166,84 +380,237 @@ def save_params_file(image, params, filename):
     return os.path.join(image['path'], filename)
 
 
+def _builder_build(batch, manifest='') -> dict:
+    '''Returns the entry in the builds parameter of templates/builder_batch.bicep for a builder that builds the batch
+    of images (with the manifest of their resolved properties), the builder is named after the first image'''
+    image = batch[0]
+    temp = bool(image.get('tempResourceGroup', None))
+    return {
+        'image': image['name'],
+        'images': [i['name'] for i in batch] if len(batch) > 1 else [],
+        'version': image['version'],
+        'resourceGroup': _builder_group(image),
+        'createGroup': temp,
+        'location': image['location'] if temp else '',
+        'manifest': manifest
+    }
+
+
+def save_batch_params_file(batches, params, path, manifests=None):
+    '''Saves one parameters file for templates/builder_batch.bicep that deploys a builder for each batch of images.
+    manifests has the manifest for each builder by the name of the image it's named after'''
+    manifests = manifests if manifests else {}
+    params_json = {
+        '$schema': 'https://schema.management.azure.com/schemas/2019-04-01/deploymentParameters.json#',
+        'contentVersion': '1.0.0.0',
+        'parameters': {
+            'builds': {
+                'value': [_builder_build(b, manifests.get(b[0]['name'], '')) for b in batches]
+            }
+        }
+    }
+
+    for p in params:
+        params_json['parameters'][p] = {
+            'value': params[p]
+        }
+
+    with open(path, 'w') as f:
+        json.dump(params_json, f, ensure_ascii=False, indent=4, sort_keys=True)
+
+    return str(path)
+
+
+def _batch_location(builds):
+    '''Returns the location of the first temporary resource group, or None if all the builders use existing groups'''
+    return next((b['location'] for b in builds if b['location']), None)
+
+
+def _group_location(group, build):
+    if not group:
+        error_exit(f'Resource group {build["resourceGroup"]} for the {build["image"]} builder was not found')
+    return group['location']
+
+
+def deploy_builders(batches, params_file, name, session=None):
+    '''Deploys the builders for every batch of images (which must share a subscription) with a single deployment'''
+    bicep_file = os.path.join(Path(__file__).resolve().parent, 'templates', 'builder_batch.bicep')
+    # deploy the cached json so bicep isn't compiled again on every deployment
+    template_file = bicep.to_json(bicep_file)
+
+    subscription = batches[0][0]['subscription']
+    builds = [_builder_build(b) for b in batches]
+
+    with tracing.span('deploy builders', builders=len(builds)):
+        # the deployment's metadata has to be stored in a location
+        location = _batch_location(builds) or _group_location(_run(session, _group_show_cmd(builds[0]['resourceGroup'], subscription)), builds[0])
+        dep = cli(_deployment_sub_create_cmd(name, location, template_file, params_file, subscription))
+
+    return dep
+
+
 def deploy_builder(image, params_file):
     '''Deploys the builder resources to kick off the image build'''
     bicep_file = os.path.join(Path(__file__).resolve().parent, 'templates', 'builder.bicep')
+    # deploy the cached json so bicep isn't compiled again on every deployment
+    template_file = bicep.to_json(bicep_file)
 
-    if 'tempResourceGroup' in image and image['tempResourceGroup']:
-        group_name = image['tempResourceGroup']
-        group = cli(_group_create_cmd(group_name, image))
-    else:
-        group_name = image['buildResourceGroup']
+    group_name = _builder_group(image)
+
+    with tracing.span('deploy builder', image=image['name']):
+        if 'tempResourceGroup' in image and image['tempResourceGroup']:
+            group = cli(_group_create_cmd(group_name, image))
 
-    dep = cli(_deployment_group_create_cmd(group_name, bicep_file, params_file, image))
+        dep = cli(_deployment_group_create_cmd(group_name, template_file, params_file, image))
 
     return dep
 
 
+def builder_state(image) -> tuple:
+    '''Returns the builder's container group (None if it doesn't exist) and its exit code (None if it's still running)'''
+    container_group = cli(_container_show_cmd(_builder_group(image), image), log_command=False)
+    return container_group, _builder_exit_code(container_group)
+
+
+def wait_for_builder(image, interval=BUILDER_POLL_INTERVAL, timeout=BUILDER_WAIT_TIMEOUT):
+    '''Waits for the builder container to finish and returns its exit code (1 if it's missing or doesn't finish in time)'''
+    group_name = _builder_group(image)
+    log.info(f'Waiting for the {image["name"]} builder to finish')
+    start = time.monotonic()
+    missing = 0
+    while True:
+        container_group = cli(_container_show_cmd(group_name, image), log_command=False)
+        missing = 0 if container_group else missing + 1
+        exit_code = _builder_result(image, container_group, missing, (time.monotonic() - start) / 60, timeout)
+        if exit_code is not None:
+            return exit_code
+        time.sleep(interval)
+
+
 # ----------------
 # async functions
 # ----------------
 
 
-async def cli_async(command, log_command=True):
-    '''Runs an azure cli command and returns the json response'''
-    args = _parse_command(command)
+def _log_stdout(source, line):
+    if source == 'stdout':
+        log.info(line)
+
+
+async def _cli_async_once(args, log_command=True):
+    '''Runs an azure cli command once, raising a RetryableError if it was throttled or failed with a transient error'''
+    if _use_arm(args):
+        try:
+            if log_command:
+                log.info(f'Sending az cli command with arm transport: {" ".join(args)}')
+            tracing.annotate(transport='arm')
+            return await asyncio.to_thread(arm.request, args[1:])
+        except arm.ArmError as e:
+            kind = throttle.classify(e.message, e.status, e.code)
+            if kind:
+                raise throttle.RetryableError(kind, str(e), e.retry_after)
+            error_exit(str(e))
+        except arm.TransportUnavailable as e:
+            log.warning(f'arm transport unavailable, falling back to the az cli: {e}')
+        except arm.TransportError as e:
+            raise throttle.RetryableError(throttle.TRANSIENT, str(e))
 
     if log_command:
         log.info(f'Running az cli command: {" ".join(args)}')
 
+    tracing.annotate(transport='cli')
+    lease = _configs.acquire() if _configs else None
     try:
-        proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await proc.communicate()
+        returncode, stdout, stderr = await stream.run_async(args, capture=True, sink=_log_stdout, env=_configs.env(lease) if lease else None)
+    finally:
+        if lease:
+            _configs.release(lease)
+    tracing.annotate(exit_code=returncode)
+
+    if stderr and RESOURCE_NOT_FOUND in stderr:
+        return None
+
+    if returncode != 0:
+        # the az cli doesn't report the http status, and a deployment that failed after it was accepted may have
+        # started builders, so failed deployments aren't retried
+        kind = None if _is_deployment(args) else throttle.classify(stderr)
+        if kind:
+            raise throttle.RetryableError(kind, stderr, throttle.retry_after(stderr))
+        error_exit(stderr if stderr else 'azure cli command failed')
+
+    if stdout:
+        try:
+            resource = json.loads(stdout)
+            return resource
+        except json.decoder.JSONDecodeError:
+            error_exit('{}: {}'.format('Could not decode response json', stderr if stderr else stdout))
 
-        if stderr and RESOURCE_NOT_FOUND in stderr.decode():
-            return None
 
-        if proc.returncode != 0:
-            error_exit(stderr.decode() if stderr else 'azure cli command failed')
+async def cli_async(command, log_command=True):
+    '''Runs an azure cli command and returns the json response. Throttled and transiently failed commands are retried
+    and the number of commands running at once adapts to throttling'''
+    args = _parse_command(command)
 
-        if stdout:
-            for line in stdout.decode().splitlines():
-                log.info(line)
+    try:
+        with tracing.span('az', command=_command_name(args)):
+            return await _controller.call(_cli_async_once, args, log_command)
 
-            try:
-                resource = json.loads(stdout)
-                return resource
-            except json.decoder.JSONDecodeError:
-                error_exit('{}: {}'.format('Could not decode response json', stderr.decode() if stderr else stdout if stdout else proc))
+    except throttle.RetryableError as e:
+
+        error_exit(f'azure cli command failed after {_controller.max_retries} retries: {e}')
 
     except SystemExit as e:
 
         error_exit(e.code if e.code else 'azure cli command failed')
 
 
-async def get_sub_async():
+def throttle_stats() -> dict:
+    '''Returns the async az call retry counters and current concurrency window'''
+    return _controller.stats()
+
+
+def config_stats() -> dict:
+    '''Returns the counters of the config directories used by async az commands, or None if they share one'''
+    return _configs.stats() if _configs else None
+
+
+async def _run_async(session, command):
+    '''Runs the command through the session, if there is one, so it can be memoized or coalesced'''
+    return await (session.cli_async(command) if session else cli_async(command))
+
+
+async def get_sub_async(session=None):
     '''Returns the current subscription id from the azure cli'''
-    sub = await cli_async('az account show')
+    sub = await _run_async(session, 'az account show')
     return sub['id']
 
 
-async def ensure_image_def_version_async(image):
-    '''Ensures that the image definition exists and the version does not exist in the gallery'''
+async def ensure_image_def_version_async(image, inventory=None, session=None):
+    '''Ensures that the image definition exists and the version does not exist in the gallery.
+    If a gallery inventory is provided, it is used instead of querying azure for the definition and version'''
     image_name = image['name']
     image_version = image['version']
 
+    inventory = _inventory_for(image, inventory)
+
     build = False
 
     log.info(f'Validating image definition and version for {image_name}')
     log.info(f'Checking if image definition exists for {image_name}')
-    imgdef = await cli_async(_img_def_show_cmd(image))
+    imgdef = _inventory_definition(inventory, image) if inventory else await _run_async(session, _img_def_show_cmd(image))
 
     if imgdef:  # image definition exists, check if the version already exists
 
         log.info(f'Found existing image definition for {image_name}')
         log.info(f'Checking if image version {image_version} exists for {image_name}')
-        imgver = await cli_async(_img_ver_show_cmd(image))
+        imgver = _inventory_version(inventory, image) if inventory else await _run_async(session, _img_ver_show_cmd(image))
 
         if imgver:
             log.info(f'Found existing image version {image_version} for {image_name}')
-            log.warning(f'{image_name} was not built because version {image_version} already exists. Please update the version number or delete the existing image version and try again.')
+            if layers.is_layer(image):  # layer versions are keyed by their content and refresh period
+                log.info(f'{image_name} was not built because its content is unchanged from version {image_version} (published this refresh period)')
+            else:
+                log.warning(f'{image_name} was not built because version {image_version} already exists. Please update the version number or delete the existing image version and try again.')
         else:  # image version does not exist, add it to the list of images to create
             log.info(f'Image version {image_version} does not exist for {image_name}')
             build = True
@@ -252,23 +619,194 @@ async def ensure_image_def_version_async(image):
 
         log.info(f'Image definition does not exist for {image_name}')
         log.info(f'Creating image definition for {image_name}')
-        imgdef = await cli_async(_img_def_create_cmd(image))
+        imgdef = await _run_async(session, _img_def_create_cmd(image))
+        _inventory_add_definition(inventory, imgdef)
 
         build = True
 
     return build, imgdef
 
 
+async def list_image_definitions_async(gallery):
+    '''Returns all the image definitions in the gallery'''
+    return await cli_async(_img_def_list_cmd(gallery)) or []
+
+
+async def list_image_versions_async(gallery, definition, session=None):
+    '''Returns all the image versions for an image definition in the gallery'''
+    return await _run_async(session, _img_ver_list_cmd(gallery, definition)) or []
+
+
+async def image_versions_async(image, inventory=None, session=None):
+    '''Returns all the versions of the image's definition, from the gallery inventory if one is provided'''
+    inventory = _inventory_for(image, inventory)
+    return _inventory_versions(inventory, image) if inventory else await list_image_versions_async(image['gallery'], image['name'], session)
+
+
+async def tag_image_version_async(image, key, value):
+    '''Adds or updates a tag on the image version in the gallery'''
+    return await cli_async(_img_ver_tag_cmd(image, key, value))
+
+
+async def replicate_image_version_async(image, regions):
+    '''Starts replicating the image version to the regions (which replace its current target regions) without waiting'''
+    return await cli_async(_img_ver_replicate_cmd(image, regions))
+
+
+async def image_version_status_async(image, log_command=True):
+    '''Returns the image version with the replication status of each of its regions'''
+    return await cli_async(_img_ver_status_cmd(image), log_command=log_command)
+
+
+async def builder_state_async(image) -> tuple:
+    '''Returns the builder's container group (None if it doesn't exist) and its exit code (None if it's still running)'''
+    container_group = await cli_async(_container_show_cmd(_builder_group(image), image), log_command=False)
+    return container_group, _builder_exit_code(container_group)
+
+
+async def wait_for_builder_async(image, interval=BUILDER_POLL_INTERVAL, timeout=BUILDER_WAIT_TIMEOUT):
+    '''Waits for the builder container to finish and returns its exit code (1 if it's missing or doesn't finish in time)'''
+    group_name = _builder_group(image)
+    log.info(f'Waiting for the {image["name"]} builder to finish')
+    start = time.monotonic()
+    missing = 0
+    while True:
+        container_group = await cli_async(_container_show_cmd(group_name, image), log_command=False)
+        missing = 0 if container_group else missing + 1
+        exit_code = _builder_result(image, container_group, missing, (time.monotonic() - start) / 60, timeout)
+        if exit_code is not None:
+            return exit_code
+        await asyncio.sleep(interval)
+
+
+async def deploy_builders_async(batches, params_file, name, session=None):
+    '''Deploys the builders for every batch of images (which must share a subscription) with a single deployment'''
+    bicep_file = os.path.join(Path(__file__).resolve().parent, 'templates', 'builder_batch.bicep')
+    # deploy the cached json so bicep isn't compiled again on every deployment
+    template_file = await bicep.to_json_async(bicep_file)
+
+    subscription = batches[0][0]['subscription']
+    builds = [_builder_build(b) for b in batches]
+
+    with tracing.span('deploy builders', builders=len(builds)):
+        # the deployment's metadata has to be stored in a location
+        location = _batch_location(builds) or _group_location(await _run_async(session, _group_show_cmd(builds[0]['resourceGroup'], subscription)), builds[0])
+        dep = await cli_async(_deployment_sub_create_cmd(name, location, template_file, params_file, subscription))
+
+    return dep
+
+
+async def builder_location_async(image, session=None):
+    '''Returns the region the image's builder is deployed to: its location, or the location of its build resource group'''
+    if image.get('location', None):
+        return image['location']
+    group = await _run_async(session, _group_show_cmd(image['buildResourceGroup'], image['subscription']))
+    return _group_location(group, {'resourceGroup': image['buildResourceGroup'], 'image': image['name']})
+
+
 async def deploy_builder_async(image, params_file):
     '''Deploys the builder resources to kick off the image build'''
     bicep_file = os.path.join(Path(__file__).resolve().parent, 'templates', 'builder.bicep')
+    # deploy the cached json so bicep isn't compiled again on every deployment
+    template_file = await bicep.to_json_async(bicep_file)
 
-    if 'tempResourceGroup' in image and image['tempResourceGroup']:
-        group_name = image['tempResourceGroup']
-        group = await cli_async(_group_create_cmd(group_name, image))
-    else:
-        group_name = image['buildResourceGroup']
+    group_name = _builder_group(image)
+
+    with tracing.span('deploy builder', image=image['name']):
+        if 'tempResourceGroup' in image and image['tempResourceGroup']:
+            group = await cli_async(_group_create_cmd(group_name, image))
 
-    dep = await cli_async(_deployment_group_create_cmd(group_name, bicep_file, params_file, image))
+        dep = await cli_async(_deployment_group_create_cmd(group_name, template_file, params_file, image))
 
     return dep
+
+
+# ----------------
+# session
+# ----------------
+
+
+class AzureSession:
+    '''The az commands of one run. Commands whose results don't change during a run (the account and resource groups)
+    are memoized, and identical read commands already in flight are coalesced so concurrent callers await one result
+    instead of each starting an az process'''
+
+    MEMOIZED = ['account show', 'group show']
+    COALESCED_VERBS = ['show', 'list']
+
+    def __init__(self):
+        self._results = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'memoized': 0, 'coalesced': 0}
+
+    def _key(self, command):
+        args = _parse_command(list(command) if isinstance(command, list) else command)
+        name = _command_name(args)
+        return tuple(args[1:]), name
+
+    def _memoized(self, key):
+        with self._lock:
+            if key not in self._results:
+                return False, None
+            self._stats['memoized'] += 1
+            return True, copy.deepcopy(self._results[key])
+
+    def _memoize(self, key, name, result):
+        if name in self.MEMOIZED and result is not None:
+            with self._lock:
+                self._results[key] = copy.deepcopy(result)
+
+    def cli(self, command, log_command=True):
+        '''Runs an azure cli command (see cli) unless its result is memoized'''
+        key, name = self._key(command)
+        found, result = self._memoized(key)
+        if found:
+            return result
+
+        with self._lock:
+            self._stats['calls'] += 1
+        result = cli(command, log_command)
+        self._memoize(key, name, result)
+        return result
+
+    async def cli_async(self, command, log_command=True):
+        '''Runs an azure cli command (see cli_async) unless its result is memoized or the same read command is in
+        flight, then it waits for that command's result instead'''
+        key, name = self._key(command)
+        found, result = self._memoized(key)
+        if found:
+            return result
+
+        waiting = None
+        if name.split(' ')[-1] in self.COALESCED_VERBS:
+            if key in self._inflight:
+                self._stats['coalesced'] += 1
+                return copy.deepcopy(await self._inflight[key])
+            waiting = asyncio.get_running_loop().create_future()
+            self._inflight[key] = waiting
+
+        self._stats['calls'] += 1
+        try:
+            result = await cli_async(command, log_command)
+        except BaseException as e:  # error_exit raises SystemExit, the callers waiting for the command get it too
+            if waiting:
+                if isinstance(e, asyncio.CancelledError):
+                    waiting.cancel()
+                else:
+                    waiting.set_exception(e)
+                    waiting.exception()  # it's raised in the callers waiting for it (if there are any)
+            raise
+        finally:
+            if waiting:
+                self._inflight.pop(key, None)
+
+        self._memoize(key, name, result)
+        if waiting:
+            waiting.set_result(result)
+        return result
+
+    def stats(self) -> dict:
+        '''Returns the number of az commands run, and the number saved by memoizing and coalescing them'''
+        with self._lock:
+            return dict(self._stats, saved=self._stats['memoized'] + self._stats['coalesced'])
@@ -0,0 +1,184 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import argparse
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # windows, only the in-process lock is used
+    fcntl = None
+
+import loggers
+import tracing
+
+BICEP_CACHE_DIR = 'bicep'
+
+# bump when the layout of the cache changes so old and new versions don't share a cache
+BICEP_CACHE_VERSION = 'v1'
+
+# set to false to deploy the bicep templates directly (compiling them on every deployment)
+CACHE = os.environ.get('BUILDER_BICEP_CACHE', 'true').lower() not in ['0', 'false', 'no']
+
+MODULE_PATTERN = re.compile(r'^\s*module\s+\w+\s+\'([^\']+)\'', re.MULTILINE)
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+
+cache_dir = storage / BICEP_CACHE_DIR / BICEP_CACHE_VERSION
+
+# the templates compiled by warm
+template_dirs = [Path(__file__).resolve().parent / 'templates', repo / 'tools' / 'templates']
+
+stats = {'hits': 0, 'misses': 0}
+
+_thread_lock = threading.Lock()
+
+
+def error_exit(message):
+    log.error(message)
+    sys.exit(message)
+
+
+def modules(path) -> list:
+    '''Returns the paths of the local modules (recursively) a bicep template references, registry modules are ignored'''
+    found = []
+    pending = [Path(path).resolve()]
+    while pending:
+        template = pending.pop()
+        for ref in MODULE_PATTERN.findall(template.read_text()):
+            if ':' in ref:  # br:, ts:
+                continue
+            module = (template.parent / ref).resolve()
+            if module not in found:
+                found.append(module)
+                pending.append(module)
+    return sorted(found)
+
+
+def key(path) -> str:
+    '''Returns a hash of the content of a bicep template and all the modules it references'''
+    path = Path(path).resolve()
+    sha = hashlib.sha256()
+    for file in [path] + modules(path):
+        sha.update(os.path.relpath(file, path.parent).encode())
+        sha.update(b'\0')
+        sha.update(file.read_bytes())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def cached_path(path) -> Path:
+    '''Returns the path of the compiled json for the current content of a bicep template'''
+    path = Path(path)
+    return cache_dir / f'{path.stem}-{key(path)[:16]}.json'
+
+
+def _acquire(lock_file):
+    _thread_lock.acquire()
+    try:
+        lock_file.parent.mkdir(parents=True, exist_ok=True)
+        f = open(lock_file, 'a')
+        if fcntl:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+        return f
+    except BaseException:
+        _thread_lock.release()
+        raise
+
+
+def _release(f):
+    try:
+        if fcntl:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+        f.close()
+    finally:
+        _thread_lock.release()
+
+
+def _build(path, outfile):
+    args = [shutil.which('az') or 'az', 'bicep', 'build', '--file', str(path), '--outfile', str(outfile)]
+    log.info(f'Running az cli command: {" ".join(args)}')
+    with tracing.span('bicep build', template=Path(path).name):
+        proc = subprocess.run(args, capture_output=True, text=True)
+        tracing.annotate(exit_code=proc.returncode)
+    if proc.returncode != 0 or not outfile.is_file():
+        error_exit(f'Failed to compile {path}: {proc.stderr.strip() if proc.stderr else "az bicep build failed"}')
+
+
+def to_json(path) -> str:
+    '''Returns the path of the arm json template compiled from the bicep template. Templates are only compiled when
+    they (or their modules) change, and compilation is serialised across threads and processes sharing the cache'''
+    if not CACHE:
+        return str(path)
+
+    compiled = cached_path(path)
+    if compiled.is_file():
+        stats['hits'] += 1
+        return str(compiled)
+
+    f = _acquire(cache_dir.with_suffix('.lock'))
+    try:
+        if compiled.is_file():  # compiled by another caller while waiting for the lock
+            stats['hits'] += 1
+            return str(compiled)
+        stats['misses'] += 1
+        log.info(f'Compiling {path} to {compiled}')
+        compiled.parent.mkdir(parents=True, exist_ok=True)
+        temp = compiled.with_suffix(f'.{os.getpid()}.tmp')
+        _build(path, temp)
+        os.replace(temp, compiled)
+    finally:
+        _release(f)
+
+    return str(compiled)
+
+
+async def to_json_async(path) -> str:
+    '''Returns the path of the arm json template compiled from the bicep template without blocking the event loop'''
+    if not CACHE:
+        return str(path)
+    compiled = cached_path(path)
+    if compiled.is_file():
+        stats['hits'] += 1
+        return str(compiled)
+    return await asyncio.to_thread(to_json, path)
+
+
+def templates() -> list:
+    '''Returns the paths of the bicep templates in the builder and tools templates directories'''
+    return sorted(p for d in template_dirs if d.is_dir() for p in d.glob('*.bicep'))
+
+
+def warm() -> list:
+    '''Compiles every template (that isn't already in the cache), returns the paths of the compiled templates'''
+    return [to_json(p) for p in templates()]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compile the bicep templates in builder/templates and tools/templates into the template cache')
+    parser.add_argument('templates', nargs='*', help='paths of the templates to compile. if not specified all templates will be')
+
+    args = parser.parse_args()
+
+    paths = [to_json(p) for p in args.templates] if args.templates else warm()
+
+    log.info(f'Bicep template cache hits: {stats["hits"]} misses: {stats["misses"]}')
+    for p in paths:
+        log.info(p)
@@ -5,15 +5,29 @@
 
 import argparse
 import asyncio
+import secrets
 import sys
+import time
 from datetime import datetime, timezone
+from pathlib import Path
 
 import azure as az
+import changes as chg
 import image as img
+import inventory as inv
+import layers
+import ledger as ldg
 import loggers
+import manifest as mft
+import plan as pln
+import replication as rep
 import repos
+import scheduler as sched
+import tracing
 
 BUILDER_PARAMS_FILE = 'builder.parameters.json'
+BUILDER_BATCH_PARAMS_FILE = 'builder.batch.{subscription}.parameters.json'
+BUILDER_BATCH_LEVEL_PARAMS_FILE = 'builder.batch.{subscription}.{level}.parameters.json'
 
 log = loggers.getLogger(__name__)
 
@@ -23,50 +37,467 @@ def error_exit(message):
     sys.exit(message)
 
 
-def main(gallery, common, names, params, suffix, skip_build=False):
+def batches(images, size=1) -> list:
+    '''Groups the images into lists of at most size images that are built by one builder container. Only images
+    whose builders deploy to the same subscription and resource group (or location) are grouped, and layers are
+    never grouped with the images derived from them. Layers are grouped (and listed) first'''
+    bases = {i['name']: i.get('base', None) for i in images}
+    groups = {}
+    for image in sorted(images, key=lambda i: layers.depth(i['name'], bases)):
+        key = (layers.depth(image['name'], bases), image['subscription'], image.get('buildResourceGroup', None) or image.get('location', None))
+        groups.setdefault(key, []).append(image)
+
+    size = max(1, size or 1)
+    return [group[i:i + size] for group in groups.values() for i in range(0, len(group), size)]
+
+
+def batch_params(params, batch) -> dict:
+    '''Returns the builder parameters for a batch of images, the builder is named after the first image'''
+    return dict(params, images=[i['name'] for i in batch]) if len(batch) > 1 else params
+
+
+def manifest(params, batch, suffix) -> str:
+    '''Returns the signed manifest of the batch's resolved images for its builder, or an empty string if the builder
+    parameters don't have a key to sign it with'''
+    key = params.get('manifestKey', None)
+    return mft.dumps(mft.create(batch, suffix, key)) if key else ''
+
+
+def by_subscription(batches) -> dict:
+    '''Groups batches of images by the subscription their builders deploy to, each subscription gets one batch deployment'''
+    subscriptions = {}
+    for batch in batches:
+        subscriptions.setdefault(batch[0]['subscription'], []).append(batch)
+    return subscriptions
+
+
+def dependencies(batches) -> dict:
+    '''Returns the names of the builders that build the base layers of each builder's images, by builder name'''
+    builders = {i['name']: b[0]['name'] for b in batches for i in b}
+    return {b[0]['name']: sorted({builders[i['base']] for i in b if i.get('base', None) in builders} - {b[0]['name']})
+            for b in batches}
+
+
+def levels(batches) -> list:
+    '''Groups the batches (listed layers first) into levels that are deployed one after the other, the base layers
+    of a level's images are built by the levels before it'''
+    after = dependencies(batches)
+    level = {}
+    result = []
+    for batch in batches:
+        name = batch[0]['name']
+        level[name] = max([level[n] + 1 for n in after[name]], default=0)
+        if level[name] == len(result):
+            result.append([])
+        result[level[name]].append(batch)
+    return result
+
+
+def save_batch_params_files(batches, params, suffix=None, level=0) -> dict:
+    '''Saves a parameters file listing the builders for each subscription, returns the paths by subscription.
+    Each level of builders (after the first) gets its own files'''
+    manifests = {b[0]['name']: manifest(params, b, suffix) for b in batches}
+    file = BUILDER_BATCH_LEVEL_PARAMS_FILE if level else BUILDER_BATCH_PARAMS_FILE
+    return {sub: az.save_batch_params_file(b, params, img.images_root / file.format(subscription=sub, level=level), manifests)
+            for sub, b in by_subscription(batches).items()}
+
+
+def _deployment_name(suffix, level) -> str:
+    return f'builders-{suffix}-{level}' if level else f'builders-{suffix}'
+
+
+def make_plan(gallery, common, names, params, suffix, inventory, skip_unchanged=True, images_per_builder=1, batch_deploy=False) -> dict:
+    '''Returns a plan of the images that would be built (and the builders that would build them) decided from a
+    snapshot of the gallery, nothing in azure is queried or changed'''
     if names is None:
-        images = img.all(gallery, common, suffix, ensure_azure=True)
-    else:
-        images = [img.get(n, gallery, common, suffix, ensure_azure=True) for n in names]
+        names = img.image_names()
+
+    images = []
+    for name in names:
+        with loggers.context(image=name, phase='plan'):
+            images.append(img.plan(name, gallery, common, suffix, inventory, skip_unchanged))
+
+    builds = batches([i for i in images if i['build']], images_per_builder)
+
+    return pln.create(images, builds, params, suffix, inventory, skip_unchanged, images_per_builder, batch_deploy, layers.refresh())
 
-    for image in images:
 
-        if image['build']:
-            params_file = az.save_params_file(image, params, BUILDER_PARAMS_FILE)
+def _start(ledger, names) -> list:
+    '''Returns the names of the images in the run (the names recorded in the ledger of a resumed run)'''
+    if ledger.names is None:
+        ledger.start(names if names is not None else img.image_names())
+    elif names is not None and names != ledger.names:
+        log.warning(f'Resuming run {ledger.run} with the images it started with: {ledger.names}')
+    return ledger.names
+
+
+def _validated(ledger, names) -> dict:
+    '''Returns the properties of the images the ledger recorded as validated'''
+    validated = {n: ledger.get(n, 'validated')['properties'] for n in names if ledger.done(n, 'validated')}
+    if validated:
+        log.info(f'Skipping validation of {len(validated)} {"image" if len(validated) == 1 else "images"} validated by run {ledger.run}')
+    return validated
+
+
+def _params_file(ledger, batch, params) -> str:
+    '''Saves the builder parameters file for a batch unless the ledger recorded it was saved (and it still exists)'''
+    image = batch[0]
+    saved = ledger.get(image['name'], 'params')
+    if saved and Path(saved['file']).is_file():
+        return saved['file']
+    params = batch_params(params, batch)
+    if params.get('manifestKey', None):
+        params = dict(params, manifest=manifest(params, batch, ledger.run))
+    params_file = az.save_params_file(image, params, BUILDER_PARAMS_FILE)
+    ledger.record(image['name'], 'params', file=params_file)
+    return params_file
+
+
+def _deployed(ledger, batch) -> bool:
+    '''Returns True if the ledger recorded the batch's builder was deployed and it hasn't finished with an error'''
+    finished = _finished(ledger, batch)
+    return ledger.done(batch[0]['name'], 'deployed') and (finished is None or finished['exitCode'] == 0)
+
+
+def _unfinished(ledger, builds) -> list:
+    '''Returns the batches whose builders the ledger recorded as deployed but not finished (runs that didn't wait for them)'''
+    return [b for b in builds if ledger.done(b[0]['name'], 'deployed') and _finished(ledger, b) is None]
+
+
+def _record_state(ledger, batch, container_group, exit_code):
+    '''Records the state of a builder deployed by the run being resumed: its exit code if it finished, or a failure if
+    its container group is gone, so it's deployed again unless it finished successfully'''
+    name = batch[0]['name']
+    if container_group is None:
+        log.warning(f'The container group of the {name} builder deployed by run {ledger.run} was not found, it will be deployed again')
+        ledger.record(name, 'finished', exitCode=1, missing=True)
+    elif exit_code is not None:
+        log.info(f'The {name} builder deployed by run {ledger.run} finished with exit code {exit_code}')
+        ledger.record(name, 'finished', exitCode=exit_code)
+
+
+def _check_deployed(ledger, builds):
+    '''Checks the builders deployed (and not waited for) by the run being resumed'''
+    for batch in _unfinished(ledger, builds):
+        _record_state(ledger, batch, *az.builder_state(batch[0]))
+
+
+async def _check_deployed_async(ledger, builds):
+    '''Checks the builders deployed (and not waited for) by the run being resumed'''
+    unfinished = _unfinished(ledger, builds)
+    states = await asyncio.gather(*[az.builder_state_async(b[0]) for b in unfinished])
+    for batch, state in zip(unfinished, states):
+        _record_state(ledger, batch, *state)
+
+
+def _record_deployed(ledger, batch):
+    ledger.record(batch[0]['name'], 'deployed', images=[i['name'] for i in batch])
+
+
+def _finished(ledger, batch) -> dict:
+    '''Returns the ledger's record of the batch's builder finishing, unless the builder was deployed again since'''
+    finished = ledger.get(batch[0]['name'], 'finished')
+    deployed = ledger.get(batch[0]['name'], 'deployed')
+    return finished if finished and (deployed is None or finished['time'] >= deployed['time']) else None
+
+
+def _wait(ledger, batch) -> int:
+    '''Waits for the batch's builder to finish (unless the ledger recorded it finished) and returns its exit code'''
+    finished = _finished(ledger, batch)
+    if finished:
+        return finished['exitCode']
+    exit_code = az.wait_for_builder(batch[0])
+    ledger.record(batch[0]['name'], 'finished', exitCode=exit_code)
+    return exit_code
+
+
+async def _wait_async(ledger, batch) -> int:
+    '''Waits for the batch's builder to finish (unless the ledger recorded it finished) and returns its exit code'''
+    finished = _finished(ledger, batch)
+    if finished:
+        return finished['exitCode']
+    exit_code = await az.wait_for_builder_async(batch[0])
+    ledger.record(batch[0]['name'], 'finished', exitCode=exit_code)
+    return exit_code
+
+
+def _failed_bases(batch, after, exit_codes) -> list:
+    '''Returns the builders of the batch's base layers that didn't finish successfully, logging why the batch is skipped'''
+    failed = [n for n in after[batch[0]['name']] if exit_codes.get(n, None) != 0]
+    if failed:
+        log.error(f'Skipping the {batch[0]["name"]} builder because the builders of its base layers failed: {failed}')
+    return failed
+
+
+def _replicated(ledger, batch) -> bool:
+    return all(ledger.done(i['name'], 'replicated') for i in batch)
+
+
+async def _replicate_async(ledger, batch) -> dict:
+    '''Replicates the versions of the images built by a batch's builder, recording the images that are ready in every region'''
+    results = await rep.replicate_all_async(batch)
+    failed = rep.failed(results)
+    for name, regions in results.items():
+        if name not in failed:
+            ledger.record(name, 'replicated', regions=list(regions))
+    return results
+
+
+def main(gallery, common, names, params, suffix, skip_build=False, skip_unchanged=True, images_per_builder=1, batch_deploy=False,
+         inventory=None, ledger=None, session=None):
+    # each step is recorded in the run's ledger so a failed run can be resumed
+    ledger = ledger if ledger else ldg.Ledger(suffix)
+    # the account and resource group lookups are shared by every image in the run
+    session = session if session else az.AzureSession()
+    names = _start(ledger, names)
+
+    images = _validated(ledger, names)
+
+    if len(images) < len(names):
+        # one snapshot of the gallery is used to validate all the images
+        if inventory is None:
+            inventory = inv.load(gallery, session)
+            # and saved so builds can be planned offline
+            inv.save(inventory)
+
+        for name in names:
+            if name not in images:
+                images[name] = img.get(name, gallery, common, suffix, ensure_azure=True, inventory=inventory, skip_unchanged=skip_unchanged, session=session)
+                ledger.record(name, 'validated', properties=images[name])
+
+    builds = batches([images[n] for n in names if images[n]['build']], images_per_builder)
+
+    # builders that failed (or are gone) since the run being resumed deployed them are deployed again
+    if not skip_build:
+        _check_deployed(ledger, builds)
+
+    # the builders of derived images are deployed once the builders of their base layers finish
+    after = dependencies(builds)
+    by_name = {b[0]['name']: b for b in builds}
+    exit_codes = {}
+    skipped = []
+
+    def _bases_built(batch):
+        for name in after[batch[0]['name']]:
+            if name not in exit_codes:
+                exit_codes[name] = _wait(ledger, by_name[name])
+        if _failed_bases(batch, after, exit_codes):
+            # and the builders of images derived from its images are skipped too
+            exit_codes[batch[0]['name']] = None
+            skipped.extend(i['name'] for i in batch)
+            return False
+        return True
+
+    if batch_deploy:
+        for level, level_builds in enumerate(levels(builds)):
+            params_files = save_batch_params_files(level_builds, params, suffix, level)
+
+            if not skip_build:
+                level_builds = [b for b in level_builds if _bases_built(b)]
+                for sub, sub_builds in by_subscription(level_builds).items():
+                    if all(_deployed(ledger, b) for b in sub_builds):
+                        log.info(f'Skipping deployment of the builders in subscription {sub} deployed by run {ledger.run}')
+                        continue
+                    az.deploy_builders(sub_builds, params_files[sub], _deployment_name(suffix, level), session)
+                    for batch in sub_builds:
+                        _record_deployed(ledger, batch)
+    else:
+        for batch in builds:
+            image = batch[0]
+            params_file = _params_file(ledger, batch, params)
 
             if not skip_build:
+                if not _bases_built(batch):
+                    continue
+                if _deployed(ledger, batch):
+                    log.info(f'Skipping deployment of the {image["name"]} builder deployed by run {ledger.run}')
+                    continue
                 az.deploy_builder(image, params_file)
+                _record_deployed(ledger, batch)
+
+    log.info(f'az session stats: {session.stats()}')
 
     if skip_build:
         log.warning('Skipping build execution because --skip-build was provided')
 
+    if skipped:
+        error_exit(f'{len(skipped)} {"image" if len(skipped) == 1 else "images"} were not built because their base layers failed to build: {skipped}')
+
 
 # ----------------
 # async functions
 # ----------------
 
 
-async def main_async(gallery, common, names, params, suffix, skip_build=False):
-    if names is None:
-        names = img.image_names()
+async def main_async(gallery, common, names, params, suffix, skip_build=False, skip_unchanged=True,
+                     max_builders=None, region_caps=None, priorities=None, default_duration=sched.DEFAULT_DURATION,
+                     images_per_builder=1, batch_deploy=False, inventory=None, ledger=None, session=None):
+    # each step is recorded in the run's ledger so a failed run can be resumed
+    ledger = ledger if ledger else ldg.Ledger(suffix)
+    # the account and resource group lookups are shared by every image in the run, and identical lookups in flight are made once
+    session = session if session else az.AzureSession()
+    names = _start(ledger, names)
+
+    images = _validated(ledger, names)
+
+    if len(images) < len(names) and inventory is None:
+        # one snapshot of the gallery is used to validate all the images
+        inventory = await inv.load_async(gallery, session)
+        # and saved so builds can be planned offline
+        inv.save(inventory)
 
     async def _process_image_async(name):
-        image = await img.get_async(name, gallery, common, suffix, ensure_azure=True)
+        with loggers.context(image=name, phase='validate'):
+            image = await img.get_async(name, gallery, common, suffix, ensure_azure=True, inventory=inventory, skip_unchanged=skip_unchanged, session=session)
+            ledger.record(name, 'validated', properties=image)
+            return image
 
-        if image['build']:
-            params_file = az.save_params_file(image, params, BUILDER_PARAMS_FILE)
+    validated = await asyncio.gather(*[_process_image_async(n) for n in names if n not in images])
+    images.update((i['name'], i) for i in validated)
 
-            if not skip_build:
-                await az.deploy_builder_async(image, params_file)
+    # each batch is built by one builder container named after (and deployed with the params file of) its first image
+    builds = {b[0]['name']: b for b in batches([images[n] for n in names if images[n]['build']], images_per_builder)}
 
-        if skip_build:
-            log.warning('Skipping build execution because --skip-build was provided')
+    # builders that failed (or are gone) since the run being resumed deployed them are deployed again
+    if not skip_build:
+        await _check_deployed_async(ledger, list(builds.values()))
 
-    await asyncio.gather(*[_process_image_async(n) for n in names])
+    # the builders of derived images start once the builders of their base layers finish
+    after = dependencies(list(builds.values()))
+    exit_codes = {}
+
+    if batch_deploy:
+        build_levels = levels(list(builds.values()))
+        params_files = [save_batch_params_files(b, params, suffix, level) for level, b in enumerate(build_levels)]
+    else:
+        params_files = {n: _params_file(ledger, b, params) for n, b in builds.items()}
+
+    if skip_build:
+        log.info(f'az session stats: {session.stats()}')
+        log.warning('Skipping build execution because --skip-build was provided')
+        return
+
+    if batch_deploy:
+
+        async def _deploy_builders_async(sub, sub_builds, level):
+            if all(_deployed(ledger, b) for b in sub_builds):
+                log.info(f'Skipping deployment of the builders in subscription {sub} deployed by run {ledger.run}')
+                return
+            await az.deploy_builders_async(sub_builds, params_files[level][sub], _deployment_name(suffix, level), session)
+            for batch in sub_builds:
+                _record_deployed(ledger, batch)
+
+        # every builder in a subscription (and level) is deployed at once, so there's nothing to schedule
+        skipped = []
+        with loggers.context(phase='deploy'):
+            for level, level_builds in enumerate(build_levels):
+                waits = sorted({n for b in level_builds for n in after[b[0]['name']] if n not in exit_codes})
+                for name, exit_code in zip(waits, await asyncio.gather(*[_wait_async(ledger, builds[n]) for n in waits])):
+                    exit_codes[name] = exit_code
+                ready = [b for b in level_builds if not _failed_bases(b, after, exit_codes)]
+                for batch in level_builds:
+                    if batch not in ready:
+                        # and the builders of images derived from its images are skipped too
+                        exit_codes[batch[0]['name']] = None
+                        skipped += [i['name'] for i in batch]
+                await asyncio.gather(*[_deploy_builders_async(sub, b, level) for sub, b in by_subscription(ready).items()])
+        log.info(f'az call stats: {az.throttle_stats()} config directories: {az.config_stats()} session: {session.stats()}')
+        if skipped:
+            error_exit(f'{len(skipped)} {"image" if len(skipped) == 1 else "images"} were not built because their base layers failed to build: {skipped}')
+        return
+
+    # builders publish image versions to their build region only, and are replicated here once they finish
+    replicate = params.get('replication', None) == 'deferred'
+    replications = []
+
+    # only wait for builders to finish when there are limits on how many can run at once (or to replicate their
+    # images, or to start the builders of images derived from them)
+    wait = bool(max_builders or region_caps or replicate or any(after.values()))
+    priorities = priorities if priorities else {}
+
+    async def _build_image_async(job):
+        batch = builds[job['name']]
+        image = batch[0]
+        start = time.monotonic()
+
+        finished = _finished(ledger, batch)
+        if finished and finished['exitCode'] == 0:
+            log.info(f'Skipping {image["name"]} because its builder finished in run {ledger.run}')
+            if replicate and not _replicated(ledger, batch):
+                replications.append(asyncio.create_task(_replicate_async(ledger, batch)))
+            exit_codes[image['name']] = 0
+            return 0
+
+        if _failed_bases(batch, after, exit_codes):
+            return None
+
+        with loggers.context(image=image['name'], phase='deploy'):
+            # a builder deployed by a previous attempt is still running (or finished), so it's only waited for
+            if _deployed(ledger, batch) and finished is None:
+                log.info(f'Skipping deployment of the {image["name"]} builder deployed by run {ledger.run}')
+            else:
+                await az.deploy_builder_async(image, params_files[image['name']])
+                _record_deployed(ledger, batch)
+
+            if wait:
+                with tracing.span('wait builder', images=[i['name'] for i in batch]):
+                    exit_code = await az.wait_for_builder_async(image)
+                    tracing.annotate(exit_code=exit_code)
+                ledger.record(image['name'], 'finished', exitCode=exit_code)
+                exit_codes[image['name']] = exit_code
+                # replication doesn't hold the builder's slot, the next builder can start while it runs
+                if replicate and exit_code == 0:
+                    replications.append(asyncio.create_task(_replicate_async(ledger, batch)))
+                # a batch's duration isn't the duration of any one of its images
+                if len(builds[job['name']]) == 1:
+                    sched.record_duration(image['name'], (time.monotonic() - start) / 60)
+                return exit_code
+
+    parallelism = params.get('parallelism', None) or images_per_builder
+
+    # builders deployed to a build resource group run in its region, which is only looked up when regions are capped
+    regions = {}
+    if region_caps:
+        locations = await asyncio.gather(*[az.builder_location_async(b[0], session) for b in builds.values()])
+        regions = dict(zip(builds, locations))
+
+    def _job(batch):
+        durations = [sched.expected_duration(i['name'], default=default_duration) for i in batch]
+        # the images in a batch build parallelism at a time
+        duration = max(max(durations), sum(durations) / max(1, min(parallelism, len(batch))))
+        return sched.job(batch[0]['name'], regions.get(batch[0]['name'], batch[0].get('location', None)), max(priorities.get(i['name'], 0) for i in batch),
+                         duration, after=after[batch[0]['name']])
+
+    jobs = [_job(b) for b in builds.values()]
+
+    results = await sched.run(jobs, _build_image_async, max_builders, region_caps)
+
+    replicated = {}
+    if replications:
+        with loggers.context(phase='replicate'):
+            for r in await asyncio.gather(*replications):
+                replicated.update(r)
+
+        log.info('Replication report:')
+        for line in rep.report_lines(replicated):
+            log.info(line)
+
+    log.info(f'az call stats: {az.throttle_stats()} config directories: {az.config_stats()} session: {session.stats()}')
+
+    if wait:
+        failed = [i['name'] for name, exit_code in results.items() if exit_code != 0 for i in builds[name]]
+        if failed:
+            error_exit(f'{len(failed)} {"image" if len(failed) == 1 else "images"} failed to build: {failed}')
+
+        failed = rep.failed(replicated)
+        if failed:
+            error_exit(f'{len(failed)} {"image" if len(failed) == 1 else "images"} failed to replicate: {failed}')
 
 
 if __name__ == '__main__':
 
+    tracing.enable()
+
     parser = argparse.ArgumentParser(description='Build custom images for Microsoft Dev Box using Packer then pubish them to an Azure Compute Gallery.'
                                      'This script asumes the presence of a gallery.yaml file in the root of the repository and image.yaml files in each subdirectory of the /images directory',
                                      epilog='example: python3 aci.py --suffix 22 --build')
@@ -75,6 +506,20 @@ if __name__ == '__main__':
     parser.add_argument('--changes', '-c', nargs='*', help='paths of the files that changed to determine which images to build. if not specified all images will be built')
     parser.add_argument('--suffix', '-s', help='suffix to append to the resource group name. if not specified, the current time will be used')
     parser.add_argument('--skip-build', action='store_true', help='skip building images with packer')
+    parser.add_argument('--rebuild-unchanged', action='store_true', help='build new image versions even if their content is unchanged from a published version')
+    parser.add_argument('--max-builders', '-m', type=int, help='maximum number of builder containers to run at once (requires --async). builds are started longest expected duration first')
+    parser.add_argument('--region-cap', nargs='*', help='maximum number of builder containers to run at once in a region in the form region=count (requires --async)')
+    parser.add_argument('--priority', nargs='*', help='scheduling priority for images in the form name=priority. higher priority images start first (requires --async)')
+    parser.add_argument('--images-per-builder', type=int, default=1, help='maximum number of images built by each builder container. images are only grouped with images that deploy their builder to the same resource group or location')
+    parser.add_argument('--builder-parallelism', type=int, help='maximum number of images a builder container builds at once (requires --images-per-builder)')
+    parser.add_argument('--batch-deploy', action='store_true', help='deploy every builder container with a single deployment (per subscription) instead of one deployment per builder. can\'t be used with --max-builders or --region-cap')
+    parser.add_argument('--defer-replication', action='store_true', help='publish image versions to the build region only, then replicate them to their replicaLocations after each builder finishes (requires --async). can\'t be used with --batch-deploy')
+    parser.add_argument('--default-duration', type=int, default=sched.DEFAULT_DURATION, help='expected build duration in minutes for images without build history')
+    parser.add_argument('--plan', nargs='?', const='', metavar='PATH', help='write a plan of the images that would be built (and why) to PATH (default: the storage directory) using a snapshot of the gallery instead of azure, then exit without building')
+    parser.add_argument('--apply', metavar='PATH', help='build the images in the plan at PATH, after checking the gallery hasn\'t changed since the plan was created')
+    parser.add_argument('--snapshot', metavar='PATH', help='path of the gallery snapshot used by --plan. if not specified the snapshot saved by the last build (or --refresh-snapshot) is used')
+    parser.add_argument('--resume', metavar='RUN', help='resume the run (the suffix of the run) recorded in its ledger, skipping the steps it completed')
+    parser.add_argument('--refresh-snapshot', action='store_true', help='take a new snapshot of the gallery (listing its image definitions and versions) before planning')
 
     parser.add_argument('--subnet-id', '-sni', help='The resource id of a subnet to use for the container instance. If this is not specified, the container instance will not be created in a virtual network and have a public ip address.')
     parser.add_argument('--storage-account', '-sa', help='The name of an existing storage account to use with the container instance. If not specified, the container instance will not mount a persistant file share.')
@@ -87,6 +532,18 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.batch_deploy and (args.max_builders or args.region_cap):
+        parser.error('--batch-deploy starts every builder at once so it can\'t be used with --max-builders or --region-cap')
+
+    if args.defer_replication and (not args.is_async or args.batch_deploy):
+        parser.error('--defer-replication waits for each builder to finish so it requires --async and can\'t be used with --batch-deploy')
+
+    if args.apply and (args.plan is not None or args.images or args.changes):
+        parser.error('--apply builds the images in the plan so it can\'t be used with --plan, --images, or --changes')
+
+    if args.resume and (args.plan is not None or args.apply or args.changes or (args.suffix and args.suffix != args.resume)):
+        parser.error('--resume builds the images of the run with its suffix so it can\'t be used with --plan, --apply, --changes, or --suffix')
+
     # client_id = args.client_id
     # client_secret = args.client_secret
     identity = args.identity
@@ -113,16 +570,124 @@ if __name__ == '__main__':
     if args.storage_account:
         params['storageAccount'] = args.storage_account
 
+    if args.builder_parallelism:
+        params['parallelism'] = args.builder_parallelism
+
+    if args.defer_replication:
+        params['replication'] = 'deferred'
+
+    # the builder containers build the images in their signed manifest without validating them again
+    params['manifestKey'] = mft.KEY if mft.KEY else secrets.token_hex(32)
+
+    # the builder containers add their spans to this build's trace
+    if tracing.TRACE:
+        params['traceId'] = tracing.trace_id
+
     is_async = args.is_async
     skip_build = args.skip_build
+    skip_unchanged = not args.rebuild_unchanged
     names = args.images if args.images else None
 
-    suffix = args.suffix if args.suffix else datetime.now(timezone.utc).strftime('%Y%m%d%H%M')
+    if names is None and args.changes:
+        names = chg.changed_images(args.changes, img.image_names())
+        if not names:
+            log.warning('Skipping build because none of the changed files affect any images')
+            sys.exit(0)
+
+        # the images derived from a changed layer have changed too
+        names = layers.with_dependents(names, layers.bases(img.image_names()))
+
+    # the layers the images are derived from are built (if they've changed) before them
+    if names is not None:
+        names = layers.with_bases(names, layers.bases(names))
+
+    # the suffix identifies the run in the ledger (the temporary resource groups are named with it)
+    suffix = args.resume if args.resume else args.suffix if args.suffix else datetime.now(timezone.utc).strftime('%Y%m%d%H%M')
 
     gallery = img.get_gallery()
     common = img.get_common()
 
-    if is_async:
-        asyncio.run(main_async(gallery, common, names, params, suffix, skip_build))
-    else:
-        main(gallery, common, names, params, suffix, skip_build)
+    log.info(f'Trace id: {tracing.trace_id}')
+
+    # plans never include the token (or the trace id and manifest key, which are different for every run)
+    plan_params = {k: v for k, v in dict(params, repository=repo['url']).items() if k not in ['traceId', 'manifestKey']}
+
+    inventory = None
+
+    if args.plan is not None:
+        if args.refresh_snapshot:
+            # only lists the gallery, nothing is changed
+            inventory = inv.load(gallery)
+            inv.save(inventory, args.snapshot)
+        else:
+            inventory = inv.load_snapshot(gallery, args.snapshot)
+
+        if inventory is None:
+            error_exit(f'No snapshot of gallery {gallery["name"]} was found at {args.snapshot or inv.snapshot_file(gallery)}. Use --refresh-snapshot to take one')
+
+        with tracing.span('plan'):
+            planned = make_plan(gallery, common, names, plan_params, suffix, inventory, skip_unchanged,
+                                args.images_per_builder, args.batch_deploy)
+
+        path = pln.save(planned, args.plan or None)
+
+        log.info(f'Plan (gallery snapshot taken {planned["gallery"]["snapshot"]}):')
+        for line in pln.summary_lines(planned):
+            log.info(line)
+        log.info(f'Saved plan to {path}')
+        sys.exit(0)
+
+    batch_deploy = args.batch_deploy
+    images_per_builder = args.images_per_builder
+
+    if args.apply:
+        planned = pln.load(args.apply)
+
+        names = pln.build_names(planned)
+        suffix = planned['suffix']
+        skip_unchanged = planned['options']['skipUnchanged']
+        images_per_builder = planned['options']['imagesPerBuilder']
+        batch_deploy = planned['options']['batchDeploy']
+        # layers are keyed by the plan's refresh period, even if a new one started since
+        layers.pin(planned['options'].get('layerRefresh', layers.refresh()))
+
+        if batch_deploy and args.defer_replication:
+            error_exit(f'The plan {args.apply} deploys every builder at once so its images can\'t be replicated with --defer-replication')
+
+        if planned['params'] != plan_params:
+            log.warning(f'The builder parameters are different from the plan\'s, the parameters from the command line are used')
+
+        if not names:
+            log.warning(f'Skipping build because the plan {args.apply} doesn\'t build any images')
+            sys.exit(0)
+
+        # the gallery is listed (not changed) to make sure the plan's decisions still hold
+        inventory = inv.load(gallery)
+
+        with tracing.span('verify plan'):
+            stale = pln.differences(planned, [img.plan(n, gallery, common, suffix, inventory, skip_unchanged) for n in names])
+
+        if stale:
+            for line in stale:
+                log.error(line)
+            error_exit(f'The gallery has changed since the plan {args.apply} was created. Please create a new plan')
+
+    # the builder containers build the images they validate themselves the same way
+    if not skip_unchanged:
+        params['rebuildUnchanged'] = True
+
+    # the builder containers key the layers by the same refresh period
+    if layers.refresh():
+        params['layerRefresh'] = layers.refresh()
+
+    ledger = ldg.Ledger(suffix, resume=bool(args.resume))
+
+    log.info(f'Run {suffix}, resume it with --resume {suffix}')
+
+    with tracing.span('build'):
+        if is_async:
+            asyncio.run(main_async(gallery, common, names, params, suffix, skip_build, skip_unchanged, args.max_builders,
+                                   sched.parse_caps(args.region_cap), sched.parse_priorities(args.priority), args.default_duration,
+                                   images_per_builder, batch_deploy, inventory, ledger))
+        else:
+            main(gallery, common, names, params, suffix, skip_build, skip_unchanged, images_per_builder, batch_deploy, inventory, ledger)
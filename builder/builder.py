@@ -3,15 +3,31 @@
 # Licensed under the MIT License.
 # ------------------------------------
 
+import asyncio
+import json
 import os
 import sys
+import time
 from datetime import datetime, timezone
 from pathlib import Path
 
 import azure as az
+import fingerprint as fp
 import image as img
+import inventory as inv
 import loggers
+import manifest as mft
 import packer
+import plugins
+import tracing
+
+# maximum number of images built at once when the builder is given more than one image
+BUILD_PARALLELISM = int(os.environ.get('BUILD_PARALLELISM', '4'))
+
+# build.py --rebuild-unchanged, images the builder validates are built even if their content is unchanged
+REBUILD_UNCHANGED = os.environ.get('BUILDER_REBUILD_UNCHANGED', '').lower() in ['1', 'true', 'yes']
+
+SUMMARY_FILE = 'builder_summary_{timestamp}.json'
 
 # indicates if the script is running in the docker container
 in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
@@ -21,14 +37,8 @@ builder_version = os.environ.get('ACI_IMAGE_BUILDER_VERSION', 'unknown')
 
 log = loggers.getLogger(__name__)
 
-
-log.info(f'ACI_IMAGE_BUILDER: {in_builder}')
-log.info(f'ACI_IMAGE_BUILDER_VERSION: {builder_version}')
-log.debug(f'in_builder: {in_builder}')
-
-
-if not in_builder:
-    log.warning('Running outside of the builder container. This should only be done during testing.')
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
 
 
 def error_exit(message):
@@ -36,32 +46,19 @@ def error_exit(message):
     sys.exit(message)
 
 
-repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
-storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
-
-log.info(f'Repository path: {repo}')
-log.info(f'Storage path: {storage}')
-
-if not os.path.isdir(repo):
-    error_exit(f'Missing volume {repo}')
+def image_names() -> list:
+    '''Returns the names of the images to build from BUILD_IMAGE_NAMES (comma separated) or BUILD_IMAGE_NAME'''
+    names = os.environ.get('BUILD_IMAGE_NAMES', '') or os.environ.get('BUILD_IMAGE_NAME', '')
+    names = [n.strip() for n in names.split(',') if n.strip()]
 
-if not os.path.isdir(storage):
-    log.warning(f'Missing volume {storage}')
+    if not names:
+        error_exit('Missing BUILD_IMAGE_NAMES or BUILD_IMAGE_NAME environment variable')
 
-for env in ['BUILD_IMAGE_NAME']:
-    if not os.environ.get(env, False):
-        error_exit(f'Missing {env} environment variable')
+    return list(dict.fromkeys(names))
 
-image_name = os.environ['BUILD_IMAGE_NAME']
-image_path = repo / 'images' / image_name
 
-log.info(f'Image name: {image_name}')
-log.info(f'Image path: {image_path}')
-
-suffix = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
-log.info(f'Build Suffix: {suffix}')
-
-if in_builder:
+def login():
+    '''Logs in to azure once for all the images (with a service principal if there are credentials, otherwise managed identity)'''
     az_client_id = os.environ.get('AZURE_CLIENT_ID', None)
     az_client_secret = os.environ.get('AZURE_CLIENT_SECRET', None)
     az_tenant_id = os.environ.get('AZURE_TENANT_ID', None)
@@ -75,18 +72,175 @@ if in_builder:
         log.info(f'Logging in to Azure with managed identity')
         az.cli('az login --identity --allow-no-subscriptions')
 
-gallery = img.get_gallery()
-common = img.get_common()
 
-image = img.get(image_name, gallery, common, suffix, ensure_azure=True)
+def summary_lines(results) -> list:
+    '''Returns the lines of a table with each image's status, exit code, and duration'''
+    width = max([len('image')] + [len(r['name']) for r in results])
+    lines = [f'{"image":<{width}}  {"status":<8}  {"exit code":>9}  {"minutes":>7}']
+    for r in results:
+        exit_code = '' if r['exitCode'] is None else r['exitCode']
+        lines.append(f'{r["name"]:<{width}}  {r["status"]:<8}  {exit_code:>9}  {r["minutes"]:>7.1f}')
+    return lines
+
+
+# ----------------
+# async functions
+# ----------------
+
+
+async def build_image_async(name, gallery, common, suffix, inventory, limit, skip_build=False, log_file=None, resolved=None, session=None,
+                            results=None, skip_unchanged=True) -> dict:
+    '''Validates and builds an image, returns its result. Images resolved from the build manifest aren't validated
+    again. Images derived from a layer in results (futures of the results of the builder's other images) are built
+    once the layer is. Failures are recorded in the result instead of raised so one image's failure doesn't stop the others'''
+    result = {'name': name, 'status': 'skipped', 'exitCode': None, 'minutes': 0.0, 'log': None}
+    start = time.monotonic()
+
+    handler = None
+    if log_file:
+        handler = loggers.add_file(log_file, image=name)
+        result['log'] = str(log_file)
+
+    with loggers.context(image=name), tracing.span('builder image') as span:
+        try:
+            image = resolved if resolved else await img.get_async(name, gallery, common, suffix, ensure_azure=True, inventory=inventory,
+                                                                  skip_unchanged=skip_unchanged, session=session)
+
+            base = image.get('base', None)
+            if image['build'] and results and base in results:
+                # waiting for the layer doesn't take one of the slots for the images built at once
+                log.info(f'Waiting for base layer {base} to be built')
+                if (await results[base])['exitCode']:
+                    error_exit(f'{name} was not built because its base layer {base} failed to build')
+
+            if image['build']:
+                async with limit:
+                    await packer.save_vars_file_async(image)
+                    result['status'] = 'validated'
+
+                    if not skip_build:
+                        result['exitCode'] = await packer.execute_async(image)
+                        result['status'] = 'built' if result['exitCode'] == 0 else 'failed'
+
+                if result['exitCode'] == 0:
+                    log.info(f'Tagging {image["name"]} version {image["version"]} with fingerprint {image["fingerprint"]}')
+                    await az.tag_image_version_async(image, fp.FINGERPRINT_TAG, image['fingerprint'])
+                    fp.record(image)
+
+        except (Exception, SystemExit) as e:  # error_exit raises SystemExit
+            log.error(f'Failed to build {name}: {e}')
+            result['status'] = 'error'
+            result['exitCode'] = result['exitCode'] or 1
+            result['error'] = str(e)
+
+        span.update(status=result['status'], exit_code=result['exitCode'])
+
+    result['minutes'] = (time.monotonic() - start) / 60
+
+    if handler:
+        loggers.remove_handler(handler)
+
+    return result
 
-skip_build = not in_builder
 
-if image['build']:
-    packer.save_vars_file(image)
+async def main_async(names, gallery, common, suffix, skip_build=False, parallelism=BUILD_PARALLELISM, manifest=None, skip_unchanged=True) -> list:
+    '''Builds the images (at most parallelism at once), layers before the images derived from them, and returns their
+    results in the order of the names. Images in the build manifest are built with the properties build.py resolved,
+    the others are validated'''
+    resolved = mft.images(manifest, names, suffix) if manifest else {}
+
+    # the account lookup is shared by every image the builder validates
+    session = az.AzureSession()
+
+    inventory = None
+    if len(resolved) < len(names):
+        gallery = gallery if gallery else img.get_gallery()
+        common = common if common else img.get_common()
+        # one snapshot of the gallery is used to validate all the images
+        inventory = await inv.load_async(gallery, session)
+
+    limit = asyncio.Semaphore(max(1, parallelism))
+
+    # each image gets its own log file when there's more than one, the main log file has them all
+    log_files = {n: storage / f'log_{loggers.timestamp}_{n}.txt' if len(names) > 1 and storage.is_dir() else None for n in names}
+
+    # images derived from a layer the builder also builds wait for the layer's result
+    loop = asyncio.get_running_loop()
+    futures = {n: loop.create_future() for n in names}
+
+    async def _build_async(name):
+        result = await build_image_async(name, gallery, common, suffix, inventory, limit, skip_build, log_files[name], resolved.get(name, None), session, futures,
+                                         skip_unchanged)
+        futures[name].set_result(result)
+        return result
+
+    results = await asyncio.gather(*[_build_async(n) for n in names])
+
+    log.info(f'az session stats: {session.stats()}')
+
+    return results
+
+
+if __name__ == '__main__':
+
+    tracing.enable()
+
+    log.info(f'ACI_IMAGE_BUILDER: {in_builder}')
+    log.info(f'ACI_IMAGE_BUILDER_VERSION: {builder_version}')
+    log.debug(f'in_builder: {in_builder}')
+
+    if not in_builder:
+        log.warning('Running outside of the builder container. This should only be done during testing.')
+
+    log.info(f'Repository path: {repo}')
+    log.info(f'Storage path: {storage}')
+
+    if not os.path.isdir(repo):
+        error_exit(f'Missing volume {repo}')
+
+    if not os.path.isdir(storage):
+        log.warning(f'Missing volume {storage}')
+
+    names = image_names()
+
+    log.info(f'Image names: {", ".join(names)}')
+    log.info(f'Build parallelism: {min(BUILD_PARALLELISM, len(names))}')
+
+    suffix = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+    log.info(f'Build Suffix: {suffix}')
+
+    log.info(f'Trace id: {tracing.trace_id}')
+
+    if in_builder:
+        with tracing.span('login'):
+            login()
+
+    # the properties build.py resolved, so the images don't have to be validated again
+    manifest = mft.from_env()
+
+    # the gallery and common properties are only read if some images aren't in the manifest
+    gallery = None if manifest else img.get_gallery()
+    common = None if manifest else img.get_common()
+
+    skip_build = not in_builder
+
+    with tracing.span('builder', images=names):
+        results = asyncio.run(main_async(names, gallery, common, suffix, skip_build, manifest=manifest, skip_unchanged=not REBUILD_UNCHANGED))
 
     if not skip_build:
-        packer.execute(image)
+        log.info(f'Packer plugin cache hits: {plugins.stats["hits"]} misses: {plugins.stats["misses"]}')
+
+    log.info('Build summary:')
+    for line in summary_lines(results):
+        log.info(line)
+
+    if storage.is_dir():
+        with open(storage / SUMMARY_FILE.format(timestamp=loggers.timestamp), 'w') as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+
+    if skip_build:
+        log.warning('Skipping build execution because --skip-build was provided')
 
-if skip_build:
-    log.warning('Skipping build execution because --skip-build was provided')
+    failed = [r['name'] for r in results if r['exitCode']]
+    if failed:
+        error_exit(f'{len(failed)} of {len(results)} {"image" if len(results) == 1 else "images"} failed to build: {failed}')
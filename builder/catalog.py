@@ -0,0 +1,187 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import json
+import os
+from pathlib import Path
+
+import loggers
+import syaml
+
+CATALOG_INDEX_FILE = 'catalog.json'
+
+IMAGE_FILES = ['image.yaml', 'image.yml']
+
+# set to keep an index of the images directory in the storage directory, only directories whose mtime changed are re-scanned
+INDEX = os.environ.get('BUILDER_CATALOG_INDEX', '').lower() in ['1', 'true', 'yes']
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+
+images_root = repo / 'images'
+index_file = storage / CATALOG_INDEX_FILE
+
+
+def _image_file(image_dir) -> str:
+    '''Returns the path to the image.yaml or image.yml file in an image directory, or None'''
+    found = [f for f in IMAGE_FILES if os.path.isfile(os.path.join(image_dir, f))]
+    if len(found) > 1:
+        syaml.error_exit(f'Found both image.yaml and image.yml in {image_dir} of repository. only one image yaml file allowed')
+    return os.path.join(image_dir, found[0]) if found else None
+
+
+def _scan(root, previous=None) -> dict:
+    '''Scans the first level of the images directory and returns a dict of directory name -> {mtime, file},
+    reusing entries from a previous scan for directories with the same mtime'''
+    previous = previous if previous else {}
+    entries = {}
+    with os.scandir(root) as it:
+        for entry in it:
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            mtime = entry.stat().st_mtime_ns
+            cached = previous.get(entry.name, None)
+            if cached and cached['mtime'] == mtime:
+                entries[entry.name] = cached
+            else:
+                entries[entry.name] = {'mtime': mtime, 'file': _image_file(entry.path)}
+    return entries
+
+
+def _load_index(root) -> dict:
+    if not index_file.is_file():
+        return {}
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except (json.decoder.JSONDecodeError, OSError):
+        log.warning(f'Ignoring unreadable catalog index {index_file}')
+        return {}
+    return index.get(str(root), {})
+
+
+def _save_index(root, root_mtime, entries):
+    index = {}
+    if index_file.is_file():
+        try:
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+        except (json.decoder.JSONDecodeError, OSError):
+            index = {}
+    index[str(root)] = {'mtime': root_mtime, 'images': entries}
+
+    storage.mkdir(parents=True, exist_ok=True)
+    temp = index_file.with_suffix(f'.{os.getpid()}.tmp')
+    with open(temp, 'w') as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+    os.replace(temp, index_file)
+
+
+def scan(root=None, index=None) -> dict:
+    '''Returns a dict of image name -> path to the image's yaml file for every directory in the first level of
+    the images directory that has an image.yaml or image.yml file. If index is True (defaults to the
+    BUILDER_CATALOG_INDEX environment variable) the scan is saved to and reused from the catalog index file'''
+    root = Path(root) if root else images_root
+    index = INDEX if index is None else index
+
+    if not root.is_dir():
+        syaml.error_exit(f'Images directory not found at {root}')
+
+    previous = {}
+    if index:
+        cached = _load_index(root)
+        root_mtime = root.stat().st_mtime_ns
+        # directories were added or removed from the images directory if its mtime changed, the
+        # entries for the rest are still valid if their own mtime hasn't changed (checked in _scan)
+        previous = cached.get('images', {}) if cached.get('mtime', None) == root_mtime else {}
+
+    entries = _scan(root, previous)
+
+    if index and entries != previous:
+        _save_index(root, root_mtime, entries)
+
+    return {name: Path(entry['file']) for name, entry in sorted(entries.items()) if entry['file']}
+
+
+def image_names(root=None, index=None) -> list:
+    '''Returns the names of the images in the images directory'''
+    return list(scan(root, index).keys())
+
+
+def load(name, root=None, index=None) -> dict:
+    '''Parses and returns the properties in an image's yaml file, images are only parsed when they're loaded'''
+    catalog = scan(root, index)
+    if name not in catalog:
+        syaml.error_exit(f'Image {name} not found in {Path(root) if root else images_root}')
+    return syaml.parse(catalog[name])
+
+
+if __name__ == '__main__':
+
+    import shutil
+    import tempfile
+    import time
+
+    temp = Path(tempfile.mkdtemp(prefix='catalog'))
+    root = temp / 'images'
+    index_file = temp / CATALOG_INDEX_FILE
+    storage = temp
+
+    try:
+        # 200 images, each with a deep tree of files that a recursive walk would visit
+        for i in range(200):
+            image_dir = root / f'Image{i}'
+            (image_dir / 'installers' / 'a' / 'b' / 'c').mkdir(parents=True)
+            (image_dir / 'image.yml').write_text(f'version: 1.0.{i}\n')
+            for j in range(50):
+                (image_dir / 'installers' / 'a' / 'b' / 'c' / f'file{j}.bin').write_bytes(b'')
+        (root / 'NotAnImage').mkdir()
+        (root / 'images.yml').write_text('publisher: Contoso\n')
+
+        def _walk_names():  # the previous implementation of image.image_names
+            names = []
+            for dirpath, dirnames, files in os.walk(root):
+                if not root.samefile(dirpath) and Path(dirpath).parent.samefile(root):
+                    names.append(Path(dirpath).name)
+            return names
+
+        def _time(fn):
+            start = time.perf_counter()
+            fn()
+            return (time.perf_counter() - start) * 1000
+
+        walk = _time(_walk_names)
+        scanned = _time(lambda: scan(root, index=False))
+        _time(lambda: scan(root, index=True))
+        indexed = _time(lambda: scan(root, index=True))
+
+        print('')
+        print(f'os.walk:     {walk:8.2f}ms')
+        print(f'scan:        {scanned:8.2f}ms')
+        print(f'scan (index): {indexed:7.2f}ms')
+        print('')
+
+        names = image_names(root, index=False)
+        if len(names) != 200 or 'NotAnImage' in names:
+            raise ValueError(f'unexpected image names: {names}')
+        if image_names(root, index=True) != names:
+            raise ValueError('indexed scan does not match the scan')
+        if load('Image7', root)['version'] != '1.0.7':
+            raise ValueError('unexpected image properties for Image7')
+
+        # adding an image changes the images directory mtime, adding an image file changes the image directory mtime
+        (root / 'NewImage').mkdir()
+        (root / 'NewImage' / 'image.yaml').write_text('version: 2.0.0\n')
+        (root / 'NotAnImage' / 'image.yml').write_text('version: 3.0.0\n')
+        names = image_names(root, index=True)
+        if 'NewImage' not in names or 'NotAnImage' not in names:
+            raise ValueError(f'index was not invalidated: {names}')
+    finally:
+        shutil.rmtree(temp)
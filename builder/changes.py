@@ -0,0 +1,170 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import os
+import posixpath
+import re
+from pathlib import Path
+
+import loggers
+
+# matches files packer templates reference relative to the template (ex. "${path.root}/../../scripts/Install-Git.ps1")
+PATH_ROOT_PATTERN = re.compile(r'\$\{path\.root\}/([^"\'\s,\]\}]+)')
+
+# files that affect every image
+SHARED_FILES = ['gallery.yml', 'gallery.yaml', 'images/images.yml', 'images/images.yaml']
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+
+
+def _normalize(path, root=repo) -> str:
+    '''Returns a path as a posix path relative to the root of the repository'''
+    path = str(path).replace('\\', '/')
+    if os.path.isabs(path):
+        path = os.path.relpath(path, root).replace('\\', '/')
+    path = posixpath.normpath(path)
+    return path[2:] if path.startswith('./') else path
+
+
+def dependencies(image_name, root=repo) -> set:
+    '''Returns the paths (relative to the root of the repository) of the files outside of the image's
+    directory that are referenced by the image's packer templates'''
+    image_dir = Path(root) / 'images' / image_name
+    deps = set()
+
+    for template in image_dir.glob('*.pkr.hcl'):
+        with open(template, 'r') as f:
+            content = f.read()
+
+        for match in PATH_ROOT_PATTERN.findall(content):
+            path = posixpath.normpath(posixpath.join('images', image_name, match))
+            if not path.startswith(f'images/{image_name}/'):
+                deps.add(path)
+
+    return deps
+
+
+def index(names, root=repo) -> dict:
+    '''Builds a reverse index of file path -> names of the images that depend on it'''
+    files = {}
+
+    for name in names:
+        for path in dependencies(name, root):
+            files.setdefault(path, set()).add(name)
+
+    return {
+        'images': set(names),
+        'files': files
+    }
+
+
+def resolve(changes, idx, root=repo) -> list:
+    '''Resolves a list of changed file paths to the names of the images that need to be built'''
+    images = idx['images']
+    files = idx['files']
+    names = set()
+
+    for change in changes:
+        path = _normalize(change, root)
+
+        if path in SHARED_FILES:
+            return sorted(images)
+
+        if path in files:
+            names.update(files[path])
+
+        elif path.startswith('images/'):
+            parts = path.split('/')
+            if len(parts) > 2 and parts[1] in images:
+                names.add(parts[1])
+
+        if len(names) == len(images):
+            break
+
+    return sorted(names)
+
+
+def changed_images(changes, names, root=repo) -> list:
+    '''Returns the names of the images that need to be built because of the changed file paths'''
+    images = resolve(changes, index(names, root), root)
+
+    log.info(f'{len(changes)} changed {"file affects" if len(changes) == 1 else "files affect"} {len(images)} {"image" if len(images) == 1 else "images"}: {images}')
+
+    return images
+
+
+if __name__ == '__main__':
+
+    import shutil
+    import tempfile
+    import time
+
+    def _corpus(root, image_count, script_count):
+        '''Creates a repository with image_count images that each reference a slice of script_count scripts'''
+        (root / 'scripts').mkdir(parents=True)
+        for s in range(script_count):
+            (root / 'scripts' / f'Script{s}.ps1').touch()
+        for i in range(image_count):
+            image_dir = root / 'images' / f'Image{i}'
+            image_dir.mkdir(parents=True)
+            scripts = ',\n'.join(f'      "${{path.root}}/../../scripts/Script{s}.ps1"' for s in range(i % script_count, script_count, 7))
+            with open(image_dir / 'build.pkr.hcl', 'w') as f:
+                f.write(f'build {{\n  provisioner "powershell" {{\n    scripts = [\n{scripts}\n    ]\n  }}\n}}\n')
+        return [f'Image{i}' for i in range(image_count)]
+
+    root = Path(tempfile.mkdtemp())
+
+    try:
+        names = _corpus(root, 10, 20)
+        idx = index(names, root)
+
+        tests = [
+            ([], []),
+            (['README.md'], []),
+            (['builder/build.py'], []),
+            (['images/Image3/build.pkr.hcl'], ['Image3']),
+            (['./images/Image3/variable.pkr.hcl', 'images/Image4/image.yml'], ['Image3', 'Image4']),
+            ([str(root / 'images' / 'Image5' / 'README.md')], ['Image5']),
+            (['images/Unknown/image.yml'], []),
+            (['images/README.md'], []),
+            (['scripts/Script0.ps1'], ['Image0']),
+            (['scripts/Script7.ps1'], ['Image0', 'Image7']),
+            (['scripts\\Script8.ps1'], ['Image1', 'Image8']),
+            (['scripts/Unused.ps1'], []),
+            (['images/images.yml'], names),
+            (['gallery.yml', 'README.md'], names),
+        ]
+
+        for changes, expected in tests:
+            actual = resolve(changes, idx, root)
+            if actual != sorted(expected):
+                raise ValueError(f'{changes} resolved to {actual}, expected {sorted(expected)}')
+            print(f'{changes} -> {actual}')
+
+        shutil.rmtree(root)
+        root = Path(tempfile.mkdtemp())
+
+        names = _corpus(root, 500, 200)
+
+        start = time.perf_counter()
+        idx = index(names, root)
+        indexed = time.perf_counter()
+
+        changes = [f'scripts/Script{s}.ps1' for s in range(0, 200, 50)] + [f'images/Image{i}/notes/{n}.txt' for i in range(0, 500, 100) for n in range(500)]
+        images = resolve(changes, idx, root)
+        resolved = time.perf_counter()
+
+        print('')
+        print(f'indexed {len(names)} images in {(indexed - start) * 1000:.1f}ms')
+        print(f'resolved {len(changes)} changed paths to {len(images)} images in {(resolved - indexed) * 1000:.1f}ms')
+        print('')
+
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,160 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import atexit
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import changes as chg
+import loggers
+
+FINGERPRINT_TAG = 'buildFingerprint'
+FINGERPRINT_CACHE_FILE = 'fingerprints.json'
+
+# image properties that don't change the content of the image: where it's built and published (moving the build
+# resource group or network, or adding a replica region, doesn't rebuild unchanged images) and its identity
+# (a derived image's baseFingerprint covers its base layer)
+FINGERPRINT_EXCLUDED_PROPERTIES = ['name', 'path', 'version', 'build', 'location', 'tempResourceGroup',
+                                   'buildResourceGroup', 'keyVault', 'virtualNetwork', 'virtualNetworkSubnet',
+                                   'virtualNetworkResourceGroup', 'replicaLocations', 'subscription', 'gallery',
+                                   'fingerprint', 'baseVersion', 'baseImage']
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+
+cache_file = storage / FINGERPRINT_CACHE_FILE
+
+_cache = None
+
+# set when a file hash is added to the cache, the cache is saved once when the process exits
+_dirty = False
+
+
+def _load_cache() -> dict:
+    global _cache
+    if _cache is None:
+        _cache = {'files': {}, 'images': {}}
+        if cache_file.is_file():
+            try:
+                with open(cache_file, 'r') as f:
+                    _cache.update(json.load(f))
+            except (json.decoder.JSONDecodeError, OSError):
+                log.warning(f'Ignoring unreadable fingerprint cache {cache_file}')
+    return _cache
+
+
+def _save_cache():
+    global _dirty
+    if _cache is None or (in_builder and not storage.is_dir()):
+        return
+    _dirty = False
+    storage.mkdir(parents=True, exist_ok=True)
+    temp = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+    with open(temp, 'w') as f:
+        json.dump(_cache, f, indent=4, sort_keys=True)
+    os.replace(temp, cache_file)
+
+
+def _file_hash(path) -> str:
+    '''Returns the sha256 of a file, reusing the cached hash if the file's mtime and size haven't changed'''
+    global _dirty
+    cache = _load_cache()['files']
+    stat = os.stat(path)
+    key = str(path)
+
+    cached = cache.get(key, None)
+    if cached and cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+        return cached['sha256']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+
+    cache[key] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha.hexdigest()}
+    _dirty = True
+    return cache[key]['sha256']
+
+
+def files(image, root=repo) -> list:
+    '''Returns the paths (relative to the root of the repository) of the files that make up the image'''
+    image_dir = Path(image['path'])
+    templates = [f'images/{image["name"]}/{t.name}' for t in image_dir.glob('*.pkr.hcl')]
+    scripts = [d for d in chg.dependencies(image['name'], root) if (Path(root) / d).is_file()]
+    return sorted(templates + scripts)
+
+
+def compute(image, root=repo) -> str:
+    '''Returns a hash over the image's properties, packer templates, and the scripts they reference'''
+    properties = {k: v for k, v in image.items() if k not in FINGERPRINT_EXCLUDED_PROPERTIES}
+
+    sha = hashlib.sha256()
+    sha.update(json.dumps(properties, sort_keys=True).encode())
+
+    for path in files(image, root):
+        sha.update(path.encode())
+        sha.update(_file_hash(Path(root) / path).encode())
+
+    return sha.hexdigest()
+
+
+def published(image, versions):
+    '''Returns the fingerprint tagged on the image's version and the name of a different published version
+    with the same fingerprint as the image (or None) from the list of the image definition's versions'''
+    fingerprint = image['fingerprint']
+    version_fingerprint = None
+    same_as = None
+
+    for version in versions:
+        tags = version.get('tags', None) or {}
+        if version['name'] == image['version']:
+            version_fingerprint = tags.get(FINGERPRINT_TAG, None)
+        elif tags.get(FINGERPRINT_TAG, None) == fingerprint:
+            same_as = version['name']
+
+    return version_fingerprint, same_as
+
+
+def check(image, versions, skip_unchanged=True) -> bool:
+    '''Returns True if the image should still be built after comparing its fingerprint to the published versions'''
+    version_fingerprint, same_as = published(image, versions)
+
+    if version_fingerprint == image['fingerprint']:
+        record(image)
+
+    if not image['build']:
+        if version_fingerprint and version_fingerprint != image['fingerprint']:
+            log.warning(f'{image["name"]} version {image["version"]} was already published but its content has changed since. Please update the version number to build the changes.')
+        return False
+
+    if same_as:
+        if skip_unchanged:
+            log.warning(f'{image["name"]} was not built because its content is unchanged from published version {same_as}.')
+            return False
+        log.warning(f'{image["name"]} content is unchanged from published version {same_as}, building version {image["version"]} anyway.')
+
+    return True
+
+
+def record(image):
+    '''Saves the fingerprint of a published image version in the local fingerprint cache'''
+    cache = _load_cache()
+    cache['images'].setdefault(image['name'], {})[image['version']] = image['fingerprint']
+    _save_cache()
+
+
+def _finish():
+    if _dirty:
+        _save_cache()
+
+
+atexit.register(_finish)
@@ -0,0 +1,437 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import hashlib
+import re
+from functools import lru_cache
+from pathlib import Path
+
+import loggers
+
+PRIMITIVE_TYPES = ['string', 'number', 'bool', 'any']
+COLLECTION_TYPES = ['list', 'set', 'map']
+
+TOKEN_PATTERN = re.compile(r'''
+    (?P<comment>\#[^\n]*|//[^\n]*|/\*.*?\*/)
+   |(?P<heredoc><<-?(?P<tag>\w+)\n.*?\n[ \t]*(?P=tag)(?=\n|$))
+   |(?P<string>"(?:[^"\\\n]|\\.)*")
+   |(?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+   |(?P<ident>[A-Za-z_][\w-]*)
+   |(?P<newline>\n)
+   |(?P<space>[ \t\r]+)
+   |(?P<punct>.)
+''', re.DOTALL | re.VERBOSE)
+
+OPEN = {'{': '}', '[': ']', '(': ')'}
+
+log = loggers.getLogger(__name__)
+
+# parsed variables and required plugins keyed by the sha256 of the file's contents
+_cache = {}
+
+
+class HclError(Exception):
+    '''Raised when a pkr.hcl file can't be parsed'''
+
+
+def _tokenize(text) -> list:
+    '''Returns (kind, value, start, end) tokens, dropping comments and whitespace (but not newlines)'''
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == 'comment' and '\n' in match.group():  # multi-line comments still end the line
+            kind = 'newline'
+        elif kind in ['comment', 'space']:
+            continue
+        tokens.append((kind, match.group(kind), match.start(), match.end()))
+    return tokens
+
+
+def _skip_group(tokens, i) -> int:
+    '''Returns the index after the bracket that closes the one at i'''
+    stack = [OPEN[tokens[i][1]]]
+    i += 1
+    while stack:
+        if i >= len(tokens):
+            raise HclError(f'unclosed {stack[-1]}')
+        value = tokens[i][1] if tokens[i][0] == 'punct' else None
+        if value in OPEN:
+            stack.append(OPEN[value])
+        elif value == stack[-1]:
+            stack.pop()
+        i += 1
+    return i
+
+
+def _expression(tokens, i) -> tuple:
+    '''Returns the tokens of the expression starting at i (up to the end of the line outside of any brackets)
+    and the index after it'''
+    start = i
+    while i < len(tokens) and tokens[i][0] != 'newline' and tokens[i][1] != '}':
+        i = _skip_group(tokens, i) if tokens[i][0] == 'punct' and tokens[i][1] in OPEN else i + 1
+    return tokens[start:i], i
+
+
+def _variable(tokens, i, text) -> tuple:
+    '''Parses the body of a variable block starting after its '{', returns the variable and the index after the '}' '''
+    variable = {'type': 'any', 'default': None, 'required': True}
+    while i < len(tokens):
+        kind, value = tokens[i][0], tokens[i][1]
+        if kind == 'newline':
+            i += 1
+        elif value == '}':
+            return variable, i + 1
+        elif kind == 'ident' and i + 1 < len(tokens) and tokens[i + 1][1] == '=':
+            expression, i = _expression(tokens, i + 2)
+            if not expression:
+                raise HclError(f'missing value for {value}')
+            if value == 'type':
+                variable['type'] = ' '.join(text[expression[0][2]:expression[-1][3]].split())
+            elif value == 'default':
+                variable['default'], _ = _literal(expression, 0, text)
+                variable['required'] = False
+            elif value == 'description':
+                variable['description'], _ = _literal(expression, 0, text)
+        elif kind == 'ident':  # nested block (i.e. validation)
+            while i < len(tokens) and tokens[i][1] != '{':
+                i += 1
+            i = _skip_group(tokens, i)
+        else:
+            raise HclError(f'unexpected {value} in variable block')
+    raise HclError('unclosed variable block')
+
+
+def _string(value) -> str:
+    return value[1:-1].encode('latin-1', 'backslashreplace').decode('unicode_escape')
+
+
+def _literal(tokens, i, text) -> tuple:
+    '''Returns the python value of the literal expression (string, number, bool, null, tuple, or object) at i
+    and the index after it. Expressions that aren't literals (i.e. function calls or references) are returned as text'''
+    while i < len(tokens) and tokens[i][0] == 'newline':
+        i += 1
+    kind, value = tokens[i][0], tokens[i][1]
+
+    if kind == 'string':
+        return _string(value), i + 1
+    if kind == 'heredoc':
+        lines = value.split('\n')[1:-1]
+        return '\n'.join(lines) + '\n', i + 1
+    if kind == 'number':
+        return (float(value) if '.' in value or 'e' in value.lower() else int(value)), i + 1
+    if value == '-' and i + 1 < len(tokens) and tokens[i + 1][0] == 'number':
+        number, i = _literal(tokens, i + 1, text)
+        return -number, i
+    if kind == 'ident' and value in ['true', 'false', 'null']:
+        return {'true': True, 'false': False, 'null': None}[value], i + 1
+
+    if value == '[':
+        items, i = [], i + 1
+        while True:
+            while tokens[i][0] == 'newline' or tokens[i][1] == ',':
+                i += 1
+            if tokens[i][1] == ']':
+                return items, i + 1
+            item, i = _literal(tokens, i, text)
+            items.append(item)
+
+    if value == '{':
+        obj, i = {}, i + 1
+        while True:
+            while tokens[i][0] == 'newline' or tokens[i][1] == ',':
+                i += 1
+            if tokens[i][1] == '}':
+                return obj, i + 1
+            key = _string(tokens[i][1]) if tokens[i][0] == 'string' else tokens[i][1]
+            if tokens[i + 1][1] not in ['=', ':']:
+                raise HclError(f'expected = or : after {key}')
+            obj[key], i = _literal(tokens, i + 2, text)
+
+    # not a literal, return the expression as text
+    end = _skip_group(tokens, i) if kind == 'punct' and value in OPEN else i + 1
+    while end < len(tokens) and tokens[end][0] != 'newline' and tokens[end][1] not in [',', ']', '}']:
+        end = _skip_group(tokens, end) if tokens[end][0] == 'punct' and tokens[end][1] in OPEN else end + 1
+    return text[tokens[i][2]:tokens[end - 1][3]], end
+
+
+def _required_plugins(tokens, i, end, text) -> dict:
+    '''Parses the required_plugins block in the packer block between i and end'''
+    plugins = {}
+    while i < end:
+        if tokens[i][0] == 'ident' and tokens[i][1] == 'required_plugins' and tokens[i + 1][1] == '{':
+            found, i = _literal(tokens, i + 1, text)
+            for name, plugin in found.items():
+                if not isinstance(plugin, dict) or 'source' not in plugin:
+                    raise HclError(f'required plugin {name} must have a source')
+                plugins[name] = {'source': plugin['source'], 'version': plugin.get('version', '')}
+        elif tokens[i][0] == 'punct' and tokens[i][1] in OPEN:
+            i = _skip_group(tokens, i)
+        else:
+            i += 1
+    return plugins
+
+
+def _parse(text) -> dict:
+    '''Returns the variables and required plugins declared in the text'''
+    tokens = _tokenize(text)
+    result = {'variables': {}, 'required_plugins': {}}
+    depth, i = 0, 0
+    while i < len(tokens):
+        kind, value = tokens[i][0], tokens[i][1]
+        if depth == 0 and kind == 'ident' and value == 'variable' and i + 2 < len(tokens) \
+                and tokens[i + 1][0] == 'string' and tokens[i + 2][1] == '{':
+            name = _string(tokens[i + 1][1])
+            try:
+                result['variables'][name], i = _variable(tokens, i + 3, text)
+            except (HclError, IndexError) as e:
+                raise HclError(f'variable "{name}": {e}') from e
+            continue
+        if depth == 0 and kind == 'ident' and value == 'packer' and i + 1 < len(tokens) and tokens[i + 1][1] == '{':
+            end = _skip_group(tokens, i + 1)
+            try:
+                result['required_plugins'].update(_required_plugins(tokens, i + 2, end - 1, text))
+            except (HclError, IndexError) as e:
+                raise HclError(f'packer block: {e}') from e
+            i = end
+            continue
+        if kind == 'punct' and value in OPEN:
+            depth += 1
+        elif kind == 'punct' and value in OPEN.values():
+            depth -= 1
+        i += 1
+    return result
+
+
+def parse(text) -> dict:
+    '''Returns a dict of variable name -> {type, default, required, description} for the variable blocks in the text'''
+    return _parse(text)['variables']
+
+
+def _parse_file(path) -> dict:
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    key = hashlib.sha256(content).hexdigest()
+    if key not in _cache:
+        try:
+            _cache[key] = _parse(content.decode('utf-8'))
+        except HclError as e:
+            raise HclError(f'{path}: {e}') from e
+
+    return _cache[key]
+
+
+def parse_file(path) -> dict:
+    '''Returns the variables declared in a pkr.hcl file, files with the same content are only parsed once'''
+    return {name: dict(variable, file=str(path)) for name, variable in _parse_file(path)['variables'].items()}
+
+
+def variables(image_dir) -> dict:
+    '''Returns the variables declared across all the *.pkr.hcl files in an image directory'''
+    result = {}
+    for path in sorted(Path(image_dir).glob('*.pkr.hcl')):
+        result.update(parse_file(path))
+    return result
+
+
+def required_plugins(image_dir) -> dict:
+    '''Returns a dict of plugin name -> {source, version} for the required_plugins across all the *.pkr.hcl files
+    in an image directory'''
+    result = {}
+    for path in sorted(Path(image_dir).glob('*.pkr.hcl')):
+        result.update({name: dict(plugin) for name, plugin in _parse_file(path)['required_plugins'].items()})
+    return result
+
+
+def _attributes(tokens, i, end) -> dict:
+    '''Returns the attributes with string values (name = "value") in the body of a block between i and end'''
+    attributes = {}
+    while i < end:
+        if tokens[i][0] == 'ident' and i + 2 < end and tokens[i + 1][1] == '=' and tokens[i + 2][0] == 'string':
+            attributes[tokens[i][1]] = _string(tokens[i + 2][1])
+            i += 3
+        elif tokens[i][0] == 'punct' and tokens[i][1] in OPEN:
+            i = _skip_group(tokens, i)
+        else:
+            i += 1
+    return attributes
+
+
+def _provisioners(tokens, i, end) -> list:
+    '''Returns the provisioner blocks in the body of a build block between i and end, each as its tokens joined by spaces'''
+    provisioners = []
+    while i < end:
+        if tokens[i][0] == 'ident' and tokens[i][1] == 'provisioner' and i + 2 < end \
+                and tokens[i + 1][0] == 'string' and tokens[i + 2][1] == '{':
+            close = _skip_group(tokens, i + 2)
+            provisioners.append(' '.join(t[1] for t in tokens[i:close] if t[0] != 'newline'))
+            i = close
+        elif tokens[i][0] == 'punct' and tokens[i][1] in OPEN:
+            i = _skip_group(tokens, i)
+        else:
+            i += 1
+    return provisioners
+
+
+def _steps(text) -> dict:
+    '''Returns the string attributes of the source blocks and the provisioners of the build blocks in the text'''
+    tokens = _tokenize(text)
+    result = {'sources': [], 'provisioners': []}
+    i = 0
+    while i < len(tokens):
+        kind, value = tokens[i][0], tokens[i][1]
+        if kind == 'ident' and value == 'source' and i + 3 < len(tokens) \
+                and tokens[i + 1][0] == 'string' and tokens[i + 2][0] == 'string' and tokens[i + 3][1] == '{':
+            end = _skip_group(tokens, i + 3)
+            result['sources'].append(_attributes(tokens, i + 4, end - 1))
+            i = end
+        elif kind == 'ident' and value == 'build' and i + 1 < len(tokens) and tokens[i + 1][1] == '{':
+            end = _skip_group(tokens, i + 1)
+            result['provisioners'].extend(_provisioners(tokens, i + 2, end - 1))
+            i = end
+        elif kind == 'punct' and value in OPEN:
+            i = _skip_group(tokens, i)
+        else:
+            i += 1
+    return result
+
+
+def build_steps(image_dir) -> dict:
+    '''Returns the string attributes of the sources (i.e. the marketplace image) and the provisioners, in order,
+    across all the *.pkr.hcl files in an image directory'''
+    result = {'sources': [], 'provisioners': []}
+    for path in sorted(Path(image_dir).glob('*.pkr.hcl')):
+        try:
+            steps = _steps(path.read_text(encoding='utf-8'))
+        except HclError as e:
+            raise HclError(f'{path}: {e}') from e
+        result['sources'].extend(steps['sources'])
+        result['provisioners'].extend(steps['provisioners'])
+    return result
+
+
+# ----------------
+# type checking
+# ----------------
+
+def _type_tokens(text) -> list:
+    return [t[1] for t in _tokenize(text) if t[0] != 'newline']
+
+
+def _parse_type(tokens, i) -> tuple:
+    name = tokens[i]
+    if name in PRIMITIVE_TYPES:
+        return name, i + 1
+    if tokens[i + 1] != '(':
+        raise HclError(f'unknown type {name}')
+    i += 2
+    if name in COLLECTION_TYPES or name == 'optional':
+        element, i = _parse_type(tokens, i)
+        if name == 'optional' and tokens[i] == ',':  # optional(type, default)
+            i = _skip_value(tokens, i + 1)
+        result = (name, element)
+    elif name == 'object':
+        attributes, i = {}, i + 1
+        while tokens[i] != '}':
+            key = tokens[i].strip('"')
+            attributes[key], i = _parse_type(tokens, i + 2)
+            if tokens[i] == ',':
+                i += 1
+        result, i = ('object', attributes), i + 1
+    elif name == 'tuple':
+        elements, i = [], i + 1
+        while tokens[i] != ']':
+            element, i = _parse_type(tokens, i)
+            elements.append(element)
+            if tokens[i] == ',':
+                i += 1
+        result, i = ('tuple', elements), i + 1
+    else:
+        raise HclError(f'unknown type {name}')
+    if tokens[i] != ')':
+        raise HclError(f'expected ) after {name} type')
+    return result, i + 1
+
+
+def _skip_value(tokens, i) -> int:
+    depth = 0
+    while depth > 0 or tokens[i] != ')':
+        depth += 1 if tokens[i] in OPEN else -1 if tokens[i] in OPEN.values() else 0
+        i += 1
+    return i
+
+
+@lru_cache(maxsize=None)
+def parse_type(text):
+    '''Parses a type constraint (i.e. list(object({ url = string }))) into a primitive type name or a
+    (kind, element(s)) tuple'''
+    tokens = _type_tokens(text)
+    result, i = _parse_type(tokens, 0)
+    if i != len(tokens):
+        raise HclError(f'unexpected {tokens[i]} in type {text}')
+    return result
+
+
+def _errors(value, type, path) -> list:
+    if type == 'any' or value is None:
+        return []
+
+    if type == 'string':  # numbers and bools convert to strings
+        return [] if isinstance(value, (str, int, float, bool)) else [f'{path} must be a string']
+    if type == 'number':
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            return [f'{path} must be a number']
+        try:
+            float(value)
+            return []
+        except ValueError:
+            return [f'{path} must be a number, "{value}" is not']
+    if type == 'bool':
+        return [] if isinstance(value, bool) or value in ['true', 'false'] else [f'{path} must be a bool']
+
+    kind, element = type
+    if kind == 'optional':
+        return _errors(value, element, path)
+    if kind in ['list', 'set']:
+        if not isinstance(value, list):
+            return [f'{path} must be a {kind}']
+        return [e for n, v in enumerate(value) for e in _errors(v, element, f'{path}[{n}]')]
+    if kind == 'tuple':
+        if not isinstance(value, list) or len(value) != len(element):
+            return [f'{path} must be a tuple of {len(element)} elements']
+        return [e for n, (v, t) in enumerate(zip(value, element)) for e in _errors(v, t, f'{path}[{n}]')]
+    if kind == 'map':
+        if not isinstance(value, dict):
+            return [f'{path} must be a map']
+        return [e for k, v in value.items() for e in _errors(v, element, f'{path}.{k}')]
+    if kind == 'object':
+        if not isinstance(value, dict):
+            return [f'{path} must be an object']
+        errors = []
+        for key, attribute in element.items():
+            if key not in value:
+                if not (isinstance(attribute, tuple) and attribute[0] == 'optional'):
+                    errors.append(f'{path} is missing the {key} attribute')
+            else:
+                errors.extend(_errors(value[key], attribute, f'{path}.{key}'))
+        return errors
+
+    return []
+
+
+def check(value, type, name='value') -> list:
+    '''Returns a list of the ways value doesn't match the type constraint (text) of a variable, packer's
+    conversions are allowed (i.e. "1" for a number or 1 for a string)'''
+    return _errors(value, parse_type(type), name)
+
+
+if __name__ == '__main__':
+
+    import json
+    import sys
+
+    paths = sys.argv[1:] if len(sys.argv) > 1 else [Path(__file__).resolve().parent.parent / 'images' / 'VSCodeBox']
+    for path in paths:
+        print(json.dumps(variables(path) if Path(path).is_dir() else parse_file(path), indent=4))
@@ -11,13 +11,21 @@ from datetime import datetime, timezone
 from pathlib import Path
 
 import azure as az
+import catalog
+import fingerprint as fp
+import inventory as inv
+import layers
 import loggers
 import syaml
+import tracing
 
 IMAGE_REQUIRED_PROPERTIES = ['publisher', 'offer', 'sku', 'version', 'os', 'replicaLocations']
 IMAGE_ALLOWED_PROPERTIES = ['publisher', 'offer', 'sku', 'version', 'os', 'replicaLocations', 'description',
                             'buildResourceGroup', 'keyVault', 'virtualNetwork', 'virtualNetworkSubnet',
-                            'virtualNetworkResourceGroup', 'subscription']
+                            'virtualNetworkResourceGroup', 'subscription', 'base', 'layer']
+
+# layers are published with a version keyed by their content, so they don't need a version property
+LAYER_REQUIRED_PROPERTIES = [p for p in IMAGE_REQUIRED_PROPERTIES if p != 'version']
 
 COMMON_ALLOWED_PROPERTIES = ['publisher', 'offer', 'replicaLocations', 'buildResourceGroup', 'keyVault',
                              'virtualNetwork', 'virtualNetworkSubnet', 'virtualNetworkResourceGroup', 'subscription']
@@ -48,8 +56,7 @@ def get_gallery() -> dict:
 
     log.info(f'Found gallery properties in {gallery_path}')
     log.info(f'Gallery properties:')
-    for line in json.dumps(gallery, indent=4).splitlines():
-        log.info(line)
+    log.info(loggers.Json(gallery))
 
     return gallery
 
@@ -65,8 +72,7 @@ def get_common() -> dict:
 
     log.info(f'Found common image properties in {images_path}')
     log.info(f'Common image properties:')
-    for line in json.dumps(common, indent=4).splitlines():
-        log.info(line)
+    log.info(loggers.Json(common))
 
     return common
 
@@ -137,7 +143,8 @@ def _get(image_name, gallery, common=None) -> dict:
         image = temp.copy()
 
     # validate all the user-defined properties
-    syaml.validate(image_path, image, required=IMAGE_REQUIRED_PROPERTIES, allowed=IMAGE_ALLOWED_PROPERTIES)
+    required = LAYER_REQUIRED_PROPERTIES if layers.is_layer(image) else IMAGE_REQUIRED_PROPERTIES
+    syaml.validate(image_path, image, required=required, allowed=IMAGE_ALLOWED_PROPERTIES)
 
     image['name'] = Path(image_dir).name
     image['path'] = f'{image_dir}'
@@ -152,103 +159,210 @@ def _get(image_name, gallery, common=None) -> dict:
         image['gallery']['subscription'] = image['subscription']
 
     log.info(f'Found (initial) image properties in {image_path}')
-    for line in json.dumps(image, indent=4).splitlines():
-        log.info(line)
+    log.info(loggers.Json(image))
 
     _pre_validate(image)
 
     return image
 
 
-def get(image_name, gallery, common=None, suffix=None, ensure_azure=False) -> dict:
-    '''Get the image properties from the image.yaml file optionally supplementing with info from azure'''
-    image = _get(image_name, gallery, common)
+def _base(image, gallery, common, derived=None) -> dict:
+    '''Get the properties of the layer a derived image starts from, with its fingerprint and (content keyed) version'''
+    derived = (derived or []) + [image['name']]
+    name = image['base']
+
+    if name in derived:
+        error_exit(f'The base layers of {derived[0]} are derived from each other: {" -> ".join(derived + [name])}')
+
+    base = _get(name, gallery, common)
+
+    if not layers.is_layer(base):
+        error_exit(f'image.yaml for {image["name"]} has base {name} but {name} is not a layer. its image.yaml must have layer: true')
+
+    _content(base, gallery, common, derived)
+    return base
+
+
+def _content(image, gallery, common, derived=None):
+    '''Set the image's fingerprint. A derived image's fingerprint includes the fingerprint of its base layer (so it
+    changes when the layer does) and a layer's version is keyed by its fingerprint (which includes its refresh period)'''
+    if _has_key_and_value(image, 'base'):
+        base = _base(image, gallery, common, derived)
+        image['baseFingerprint'] = base['fingerprint']
+        image['baseVersion'] = base['version']
+
+    # layers are built again every refresh period so they get the latest marketplace image and updates
+    if layers.is_layer(image) and layers.refresh():
+        image['layerRefresh'] = layers.refresh()
+
+    image['fingerprint'] = fp.compute(image)
+
+    if layers.is_layer(image):
+        image['version'] = layers.version(image)
 
-    if ensure_azure:
 
-        # _get() will set the subscription on the image and the gallery if one was
-        # defined on either, if none was defined, set the subscription on the image
+def get(image_name, gallery, common=None, suffix=None, ensure_azure=False, inventory=None, skip_unchanged=True, session=None) -> dict:
+    '''Get the image properties from the image.yaml file optionally supplementing with info from azure.
+    If a gallery inventory is provided, it is used to validate the image definition and version.
+    If skip_unchanged is True, images with the same fingerprint as a published version are not built.
+    If an azure session is provided, the az commands go through it so the run's lookups are shared'''
+    with tracing.span('image', image=image_name):
+        image = _get(image_name, gallery, common)
+        _content(image, gallery, common)
+
+        if ensure_azure:
+
+            # _get() will set the subscription on the image and the gallery if one was
+            # defined on either, if none was defined, set the subscription on the image
+            if _missing_key_or_value(image, 'subscription'):
+                sub = az.get_sub(session)
+                image['subscription'] = sub
+            # and the gallery
+            if _missing_key_or_value(image['gallery'], 'subscription'):
+                image['gallery']['subscription'] = image['subscription']
+
+            # derived images start from their base layer's version in the gallery
+            if _has_key_and_value(image, 'base'):
+                image['baseImage'] = layers.reference(image)
+
+            build, image_def = az.ensure_image_def_version(image, inventory, session)
+            image['build'] = build
+
+            versions = az.image_versions(image, inventory, session)
+            image['build'] = fp.check(image, versions, skip_unchanged)
+
+            # if buildResourceGroup is not provided we'll provide a name and location for the resource group
+            if _missing_key_or_value(image, 'buildResourceGroup'):
+                suffix = suffix if suffix else default_suffix
+                image['location'] = image_def['location']
+                image['tempResourceGroup'] = f'{image["gallery"]["name"]}-{image["name"]}-{suffix}'
+
+            log.info(f'Image {image["name"]} properties:')
+            log.info(loggers.Json(image))
+
+            _validate(image)
+
+    return image
+
+
+def plan(image_name, gallery, common=None, suffix=None, inventory=None, skip_unchanged=True) -> dict:
+    '''Get the image properties from the image.yaml file and decide if the image should be built using a snapshot of
+    the gallery's inventory instead of azure, so nothing in azure is queried or changed. The reason for the decision
+    is added to the image properties'''
+    with tracing.span('image', image=image_name):
+        image = _get(image_name, gallery, common)
+        _content(image, gallery, common)
+
+        # the snapshot has the subscription the gallery was found in
         if _missing_key_or_value(image, 'subscription'):
-            sub = az.get_sub()
-            image['subscription'] = sub
-        # and the gallery
+            image['subscription'] = inventory['subscription']
         if _missing_key_or_value(image['gallery'], 'subscription'):
             image['gallery']['subscription'] = image['subscription']
 
-        build, image_def = az.ensure_image_def_version(image)
-        image['build'] = build
+        if image['gallery']['subscription'] != inventory['subscription']:
+            error_exit(f'The snapshot of gallery {inventory["gallery"]} is from subscription {inventory["subscription"]} but {image["name"]} uses subscription {image["gallery"]["subscription"]}')
+
+        if _has_key_and_value(image, 'base'):
+            image['baseImage'] = layers.reference(image)
+
+        name = image['name'].lower()
+        image_def = inventory['definitions'].get(name, None)
+
+        if image_def is None:
+            image['build'] = True
+            image['reason'] = 'image definition does not exist (it will be created)'
+        elif (name, image['version']) in inventory['versions']:
+            image['build'] = False
+            image['reason'] = f'version {image["version"]} already exists'
+        else:
+            image['build'] = True
+            image['reason'] = f'version {image["version"]} does not exist'
+
+        versions = [v for k, v in inventory['versions'].items() if k[0] == name]
+        version_fingerprint, same_as = fp.published(image, versions)
+
+        if image['build'] and not fp.check(image, versions, skip_unchanged):
+            image['build'] = False
+            image['reason'] = f'content is unchanged from published version {same_as}'
+        elif not image['build'] and version_fingerprint and version_fingerprint != image['fingerprint']:
+            image['reason'] += ' but its content has changed since it was published'
 
         # if buildResourceGroup is not provided we'll provide a name and location for the resource group
         if _missing_key_or_value(image, 'buildResourceGroup'):
             suffix = suffix if suffix else default_suffix
-            image['location'] = image_def['location']
+            # new image definitions are created in the gallery's location, like every other definition
+            image_def = image_def if image_def else next(iter(inventory['definitions'].values()), {})
+            image['location'] = image_def.get('location', None)
             image['tempResourceGroup'] = f'{image["gallery"]["name"]}-{image["name"]}-{suffix}'
 
-        log.info(f'Image {image["name"]} properties:')
-        for line in json.dumps(image, indent=4).splitlines():
-            log.info(line)
-
-        _validate(image)
+        if image['build'] and (image.get('location', None) or _has_key_and_value(image, 'buildResourceGroup')):
+            _validate(image)
 
     return image
 
 
-def all(gallery, common=None, suffix=None, ensure_azure=False) -> list:
-    '''Get all the image properties from the image.yaml files'''
+def all(gallery, common=None, suffix=None, ensure_azure=False, inventory=None, skip_unchanged=True, session=None) -> list:
+    '''Get all the image properties from the image.yaml files. If ensure_azure is True and no
+    gallery inventory is provided, a single inventory of the gallery is used for all the images'''
     common = common if common else get_common()
     names = image_names()
     for name in names:
         log.warning(f'Getting image {name}')
-    images = [get(i, gallery, common, suffix, ensure_azure) for i in image_names()]
+    if ensure_azure and inventory is None:
+        inventory = inv.load(gallery, session)
+    images = [get(i, gallery, common, suffix, ensure_azure, inventory, skip_unchanged, session) for i in names]
     return images
 
 
 def image_names() -> list:
     '''Get the list of image names from the images directory'''
-    names = []
-
-    # walk the images directory and find all the image.yml/image.yaml files
-    for dirpath, dirnames, files in os.walk(images_root):
-        # os.walk includes the root directory (i.e. repo/images) so we need to skip it
-        if not images_root.samefile(dirpath) and Path(dirpath).parent.samefile(images_root):
-            names.append(Path(dirpath).name)
-
-    return names
+    return catalog.image_names(images_root)
 
 # ----------------
 # async functions
 # ----------------
 
 
-async def get_async(image_name, gallery, common=None, suffix=None, ensure_azure=False) -> dict:
-    '''Get the image properties from the image.yaml file optionally supplementing with info from azure'''
-    image = _get(image_name, gallery, common)
+async def get_async(image_name, gallery, common=None, suffix=None, ensure_azure=False, inventory=None, skip_unchanged=True, session=None) -> dict:
+    '''Get the image properties from the image.yaml file optionally supplementing with info from azure.
+    If a gallery inventory is provided, it is used to validate the image definition and version.
+    If skip_unchanged is True, images with the same fingerprint as a published version are not built.
+    If an azure session is provided, the az commands go through it so the run's lookups are shared'''
+    with tracing.span('image', image=image_name):
+        image = _get(image_name, gallery, common)
+        _content(image, gallery, common)
 
-    if ensure_azure:
+        if ensure_azure:
 
-        # _get() will set the subscription on the image and the gallery if one was
-        # defined on either, if none was defined, set the subscription on the image
-        if _missing_key_or_value(image, 'subscription'):
-            sub = await az.get_sub_async()
-            image['subscription'] = sub
-        # and the gallery
-        if _missing_key_or_value(image['gallery'], 'subscription'):
-            image['gallery']['subscription'] = image['subscription']
+            # _get() will set the subscription on the image and the gallery if one was
+            # defined on either, if none was defined, set the subscription on the image
+            if _missing_key_or_value(image, 'subscription'):
+                sub = await az.get_sub_async(session)
+                image['subscription'] = sub
+            # and the gallery
+            if _missing_key_or_value(image['gallery'], 'subscription'):
+                image['gallery']['subscription'] = image['subscription']
 
-        build, image_def = await az.ensure_image_def_version_async(image)
-        image['build'] = build
+            # derived images start from their base layer's version in the gallery
+            if _has_key_and_value(image, 'base'):
+                image['baseImage'] = layers.reference(image)
 
-        # if buildResourceGroup is not provided we'll provide a name and location for the resource group
-        if 'buildResourceGroup' not in image or not image['buildResourceGroup']:
-            suffix = suffix if suffix else default_suffix
-            image['location'] = image_def['location']
-            image['tempResourceGroup'] = f'{image["gallery"]["name"]}-{image["name"]}-{suffix}'
+            build, image_def = await az.ensure_image_def_version_async(image, inventory, session)
+            image['build'] = build
+
+            versions = await az.image_versions_async(image, inventory, session)
+            image['build'] = fp.check(image, versions, skip_unchanged)
+
+            # if buildResourceGroup is not provided we'll provide a name and location for the resource group
+            if 'buildResourceGroup' not in image or not image['buildResourceGroup']:
+                suffix = suffix if suffix else default_suffix
+                image['location'] = image_def['location']
+                image['tempResourceGroup'] = f'{image["gallery"]["name"]}-{image["name"]}-{suffix}'
 
-        log.info(f'Image {image["name"]} properties:')
-        for line in json.dumps(image, indent=4).splitlines():
-            log.info(line)
+            log.info(f'Image {image["name"]} properties:')
+            log.info(loggers.Json(image))
 
-        _validate(image)
+            _validate(image)
 
     return image
 
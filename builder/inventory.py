@@ -0,0 +1,144 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import azure as az
+import loggers
+
+# maximum number of image version list calls to run at once
+INVENTORY_CONCURRENCY = 8
+
+SNAPSHOT_FILE = 'gallery_{gallery}.json'
+SNAPSHOT_VERSION = 1
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+
+
+def _index(gallery, definitions, versions) -> dict:
+    '''Builds the inventory index from the image definitions and the list of versions for each definition'''
+    inventory = {
+        'gallery': gallery['name'],
+        'subscription': gallery['subscription'],
+        'definitions': {},
+        'versions': {}
+    }
+
+    for imgdef, imgvers in zip(definitions, versions):
+        inventory['definitions'][imgdef['name'].lower()] = imgdef
+        for imgver in imgvers:
+            inventory['versions'][(imgdef['name'].lower(), imgver['name'])] = imgver
+
+    log.info(f'Gallery {gallery["name"]} has {len(inventory["definitions"])} image definitions and {len(inventory["versions"])} image versions')
+
+    return inventory
+
+
+def snapshot_file(gallery) -> Path:
+    '''Returns the path of the saved snapshot of the gallery's inventory'''
+    return storage / SNAPSHOT_FILE.format(gallery=gallery['name'].lower())
+
+
+def save(inventory, path=None) -> Path:
+    '''Saves the inventory as a snapshot of the gallery that can be planned against offline. The time the snapshot
+    was taken is added to the inventory as created'''
+    path = Path(path) if path else snapshot_file({'name': inventory['gallery']})
+
+    versions = {}
+    for (definition, _), imgver in inventory['versions'].items():
+        versions.setdefault(definition, []).append(imgver)
+
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'gallery': inventory['gallery'],
+        'subscription': inventory['subscription'],
+        'definitions': list(inventory['definitions'].values()),
+        'versions': [versions.get(d, []) for d in inventory['definitions']]
+    }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(temp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temp, path)
+
+    inventory['created'] = snapshot['created']
+
+    log.info(f'Saved snapshot of gallery {inventory["gallery"]} to {path}')
+
+    return path
+
+
+def load_snapshot(gallery, path=None) -> dict:
+    '''Returns the inventory from the saved snapshot of the gallery (or None if there isn't one) without calling azure.
+    The time the snapshot was taken is added to the inventory as created'''
+    path = Path(path) if path else snapshot_file(gallery)
+    if not path.is_file():
+        return None
+
+    with open(path, 'r') as f:
+        snapshot = json.load(f)
+
+    if snapshot.get('version', None) != SNAPSHOT_VERSION or snapshot['gallery'].lower() != gallery['name'].lower():
+        log.warning(f'Ignoring snapshot {path} because it is not a snapshot of gallery {gallery["name"]}')
+        return None
+
+    log.info(f'Using snapshot of gallery {snapshot["gallery"]} taken {snapshot["created"]} from {path}')
+
+    inventory = _index({'name': snapshot['gallery'], 'subscription': snapshot['subscription']}, snapshot['definitions'], snapshot['versions'])
+    inventory['created'] = snapshot['created']
+    return inventory
+
+
+def load(gallery, session=None) -> dict:
+    '''Lists every image definition and version in the gallery once and returns them as an index
+    keyed by definition name and (definition name, version)'''
+    if not gallery.get('subscription', None):  # don't change the gallery, images may set the subscription later
+        gallery = dict(gallery, subscription=az.get_sub(session))
+    log.info(f'Getting inventory of gallery {gallery["name"]}')
+
+    definitions = az.list_image_definitions(gallery)
+
+    with ThreadPoolExecutor(max_workers=INVENTORY_CONCURRENCY) as pool:
+        versions = list(pool.map(lambda d: az.list_image_versions(gallery, d['name']), definitions))
+
+    return _index(gallery, definitions, versions)
+
+
+# ----------------
+# async functions
+# ----------------
+
+
+async def load_async(gallery, session=None) -> dict:
+    '''Lists every image definition and version in the gallery once and returns them as an index
+    keyed by definition name and (definition name, version)'''
+    if not gallery.get('subscription', None):  # don't change the gallery, images may set the subscription later
+        gallery = dict(gallery, subscription=await az.get_sub_async(session))
+    log.info(f'Getting inventory of gallery {gallery["name"]}')
+
+    definitions = await az.list_image_definitions_async(gallery)
+
+    semaphore = asyncio.Semaphore(INVENTORY_CONCURRENCY)
+
+    async def _list_versions(imgdef):
+        async with semaphore:
+            return await az.list_image_versions_async(gallery, imgdef['name'])
+
+    versions = await asyncio.gather(*[_list_versions(d) for d in definitions])
+
+    return _index(gallery, definitions, versions)
@@ -0,0 +1,209 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import argparse
+import os
+import sys
+from datetime import date
+from pathlib import Path
+
+import catalog
+import hcl
+import loggers
+import syaml
+
+# the attributes of a packer source that identify the marketplace image it starts from
+MARKETPLACE_ATTRIBUTES = ['image_publisher', 'image_offer', 'image_sku']
+
+# days a layer version is used for before the layer is built again (from the latest marketplace image, with the latest
+# updates) even if its content is unchanged. 0 keys layers by their content only
+MAX_AGE = int(os.environ.get('BUILDER_LAYER_MAX_AGE', '30'))
+
+# the refresh period of layer versions, resolved once for the run (build.py passes its own to the builders)
+_refresh = os.environ.get('BUILDER_LAYER_REFRESH', None)
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+images_root = repo / 'images'
+
+
+def error_exit(message):
+    log.error(message)
+    sys.exit(message)
+
+
+def is_layer(image) -> bool:
+    '''Returns True if the image is a base layer (layer: true in its image.yaml) other images can be derived from'''
+    return str(image.get('layer', '')).lower() in ['1', 'true', 'yes']
+
+
+def refresh() -> str:
+    '''Returns the refresh period layers are keyed by (with their content): the first day of the current period of
+    MAX_AGE days, so every layer is built again at most MAX_AGE days after its version was published. It's resolved
+    once so every image in the run agrees on it, and is empty if MAX_AGE is 0'''
+    global _refresh
+    if _refresh is None:
+        days = date.today().toordinal()
+        _refresh = date.fromordinal(days - days % MAX_AGE).isoformat() if MAX_AGE > 0 else ''
+    return _refresh
+
+
+def pin(period):
+    '''Sets the refresh period layers are keyed by for the run (i.e. the period of the plan being applied)'''
+    global _refresh
+    _refresh = period
+
+
+def version(image) -> str:
+    '''Returns the version a layer is published as. It's keyed by the layer's content and refresh period: the major
+    number of its version property (1 if it doesn't have one) followed by two numbers taken from its fingerprint'''
+    major = int(str(image.get('version', None) or '1').split('.')[0])
+    fingerprint = image['fingerprint']
+    return f'{major}.{int(fingerprint[:7], 16)}.{int(fingerprint[7:14], 16)}'
+
+
+def reference(image) -> dict:
+    '''Returns the gallery image version a derived image starts from (its baseImage packer variable)'''
+    gallery = image['gallery']
+    return {
+        'subscription': gallery['subscription'],
+        'resourceGroup': gallery['resourceGroup'],
+        'gallery': gallery['name'],
+        'name': image['base'],
+        'version': image['baseVersion']
+    }
+
+
+def bases(names, root=images_root) -> dict:
+    '''Returns the base layer (or None) declared in each image's image.yaml by name, including the
+    layers the images are derived from'''
+    result = {}
+    pending = list(names)
+    while pending:
+        name = pending.pop(0)
+        if name in result:
+            continue
+        if not (Path(root) / name).is_dir():
+            error_exit(f'Base layer {name} was not found in {root}')
+        result[name] = syaml.parse(syaml.get_file(Path(root) / name, 'image', required=True)).get('base', None) or None
+        if result[name]:
+            pending.append(result[name])
+    return result
+
+
+def chain(name, bases) -> list:
+    '''Returns the layers the image is derived from, nearest first. Exits if a layer is derived from itself'''
+    layers = []
+    base = bases.get(name, None)
+    while base:
+        if base == name or base in layers:
+            error_exit(f'The base layers of {name} are derived from each other: {" -> ".join([name] + layers + [base])}')
+        layers.append(base)
+        base = bases.get(base, None)
+    return layers
+
+
+def depth(name, bases) -> int:
+    '''Returns the number of layers the image is derived from'''
+    return len(chain(name, bases))
+
+
+def order(names, bases) -> list:
+    '''Returns the names ordered so every layer comes before the images derived from it'''
+    return sorted(names, key=lambda n: depth(n, bases))
+
+
+def with_bases(names, bases) -> list:
+    '''Returns the names with the layers they're derived from, each layer before the first image derived from it'''
+    result = []
+    for name in names:
+        for layer in reversed(chain(name, bases)):
+            if layer not in result:
+                result.append(layer)
+        if name not in result:
+            result.append(name)
+    return result
+
+
+def with_dependents(names, bases) -> list:
+    '''Returns the names with the images in bases that are derived (directly or through other layers) from any of them'''
+    result = list(names)
+    for name in bases:
+        if name not in result and any(layer in names for layer in chain(name, bases)):
+            result.append(name)
+    return result
+
+
+def _common_prefix(lists) -> list:
+    prefix = []
+    for items in zip(*lists):
+        if any(i != items[0] for i in items):
+            break
+        prefix.append(items[0])
+    return prefix
+
+
+def detect(names, root=images_root) -> list:
+    '''Returns the groups of images (that aren't derived from a layer) which start from the same marketplace image and
+    run the same provisioners first, with the provisioners they share. Each group is a candidate for a base layer'''
+    groups = {}
+    provisioners = {}
+    for name, base in bases(names, root).items():
+        if base or name not in names:
+            continue
+        try:
+            steps = hcl.build_steps(Path(root) / name)
+        except hcl.HclError as e:
+            log.warning(f'Unable to parse the packer templates of {name}: {e}')
+            continue
+        source = next((s for s in steps['sources'] if all(a in s for a in MARKETPLACE_ATTRIBUTES)), None)
+        if source is None:
+            continue
+        groups.setdefault(tuple(source[a] for a in MARKETPLACE_ATTRIBUTES), []).append(name)
+        provisioners[name] = steps['provisioners']
+
+    candidates = []
+    for source, members in groups.items():
+        if len(members) < 2:
+            continue
+        shared = _common_prefix([provisioners[m] for m in members])
+        # a layer that runs every provisioner of one of the images would be that image
+        if shared and all(len(shared) < len(provisioners[m]) for m in members):
+            candidates.append({'images': sorted(members), 'source': dict(zip(MARKETPLACE_ATTRIBUTES, source)), 'provisioners': shared})
+    return candidates
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Show the base layers the images are derived from and the order they are built in, '
+                                     'or detect images that could be derived from a shared base layer')
+    parser.add_argument('--images', '-i', nargs='*', help='names of images to include. if not specified all images will be')
+    parser.add_argument('--detect', action='store_true', help='list the groups of images that start from the same marketplace image and run the same provisioners first')
+
+    args = parser.parse_args()
+
+    names = args.images if args.images else catalog.image_names(images_root)
+
+    if args.detect:
+        candidates = detect(names)
+        for c in candidates:
+            print('')
+            print(f'{", ".join(c["images"])} start from {"/".join(c["source"].values())} and run the same {len(c["provisioners"])} provisioners first:')
+            for p in c['provisioners']:
+                print(f'  {p[:120]}{"..." if len(p) > 120 else ""}')
+        if not candidates:
+            print('')
+            print('No images share a marketplace image and their first provisioners')
+    else:
+        print('')
+        graph = bases(names)
+        for name in order(with_bases(names, graph), graph):
+            layers = chain(name, graph)
+            print(f'{"  " * len(layers)}{name}{" (from " + " <- ".join(layers) + ")" if layers else ""}')
+    print('')
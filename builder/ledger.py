@@ -0,0 +1,102 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import json
+import os
+import sys
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+import loggers
+
+LEDGER_DIR = 'ledger'
+
+# the steps recorded for each image (or builder) in the order they happen
+STEPS = ['validated', 'params', 'deployed', 'finished', 'replicated']
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+
+_lock = threading.Lock()
+
+
+def error_exit(message):
+    log.error(message)
+    sys.exit(message)
+
+
+def ledger_file(run) -> Path:
+    '''Returns the path of the ledger for a run'''
+    return storage / LEDGER_DIR / f'{run}.jsonl'
+
+
+class Ledger:
+    '''Records the steps each image of a build run has completed as json lines, so a failed run can be resumed.
+    Each record is appended with a single write to a file opened for appending, so records written by concurrent
+    tasks (or processes) are never interleaved, and a record cut short by a crash is ignored when it's read'''
+
+    def __init__(self, run, resume=False):
+        self.run = run
+        self.path = ledger_file(run)
+        self.names = None
+        self._steps = {}
+
+        if resume:
+            if not self.path.is_file():
+                error_exit(f'No ledger was found for run {run} at {self.path}')
+            self._load()
+        else:
+            self.path.unlink(missing_ok=True)
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            lines = f.read().splitlines()
+
+        for number, line in enumerate(lines, start=1):
+            try:
+                record = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                log.warning(f'Ignoring incomplete record on line {number} of ledger {self.path}')
+                continue
+            if record['step'] == 'started':
+                self.names = record['names']
+            else:
+                self._steps.setdefault(record['image'], {})[record['step']] = record
+
+        log.info(f'Resuming run {self.run} from ledger {self.path} with {len(self._steps)} recorded images')
+
+    def _append(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode()
+        with _lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def start(self, names):
+        '''Records the names of the images in the run, a resumed run builds the same images'''
+        self.names = list(names)
+        self._append({'time': datetime.now(timezone.utc).isoformat(), 'step': 'started', 'names': self.names})
+
+    def record(self, name, step, **fields):
+        '''Records that the image (or the builder named after it) completed the step'''
+        record = dict(fields, time=datetime.now(timezone.utc).isoformat(), image=name, step=step)
+        self._steps.setdefault(name, {})[step] = record
+        self._append(record)
+
+    def get(self, name, step) -> dict:
+        '''Returns the record of the step for the image, or None if the image hasn't completed it'''
+        return self._steps.get(name, {}).get(step, None)
+
+    def done(self, name, step) -> bool:
+        return self.get(name, step) is not None
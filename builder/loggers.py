@@ -3,8 +3,15 @@
 # Licensed under the MIT License.
 # ------------------------------------
 
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -18,24 +25,188 @@ storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
 
 log_file = storage / f'log_{timestamp}.txt'
 
+LOG_LEVEL = os.environ.get('BUILDER_LOG_LEVEL', 'DEBUG').upper()
 
-def getLogger(name, level=logging.DEBUG):
-    logger = logging.getLogger(name)
-    logger.setLevel(level=level)
+# text: the usual human readable lines, json: one json object per line with the image and phase fields
+LOG_FORMAT = os.environ.get('BUILDER_LOG_FORMAT', 'text').lower()
+
+CONTEXT_FIELDS = ['image', 'phase']
+
+TEXT_FORMAT = '{asctime} [{name:^8}] {levelname:<8}: {message}'
+DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+_context = {field: contextvars.ContextVar(f'log_{field}', default=None) for field in CONTEXT_FIELDS}
+
+_lock = threading.Lock()
+_queue = queue.SimpleQueue()
+_listener = None
+
+
+class Json:
+    '''Wraps an object so it is only serialised (as indented json) if the log line is actually emitted,
+    i.e. log.info(loggers.Json(image)) instead of log.info(json.dumps(image, indent=4))'''
+
+    __slots__ = ['obj']
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, indent=4)
+
+
+class _TextFormatter(logging.Formatter):
+    '''Formats each line of a multi-line message (i.e. json) as its own log line'''
+
+    def format(self, record):
+        text = super().format(record)
+        if '\n' not in record.message:
+            return text
+        lines = []
+        for line in record.message.splitlines():
+            record.message = line
+            lines.append(self.formatMessage(record))
+        return '\n'.join(lines)
+
+
+class _JsonFormatter(logging.Formatter):
+    '''Formats each record as a single json object'''
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''Formats the message in the calling thread (only for records that pass the level) and hands
+    the record to the listener thread, which does the (potentially slow) writes'''
+
+    def prepare(self, record):
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is None:
+                setattr(record, field, _context[field].get())
+        return super().prepare(record)
+
+
+class _Remove:
+    '''Queued after a handler's records to remove the handler from the listener once they're written'''
+
+    __slots__ = ['handler']
+
+    def __init__(self, handler):
+        self.handler = handler
+
+
+class _Listener(logging.handlers.QueueListener):
+    '''Removes handlers when their _Remove marker comes off the queue'''
 
-    formatter = logging.Formatter('{asctime} [{name:^8}] {levelname:<8}: {message}', datefmt='%m/%d/%Y %I:%M:%S %p', style='{',)
+    def handle(self, record):
+        if isinstance(record, _Remove):
+            self.handlers = tuple(h for h in self.handlers if h is not record.handler)
+            record.handler.close()
+            return
+        super().handle(record)
 
-    ch = logging.StreamHandler()
-    ch.setLevel(level=level)
-    ch.setFormatter(formatter)
 
-    logger.addHandler(ch)
+_queue_handler = _QueueHandler(_queue)
+
+
+def _formatter():
+    return _JsonFormatter() if LOG_FORMAT == 'json' else _TextFormatter(TEXT_FORMAT, datefmt=DATE_FORMAT, style='{')
+
+
+def _handlers() -> list:
+    handlers = [logging.StreamHandler()]
 
     if in_builder and os.path.isdir(storage):
-        fh = logging.FileHandler(log_file)
-        fh.setLevel(level=level)
-        fh.setFormatter(formatter)
+        handlers.append(logging.FileHandler(log_file))
+
+    for handler in handlers:
+        handler.setFormatter(_formatter())
+
+    return handlers
+
+
+def start(handlers=None) -> logging.Handler:
+    '''Starts the process-wide listener that writes log records to the handlers (by default the console and, in the
+    builder container, the log file in storage), returns the handler that adds records to the listener's queue'''
+    global _listener
+    with _lock:
+        if _listener is None:
+            _listener = _Listener(_queue, *(handlers if handlers else _handlers()), respect_handler_level=True)
+            _listener.start()
+        return _queue_handler
+
+
+def stop():
+    '''Writes any queued log records and stops the listener'''
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(stop)
 
-        logger.addHandler(fh)
+
+def add_file(path, image=None) -> logging.Handler:
+    '''Writes log records to a file (only the records logged in the context of the image, if one is provided)
+    along with the listener's other handlers, returns the handler to pass to remove_handler'''
+    handler = logging.FileHandler(path)
+    handler.setFormatter(_formatter())
+    if image is not None:
+        handler.addFilter(lambda record: getattr(record, 'image', None) == image)
+    start()
+    with _lock:
+        _listener.handlers = _listener.handlers + (handler,)
+    return handler
+
+
+def remove_handler(handler):
+    '''Stops writing log records to a handler added with add_file and closes it'''
+    with _lock:
+        if _listener is not None and handler in _listener.handlers:
+            # records already queued for the handler are written before it's removed
+            _queue.put_nowait(_Remove(handler))
+            return
+    handler.close()
+
+
+def getLogger(name, level=None):
+    '''Returns the named logger, adding the process-wide queue handler only the first time it is requested'''
+    handler = start()
+
+    logger = logging.getLogger(name)
+    logger.setLevel(level=level if level else LOG_LEVEL)
+
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
 
     return logger
+
+
+@contextmanager
+def context(**fields):
+    '''Adds fields (i.e. image and phase) to the log records made within the context (including by async tasks
+    created within it)'''
+    tokens = [(_context[k], _context[k].set(v)) for k, v in fields.items() if k in _context]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def current(field):
+    '''Returns the value of a context field (i.e. image) for the current context, or None'''
+    return _context[field].get() if field in _context else None
@@ -0,0 +1,128 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import hashlib
+import hmac
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import fingerprint as fp
+import loggers
+
+# bump when the layout of the manifest changes so builders don't use manifests they don't understand
+MANIFEST_VERSION = 1
+
+# hours a manifest can be used for before the builder validates its images again
+MAX_AGE = int(os.environ.get('BUILDER_MANIFEST_MAX_AGE', '24'))
+
+# the key manifests are signed with, build.py generates one for each run if it isn't set
+KEY = os.environ.get('BUILDER_MANIFEST_KEY', '')
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+
+
+def _entry(image) -> dict:
+    '''Returns the image's resolved properties with its path relative to the repository, builders clone it elsewhere'''
+    return dict(image, path=Path(os.path.relpath(image['path'], repo)).as_posix())
+
+
+def _payload(manifest) -> bytes:
+    return json.dumps({k: v for k, v in manifest.items() if k != 'signature'}, sort_keys=True, separators=(',', ':')).encode()
+
+
+def sign(manifest, key) -> str:
+    '''Returns the hmac-sha256 of the manifest (without its signature) with the key'''
+    return hmac.new(key.encode(), _payload(manifest), hashlib.sha256).hexdigest()
+
+
+def create(images, suffix, key) -> dict:
+    '''Returns a signed manifest of the images resolved (and validated) by build.py for the run with the suffix'''
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'suffix': suffix,
+        'images': {i['name']: _entry(i) for i in images}
+    }
+    manifest['signature'] = sign(manifest, key)
+    return manifest
+
+
+def dumps(manifest) -> str:
+    '''Returns the manifest as compact json to pass to a builder container'''
+    return json.dumps(manifest, sort_keys=True, separators=(',', ':'))
+
+
+def loads(text, key=KEY) -> dict:
+    '''Returns the manifest in the json text, or None (with a warning) if it isn't a manifest this builder can use'''
+    if not text:
+        return None
+
+    try:
+        manifest = json.loads(text)
+    except json.decoder.JSONDecodeError:
+        log.warning('Ignoring the build manifest because it isn\'t valid json')
+        return None
+
+    if manifest.get('version', None) != MANIFEST_VERSION:
+        log.warning(f'Ignoring the build manifest because it has version {manifest.get("version", None)} and this builder uses version {MANIFEST_VERSION}')
+        return None
+
+    if not key or not hmac.compare_digest(manifest.get('signature', ''), sign(manifest, key)):
+        log.warning('Ignoring the build manifest because its signature doesn\'t match')
+        return None
+
+    created = datetime.fromisoformat(manifest['created'])
+    if datetime.now(timezone.utc) - created > timedelta(hours=MAX_AGE):
+        log.warning(f'Ignoring the build manifest because it was created more than {MAX_AGE} hours ago ({manifest["created"]})')
+        return None
+
+    return manifest
+
+
+def from_env() -> dict:
+    '''Returns the manifest passed to the builder container in BUILDER_MANIFEST, or None'''
+    return loads(os.environ.get('BUILDER_MANIFEST', ''))
+
+
+def image(manifest, name, suffix) -> dict:
+    '''Returns the image's resolved properties from the manifest, or None if the image isn't in the manifest or its
+    content in this checkout of the repository is different (i.e. the builder cloned another revision)'''
+    entry = manifest['images'].get(name, None)
+    if entry is None:
+        log.warning(f'{name} is not in the build manifest')
+        return None
+
+    image = dict(entry, path=str(repo / entry['path']))
+
+    fingerprint = fp.compute(image)
+    if fingerprint != entry['fingerprint']:
+        log.warning(f'{name} has changed since the build manifest was created (fingerprint {fingerprint} != {entry["fingerprint"]})')
+        return None
+
+    # packer creates its own temporary resource group, named with the builder's suffix so it isn't the builder's group
+    if image.get('tempResourceGroup', None):
+        image['tempResourceGroup'] = f'{image["gallery"]["name"]}-{image["name"]}-{suffix}'
+
+    return image
+
+
+def images(manifest, names, suffix) -> dict:
+    '''Returns the resolved properties of the images in the manifest that are still current, by name'''
+    resolved = {}
+    for name in names:
+        with loggers.context(image=name):
+            i = image(manifest, name, suffix)
+        if i is not None:
+            resolved[name] = i
+    if resolved:
+        log.info(f'Using the build manifest of run {manifest["suffix"]} for {", ".join(resolved)}')
+    return resolved
@@ -3,7 +3,6 @@
 # Licensed under the MIT License.
 # ------------------------------------
 
-import asyncio
 import json
 import os
 import shutil
@@ -11,12 +10,20 @@ import subprocess
 import sys
 from pathlib import Path
 
+import hcl
 import loggers
+import plugins
+import replication
+import stream
+import tracing
 
 AUTO_VARS_FILE = 'vars.auto.pkrvars.json'
 DEFAULT_PKR_VARS = ['subscription', 'name', 'location', 'version', 'tempResourceGroup', 'buildResourceGroup',
                     'gallery', 'replicaLocations', 'keyVault', 'virtualNetwork',  'virtualNetworkSubnet',
-                    'virtualNetworkResourceGroup', 'branch', 'commit']
+                    'virtualNetworkResourceGroup', 'branch', 'commit', 'baseImage']
+
+# set to fall back to packer inspect when an image's variables can't be parsed from its *.pkr.hcl files
+PACKER_INSPECT = os.environ.get('BUILDER_PACKER_INSPECT', '').lower() in ['1', 'true', 'yes']
 
 log = loggers.getLogger(__name__)
 
@@ -40,7 +47,7 @@ def _parse_command(command):
     else:
         raise ValueError(f'command must be a string or list, not {type(command)}')
 
-    packer = shutil.which('packer')
+    packer = shutil.which('packer') or 'packer'
 
     if args[0] == 'packer':
         args.pop(0)
@@ -51,15 +58,66 @@ def _parse_command(command):
     return args
 
 
+def _variables(image) -> dict:
+    '''Returns the variables declared in the image's *.pkr.hcl files, or None if they can't be parsed'''
+    try:
+        return hcl.variables(image['path']) or None
+    except hcl.HclError as e:
+        log.warning(f'Unable to parse packer variables for {image["name"]}: {e}')
+        return None
+
+
+def _inspect_vars(stdout) -> list:
+    # machine-readable output escapes the newlines in the ui messages as a literal \n
+    return [v.strip().split('var.')[1].split(':')[0] for v in stdout.split('\\n') if v.startswith('var.')]
+
+
+def _check_vars(image, auto_vars, variables):
+    '''Exits if any of the values don't match the type of the packer variable they're for'''
+    if not variables:
+        return
+    errors = []
+    for name, value in auto_vars.items():
+        if name in variables:
+            try:
+                errors.extend(hcl.check(value, variables[name]['type'], name))
+            except hcl.HclError as e:
+                log.warning(f'Unable to check the type of packer variable {name} for {image["name"]}: {e}')
+    if errors:
+        error_exit(f'Invalid packer variables for {image["name"]}: {", ".join(errors)}')
+
+
+def _auto_vars(image, pkr_vars) -> dict:
+    '''Returns the image properties for the packer variables. When replication is deferred the image version is
+    only published to the build region, the orchestrator replicates it to the replicaLocations after the build'''
+    auto_vars = {}
+
+    for v in pkr_vars:
+        if v in image and image[v]:
+            auto_vars[v] = image[v]
+
+    if 'replicaLocations' in pkr_vars and replication.deferred():
+        auto_vars['replicaLocations'] = replication.packer_regions(image)
+
+    return auto_vars
+
+
 def get_vars(image):
-    '''Gets the available packer variables from the variable.pkr.hcl file'''
+    '''Gets the available packer variables from the image's *.pkr.hcl files'''
+    variables = _variables(image)
+    if variables:
+        return list(variables)
+
+    if not PACKER_INSPECT:
+        return DEFAULT_PKR_VARS
+
     try:
         args = _parse_command(['inspect', '-machine-readable', image['path']])
         log.info(f'Running packer command: {" ".join(args)}')
         proc = subprocess.run(args, capture_output=True, check=True, text=True)
         if proc.stdout:
             log.info(f'\n\n{proc.stdout}')
-            return [v.strip().split('var.')[1].split(':')[0] for v in proc.stdout.split('\\n') if v.startswith('var.')]
+            return _inspect_vars(proc.stdout)
         return DEFAULT_PKR_VARS
     except subprocess.CalledProcessError:
         return DEFAULT_PKR_VARS
@@ -67,16 +125,14 @@ def get_vars(image):
 
 def save_vars_file(image):
     '''Saves properties from image.yaml to a packer auto variables file'''
-    pkr_vars = get_vars(image)
-    auto_vars = {}
+    variables = _variables(image)
+    pkr_vars = list(variables) if variables else get_vars(image)
+    auto_vars = _auto_vars(image, pkr_vars)
 
-    for v in pkr_vars:
-        if v in image and image[v]:
-            auto_vars[v] = image[v]
+    _check_vars(image, auto_vars, variables)
 
     log.info(f'Saving {image["name"]} packer auto variables:')
-    for line in json.dumps(auto_vars, indent=4).splitlines():
-        log.info(line)
+    log.info(loggers.Json(auto_vars))
 
     with open(Path(image['path']) / AUTO_VARS_FILE, 'w') as f:
         json.dump(auto_vars, f, ensure_ascii=False, indent=4, sort_keys=True)
@@ -89,25 +145,40 @@ def save_vars_files(images):
 
 
 def init(image):
-    '''Executes the packer init command on an image'''
-    log.info(f'Executing packer init for {image["name"]}')
-    args = _parse_command(['init', image['path']])
-    log.info(f'Running packer command: {" ".join(args)}')
-    proc = subprocess.run(args, stdout=sys.stdout, stderr=sys.stderr, check=True, text=True)
-    log.info(f'Done executing packer init for {image["name"]}')
-    return proc.returncode
+    '''Executes the packer init command on an image, unless the plugin cache already has its required plugins'''
+    with loggers.context(image=image['name'], phase='init'), tracing.span('packer init'):
+        log.info(f'Executing packer init for {image["name"]}')
+        if plugins.cached(image):
+            plugins.record(image, hit=True)
+            tracing.annotate(cached=True, exit_code=0)
+            return 0
+        with plugins.lock():
+            if plugins.cached(image):  # installed by another build while waiting for the lock
+                plugins.record(image, hit=True)
+                tracing.annotate(cached=True, exit_code=0)
+                return 0
+            plugins.record(image, hit=False)
+            plugins.prune(image)
+            args = _parse_command(['init', image['path']])
+            log.info(f'Running packer command: {" ".join(args)}')
+            proc = subprocess.run(args, stdout=sys.stdout, stderr=sys.stderr, check=True, text=True, env=plugins.env())
+        log.info(f'Done executing packer init for {image["name"]}')
+        tracing.annotate(exit_code=proc.returncode)
+        return proc.returncode
 
 
 def build(image):
     '''Executes the packer build command on an image'''
-    log.info(f'Executing packer build for {image["name"]}')
-    args = _parse_command(['build', '-force', image['path']])
-    if in_builder:
-        args.insert(2, '-color=false')
-    log.info(f'Running packer command: {" ".join(args)}')
-    proc = subprocess.run(args, stdout=sys.stdout, stderr=sys.stderr, check=True, text=True)
-    log.info(f'Done executing packer build for {image["name"]}')
-    return proc.returncode
+    with loggers.context(image=image['name'], phase='build'), tracing.span('packer build'):
+        log.info(f'Executing packer build for {image["name"]}')
+        args = _parse_command(['build', '-force', image['path']])
+        if in_builder:
+            args.insert(2, '-color=false')
+        log.info(f'Running packer command: {" ".join(args)}')
+        proc = subprocess.run(args, stdout=sys.stdout, stderr=sys.stderr, check=True, text=True, env=plugins.env())
+        log.info(f'Done executing packer build for {image["name"]}')
+        tracing.annotate(exit_code=proc.returncode)
+        return proc.returncode
 
 
 def execute(image):
@@ -121,62 +192,73 @@ def execute(image):
 # ----------------
 
 async def get_vars_async(image):
-    '''Gets the available packer variables from the variable.pkr.hcl file'''
-    try:
-        args = _parse_command(['inspect', '-machine-readable', image['path']])
-        proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await proc.communicate()
-        if stdout:
-            log.info(f'\n\n{stdout}')
-            return [v.strip().split('var.')[1].split(':')[0] for v in stdout.decode().split('\\n') if v.startswith('var.')]
-        return DEFAULT_PKR_VARS
-    except subprocess.CalledProcessError:
+    '''Gets the available packer variables from the image's *.pkr.hcl files'''
+    variables = _variables(image)
+    if variables:
+        return list(variables)
+
+    if not PACKER_INSPECT:
         return DEFAULT_PKR_VARS
 
+    args = _parse_command(['inspect', '-machine-readable', image['path']])
+    returncode, stdout, stderr = await stream.run_async(args, name=image['name'], capture=True)
+    if returncode == 0 and stdout:
+        return _inspect_vars(stdout)
+    return DEFAULT_PKR_VARS
+
 
 async def save_vars_file_async(image):
     '''Saves properties from each image.yaml to packer auto variables files'''
-    pkr_vars = await get_vars_async(image)
-    auto_vars = {}
+    variables = _variables(image)
+    pkr_vars = list(variables) if variables else await get_vars_async(image)
+    auto_vars = _auto_vars(image, pkr_vars)
 
-    for v in pkr_vars:
-        if v in image and image[v]:
-            auto_vars[v] = image[v]
+    _check_vars(image, auto_vars, variables)
 
     log.info(f'Saving {image["name"]} packer auto variables:')
-    for line in json.dumps(auto_vars, indent=4).splitlines():
-        log.info(line)
+    log.info(loggers.Json(auto_vars))
 
     with open(Path(image['path']) / AUTO_VARS_FILE, 'w') as f:
         json.dump(auto_vars, f, ensure_ascii=False, indent=4, sort_keys=True)
 
 
 async def init_async(image):
-    '''Executes the packer init command on an image'''
-    log.info(f'Executing packer init for {image["name"]}')
-    args = _parse_command(['init', image['path']])
-    log.info(f'Running packer command: {" ".join(args)}')
-    proc = await asyncio.create_subprocess_exec(*args)
-    stdout, stderr = await proc.communicate()
-    # log.info(f'\n\n{stdout}')
-    log.info(f'Done executing packer init for {image["name"]}')
-    log.info(f'[packer init for {image["name"]} exited with {proc.returncode}]')
-    return proc.returncode
+    '''Executes the packer init command on an image, unless the plugin cache already has its required plugins'''
+    with loggers.context(image=image['name'], phase='init'), tracing.span('packer init'):
+        log.info(f'Executing packer init for {image["name"]}')
+        if plugins.cached(image):
+            plugins.record(image, hit=True)
+            tracing.annotate(cached=True, exit_code=0)
+            return 0
+        async with plugins.lock_async():
+            if plugins.cached(image):  # installed by another build while waiting for the lock
+                plugins.record(image, hit=True)
+                tracing.annotate(cached=True, exit_code=0)
+                return 0
+            plugins.record(image, hit=False)
+            plugins.prune(image)
+            args = _parse_command(['init', image['path']])
+            log.info(f'Running packer command: {" ".join(args)}')
+            returncode, stdout, stderr = await stream.run_async(args, name=image['name'], env=plugins.env())
+        log.info(f'Done executing packer init for {image["name"]}')
+        log.info(f'[packer init for {image["name"]} exited with {returncode}]')
+        tracing.annotate(exit_code=returncode)
+        return returncode
 
 
 async def build_async(image):
     '''Executes the packer build command on an image'''
-    log.info(f'Executing packer build for {image["name"]}')
-    args = _parse_command(['build', '-force', image['path']])
-    if in_builder:
-        args.insert(2, '-color=false')
-    log.info(f'Running packer command: {" ".join(args)}')
-    proc = await asyncio.create_subprocess_exec(*args)
-    stdout, stderr = await proc.communicate()
-    # log.info(f'\n\n{stdout}')
-    log.info(f'Done executing packer build for {image["name"]}')
-    log.info(f'[packer build for {image["name"]} exited with {proc.returncode}]')
-    return proc.returncode
+    with loggers.context(image=image['name'], phase='build'), tracing.span('packer build'):
+        log.info(f'Executing packer build for {image["name"]}')
+        args = _parse_command(['build', '-force', image['path']])
+        if in_builder:
+            args.insert(2, '-color=false')
+        log.info(f'Running packer command: {" ".join(args)}')
+        returncode, stdout, stderr = await stream.run_async(args, name=image['name'], env=plugins.env())
+        log.info(f'Done executing packer build for {image["name"]}')
+        log.info(f'[packer build for {image["name"]} exited with {returncode}]')
+        tracing.annotate(exit_code=returncode)
+        return returncode
 
 
 async def execute_async(image):
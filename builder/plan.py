@@ -0,0 +1,138 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import loggers
+
+PLAN_FILE = 'plan_{suffix}.json'
+
+# bump when the layout of the plan changes so old plans aren't applied by a newer orchestrator
+PLAN_VERSION = 1
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+
+
+def error_exit(message):
+    log.error(message)
+    sys.exit(message)
+
+
+def _builder(batch) -> dict:
+    '''Returns the builder container that builds a batch of images, the builder is named after the first image'''
+    image = batch[0]
+    temp = bool(image.get('tempResourceGroup', None))
+    return {
+        'name': image['name'],
+        'images': [i['name'] for i in batch],
+        'subscription': image['subscription'],
+        'resourceGroup': image['tempResourceGroup'] if temp else image['buildResourceGroup'],
+        'createGroup': temp,
+        'location': image.get('location', None)
+    }
+
+
+def _image(image, builders) -> dict:
+    return {
+        'name': image['name'],
+        'version': image['version'],
+        'base': image.get('base', None),
+        'build': image['build'],
+        'reason': image['reason'],
+        'builder': builders.get(image['name'], None),
+        'subscription': image['subscription'],
+        'buildResourceGroup': image.get('buildResourceGroup', None),
+        'tempResourceGroup': image.get('tempResourceGroup', None),
+        'location': image.get('location', None),
+        'replicaLocations': image.get('replicaLocations', []),
+        'fingerprint': image['fingerprint']
+    }
+
+
+def create(images, builds, params, suffix, inventory, skip_unchanged=True, images_per_builder=1, batch_deploy=False,
+           layer_refresh='') -> dict:
+    '''Returns a plan of the images (from image.plan), the builders for the batches of images to build, and the
+    builder parameters, decided from the snapshot of the gallery in the inventory and the layers' refresh period'''
+    builders = {i['name']: b[0]['name'] for b in builds for i in b}
+    return {
+        'version': PLAN_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'suffix': suffix,
+        'gallery': {'name': inventory['gallery'], 'subscription': inventory['subscription'],
+                    'snapshot': inventory.get('created', None)},
+        'options': {'skipUnchanged': skip_unchanged, 'imagesPerBuilder': images_per_builder, 'batchDeploy': batch_deploy,
+                    'layerRefresh': layer_refresh},
+        'params': params,
+        'images': [_image(i, builders) for i in images],
+        'builders': [_builder(b) for b in builds]
+    }
+
+
+def save(plan, path=None) -> Path:
+    '''Writes the plan as json (by default to the storage directory)'''
+    path = Path(path) if path else storage / PLAN_FILE.format(suffix=plan['suffix'])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(temp, 'w') as f:
+        json.dump(plan, f, ensure_ascii=False, indent=4)
+    os.replace(temp, path)
+    return path
+
+
+def load(path) -> dict:
+    '''Reads a plan written by save'''
+    path = Path(path)
+    if not path.is_file():
+        error_exit(f'Plan {path} was not found')
+
+    with open(path, 'r') as f:
+        plan = json.load(f)
+
+    if plan.get('version', None) != PLAN_VERSION:
+        error_exit(f'Plan {path} has version {plan.get("version", None)} but only version {PLAN_VERSION} plans can be applied. Please create a new plan')
+
+    return plan
+
+
+def build_names(plan) -> list:
+    '''Returns the names of the images the plan builds'''
+    return [i['name'] for i in plan['images'] if i['build']]
+
+
+def differences(plan, images) -> list:
+    '''Returns a line for each image whose build decision (from image.plan or image.get) differs from the plan'''
+    planned = {i['name']: i for i in plan['images']}
+    lines = []
+    for image in images:
+        p = planned.get(image['name'], None)
+        if p is None:
+            lines.append(f'{image["name"]} is not in the plan')
+        elif p['build'] != image['build'] or p['version'] != image['version'] or p['fingerprint'] != image['fingerprint']:
+            lines.append(f'{image["name"]} was planned {"to build" if p["build"] else "to skip"} version {p["version"]} '
+                         f'({p["reason"]}) but would now {"build" if image["build"] else "skip"} version {image["version"]} '
+                         f'({image.get("reason", "validated in azure")})')
+    return lines
+
+
+def summary_lines(plan) -> list:
+    '''Returns the lines of a table of the images in the plan, if they'll be built, why, and by which builder'''
+    images = plan['images']
+    width = max([len('image')] + [len(i['name']) for i in images])
+    # layer versions are keyed by their content so they're longer than most
+    version_width = max([10] + [len(i['version']) for i in images])
+    lines = [f'{"image":<{width}}  {"version":<{version_width}}  {"build":<5}  {"builder":<{width}}  reason']
+    for i in images:
+        lines.append(f'{i["name"]:<{width}}  {i["version"]:<{version_width}}  {"yes" if i["build"] else "no":<5}  {i["builder"] or "":<{width}}  {i["reason"]}')
+    return lines
@@ -0,0 +1,226 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import hashlib
+import os
+import platform
+import re
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # windows, only the in-process lock is used
+    fcntl = None
+
+import hcl
+import loggers
+
+PLUGIN_CACHE_DIR = 'packer-plugins'
+
+# bump when the layout of the cache changes so old and new builders don't share a cache
+PLUGIN_CACHE_VERSION = 'v1'
+
+PLUGIN_PATTERN = re.compile(r'^packer-plugin-(?P<type>.+?)_v(?P<version>\d+(?:\.\d+)*(?:-[\w.]+)?)_x(?P<api>\d+\.\d+)'
+                            r'_(?P<os>[a-z0-9]+)_(?P<arch>[a-z0-9]+)(?:\.exe)?$')
+
+CONSTRAINT_PATTERN = re.compile(r'^\s*(?P<op>>=|<=|!=|~>|>|<|=)?\s*v?(?P<version>\d+(?:\.\d+)*)')
+
+ARCHITECTURES = {'x86_64': 'amd64', 'amd64': 'amd64', 'aarch64': 'arm64', 'arm64': 'arm64', 'i386': '386', 'i686': '386'}
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+
+# an explicit PACKER_PLUGIN_PATH is used as the cache instead of the one in storage
+cache_dir = Path(os.environ['PACKER_PLUGIN_PATH']) if os.environ.get('PACKER_PLUGIN_PATH', None) \
+    else storage / PLUGIN_CACHE_DIR / PLUGIN_CACHE_VERSION
+
+stats = {'hits': 0, 'misses': 0}
+
+_thread_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    '''The cache is used unless the builder container is missing the storage volume'''
+    return not (in_builder and not storage.is_dir() and not os.environ.get('PACKER_PLUGIN_PATH', None))
+
+
+def env() -> dict:
+    '''Returns the environment for packer commands so they install and load plugins from the cache'''
+    return dict(os.environ, PACKER_PLUGIN_PATH=str(cache_dir)) if enabled() else None
+
+
+def _platform() -> tuple:
+    machine = platform.machine().lower()
+    return platform.system().lower(), ARCHITECTURES.get(machine, machine)
+
+
+def _version(text) -> tuple:
+    return tuple(int(p) for p in text.lstrip('v').split('-')[0].split('.'))
+
+
+def _pad(version, length) -> tuple:
+    return version + (0,) * (length - len(version))
+
+
+def satisfies(version, constraints) -> bool:
+    '''Returns True if the version (i.e. 1.2.3) satisfies all the comma separated constraints (i.e. >= 1.2, < 2.0.0)'''
+    version = _version(version)
+    for constraint in [c for c in (constraints or '').split(',') if c.strip()]:
+        match = CONSTRAINT_PATTERN.match(constraint)
+        if not match:
+            raise ValueError(f'invalid version constraint {constraint}')
+        op, target = match.group('op') or '=', _version(match.group('version'))
+        length = max(len(version), len(target))
+        v, t = _pad(version, length), _pad(target, length)
+        if op == '~>':  # the right-most specified part can increase
+            upper = target[:-2] + (target[-2] + 1,) if len(target) > 1 else (target[0] + 1,)
+            if not (v >= t and v < _pad(upper, length)):
+                return False
+        elif not {'=': v == t, '!=': v != t, '>': v > t, '>=': v >= t, '<': v < t, '<=': v <= t}[op]:
+            return False
+    return True
+
+
+def _verified(binary) -> bool:
+    '''Returns True if the plugin binary's content matches the checksum packer saved next to it'''
+    checksum = binary.parent / f'{binary.name}_SHA256SUM'
+    if not checksum.is_file():
+        return False
+    expected = checksum.read_text().split()
+    if not expected:
+        return False
+    sha = hashlib.sha256()
+    with open(binary, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest() == expected[0].lower()
+
+
+def installed(source) -> list:
+    '''Returns the versions of a plugin (i.e. github.com/rgl/windows-update) in the cache for this platform'''
+    plugin_dir = cache_dir / source
+    if not plugin_dir.is_dir():
+        return []
+    system, arch = _platform()
+    versions = []
+    for binary in plugin_dir.iterdir():
+        match = PLUGIN_PATTERN.match(binary.name)
+        if match and match.group('os') == system and match.group('arch') == arch and _verified(binary):
+            versions.append(match.group('version'))
+    return versions
+
+
+def missing(image) -> list:
+    '''Returns the names of the image's required plugins that aren't in the cache, or None if the
+    required plugins can't be read from the image's *.pkr.hcl files'''
+    try:
+        required = hcl.required_plugins(image['path'])
+    except hcl.HclError as e:
+        log.warning(f'Unable to read the required plugins for {image["name"]}: {e}')
+        return None
+    return [name for name, plugin in required.items()
+            if not any(satisfies(v, plugin['version']) for v in installed(plugin['source']))]
+
+
+def prune(image):
+    '''Removes cached binaries of the image's required plugins that don't match their checksum (i.e. partial
+    downloads) so packer init installs them again'''
+    try:
+        required = hcl.required_plugins(image['path'])
+    except hcl.HclError:
+        return
+    for plugin in required.values():
+        plugin_dir = cache_dir / plugin['source']
+        if not plugin_dir.is_dir():
+            continue
+        for binary in plugin_dir.iterdir():
+            if PLUGIN_PATTERN.match(binary.name) and not _verified(binary):
+                log.warning(f'Removing packer plugin {binary.name} from the cache because its checksum does not match')
+                binary.unlink()
+                binary.with_name(f'{binary.name}_SHA256SUM').unlink(missing_ok=True)
+
+
+def cached(image) -> bool:
+    '''Returns True if every plugin the image requires is already in the cache'''
+    return enabled() and missing(image) == []
+
+
+def record(image, hit):
+    '''Counts and logs a cache hit or miss for the image'''
+    stats['hits' if hit else 'misses'] += 1
+    if hit:
+        log.info(f'Packer plugin cache hit for {image["name"]}, skipping packer init')
+    else:
+        log.info(f'Packer plugin cache miss for {image["name"]}, installing plugins to {cache_dir}')
+
+
+def _acquire(lock_file):
+    _thread_lock.acquire()
+    try:
+        lock_file.parent.mkdir(parents=True, exist_ok=True)
+        f = open(lock_file, 'a')
+        if fcntl:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+        return f
+    except BaseException:
+        _thread_lock.release()
+        raise
+
+
+def _release(f):
+    try:
+        if fcntl:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+        f.close()
+    finally:
+        _thread_lock.release()
+
+
+@contextmanager
+def lock():
+    '''Holds the cache lock (shared by every thread, task, and container using the cache) while plugins are installed'''
+    if not enabled():
+        yield
+        return
+    f = _acquire(cache_dir.with_suffix('.lock'))
+    try:
+        yield
+    finally:
+        _release(f)
+
+
+@asynccontextmanager
+async def lock_async():
+    '''Holds the cache lock without blocking the event loop while waiting for it'''
+    if not enabled():
+        yield
+        return
+    f = await asyncio.to_thread(_acquire, cache_dir.with_suffix('.lock'))
+    try:
+        yield
+    finally:
+        _release(f)
+
+
+if __name__ == '__main__':
+
+    checks = [('0.14.1', '0.14.1', True), ('0.14.2', '0.14.1', False), ('1.4.2', '>= 1.4.0, < 2.0.0', True),
+              ('2.0.0', '>= 1.4.0, < 2.0.0', False), ('1.2.9', '~> 1.2.3', True), ('1.3.0', '~> 1.2.3', False),
+              ('1.9.0', '~> 1.2', True), ('2.0.0', '~> 1.2', False), ('1.0.0', '', True), ('1.0', '>= 1.0.0', True),
+              ('1.0.1', '!= 1.0.1', False), ('v1.1.0', '> 1.0', True)]
+
+    for version, constraint, expected in checks:
+        if satisfies(version, constraint) != expected:
+            raise ValueError(f'{version} {"should" if expected else "should not"} satisfy {constraint}')
+
+    print(f'{len(checks)} version constraint checks passed')
@@ -0,0 +1,199 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import azure as az
+import image as img
+import loggers
+import tracing
+
+# 'packer' replicates image versions to their replicaLocations during packer build, 'deferred' publishes
+# them only to the build region and leaves the other regions to replicate_async
+REPLICATION = os.environ.get('BUILDER_REPLICATION', 'packer').lower()
+
+# seconds between checks of an image version's replication status
+POLL_INTERVAL = int(os.environ.get('BUILDER_REPLICATION_POLL_INTERVAL', '60'))
+
+# minutes to wait for an image version to replicate to every region
+TIMEOUT = int(os.environ.get('BUILDER_REPLICATION_TIMEOUT', '240'))
+
+# the replication states of a region that won't change
+FINAL_STATES = ['completed', 'failed']
+
+log = loggers.getLogger(__name__)
+
+
+def error_exit(message):
+    log.error(message)
+    sys.exit(message)
+
+
+def deferred() -> bool:
+    '''Returns True if image versions are replicated after packer build instead of during it'''
+    return REPLICATION == 'deferred'
+
+
+def region(name) -> str:
+    '''Returns the name of a region as it's passed to the az cli (i.e. East US -> eastus)'''
+    return name.replace(' ', '').lower()
+
+
+def packer_regions(image) -> list:
+    '''Returns the regions packer replicates the image version to, none (only the build region) when replication is deferred'''
+    return [] if deferred() else image.get('replicaLocations', None) or []
+
+
+def target_regions(image, version) -> list:
+    '''Returns the regions the image version should be replicated to: its build region, the regions it's
+    already replicated to, and the image's replicaLocations'''
+    regions = [region(version['location'])] + _current_regions(version) + [region(r) for r in image.get('replicaLocations', None) or []]
+    return list(dict.fromkeys(regions))
+
+
+def _current_regions(version) -> list:
+    '''Returns the regions the image version is replicated (or replicating) to'''
+    return [region(r['name']) for r in ((version.get('publishingProfile', None) or {}).get('targetRegions', None) or [])]
+
+
+def _status(version) -> dict:
+    '''Returns the state and progress of each region from an image version shown with its replication status'''
+    summary = ((version or {}).get('replicationStatus', None) or {}).get('summary', None) or []
+    return {region(s['region']): (s.get('state', 'Unknown'), s.get('progress', 0)) for s in summary}
+
+
+async def replicate_async(image, interval=POLL_INTERVAL, timeout=TIMEOUT) -> dict:
+    '''Replicates the image version to the image's replicaLocations and waits for each region to be ready.
+    Returns the state of each region and the minutes it took to get there'''
+    name = image['name']
+    start = time.monotonic()
+
+    with loggers.context(image=name, phase='replicate'), tracing.span('replicate', image=name) as span:
+        version = await az.image_version_status_async(image)
+        if version is None:
+            log.error(f'Unable to replicate {name} because version {image["version"]} was not found')
+            span.update(status='missing')
+            return {}
+
+        regions = target_regions(image, version)
+        missing = [r for r in regions if r not in _current_regions(version)]
+        # regions that already failed stay in the version's target regions, updating them again retries them
+        retry = [r for r, (state, _) in _status(version).items() if state.lower() == 'failed' and r in regions]
+
+        if missing or retry:
+            if missing:
+                log.info(f'Replicating {name} version {image["version"]} to {", ".join(missing)}')
+            if retry:
+                log.info(f'Retrying the replication of {name} version {image["version"]} to {", ".join(retry)}')
+            await az.replicate_image_version_async(image, regions)
+            version = await az.image_version_status_async(image, log_command=False)
+        else:
+            log.info(f'{name} version {image["version"]} already targets {", ".join(regions)}')
+
+        results = {}
+        progress = {}
+
+        while True:
+            minutes = (time.monotonic() - start) / 60
+            status = _status(version)
+
+            for r in regions:
+                if r in results:
+                    continue
+                state, percent = status.get(r, ('Unknown', 0))
+                if state.lower() in FINAL_STATES:
+                    results[r] = {'state': state, 'minutes': minutes}
+                    if state.lower() == 'completed':
+                        log.info(f'{name} version {image["version"]} is ready in {r} after {minutes:.1f} minutes')
+                    else:
+                        log.error(f'{name} version {image["version"]} failed to replicate to {r}')
+                elif progress.get(r, None) != percent:
+                    progress[r] = percent
+                    log.info(f'{name} version {image["version"]} is {percent}% replicated to {r}')
+
+            if len(results) == len(regions):
+                break
+
+            if minutes >= timeout:
+                for r in regions:
+                    if r not in results:
+                        log.error(f'{name} version {image["version"]} did not replicate to {r} within {timeout} minutes')
+                        results[r] = {'state': 'TimedOut', 'minutes': minutes}
+                break
+
+            await asyncio.sleep(interval)
+            version = await az.image_version_status_async(image, log_command=False)
+
+        span.update(regions=len(regions), ready=len([r for r in results.values() if r['state'].lower() == 'completed']))
+
+    return results
+
+
+async def replicate_all_async(images, interval=POLL_INTERVAL, timeout=TIMEOUT) -> dict:
+    '''Replicates the image versions concurrently, returns the results of replicate_async by image name'''
+    results = await asyncio.gather(*[replicate_async(i, interval, timeout) for i in images])
+    return {i['name']: r for i, r in zip(images, results)}
+
+
+def failed(results) -> list:
+    '''Returns the names of the images that aren't ready in every region'''
+    return [name for name, regions in results.items() if not regions or any(r['state'].lower() != 'completed' for r in regions.values())]
+
+
+def report_lines(results) -> list:
+    '''Returns the lines of a table with the replication state of each image in each region'''
+    rows = [(name, r, s['state'], f'{s["minutes"]:.1f}') for name, regions in results.items() for r, s in regions.items()]
+    rows += [(name, '', 'NotFound', '') for name, regions in results.items() if not regions]
+    width = max([len('image')] + [len(r[0]) for r in rows])
+    region_width = max([len('region')] + [len(r[1]) for r in rows])
+    lines = [f'{"image":<{width}}  {"region":<{region_width}}  {"state":<10}  {"minutes":>7}']
+    for name, r, state, minutes in rows:
+        lines.append(f'{name:<{width}}  {r:<{region_width}}  {state:<10}  {minutes:>7}')
+    return lines
+
+
+async def main_async(names, gallery, common, interval=POLL_INTERVAL, timeout=TIMEOUT) -> dict:
+    images = [img.get(n, gallery, common) for n in names]
+
+    sub = None
+    for image in images:
+        if not image.get('subscription', None):
+            sub = sub or await az.get_sub_async()
+            image['subscription'] = sub
+        if not image['gallery'].get('subscription', None):
+            image['gallery']['subscription'] = image['subscription']
+
+    return await replicate_all_async(images, interval, timeout)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Replicate the published versions of images to their replicaLocations and wait for every region to be ready. '
+                                     'Used to finish the replication of images built with BUILDER_REPLICATION=deferred')
+    parser.add_argument('--images', '-i', nargs='*', help='names of images to replicate. if not specified all images will be')
+    parser.add_argument('--interval', type=int, default=POLL_INTERVAL, help='seconds between checks of the replication status')
+    parser.add_argument('--timeout', type=int, default=TIMEOUT, help='minutes to wait for every region to be ready')
+
+    args = parser.parse_args()
+
+    names = args.images if args.images else img.image_names()
+
+    gallery = img.get_gallery()
+    common = img.get_common()
+
+    with tracing.span('replication', images=names):
+        results = asyncio.run(main_async(names, gallery, common, args.interval, args.timeout))
+
+    log.info('Replication report:')
+    for line in report_lines(results):
+        log.info(line)
+
+    failures = failed(results)
+    if failures:
+        error_exit(f'{len(failures)} {"image" if len(failures) == 1 else "images"} failed to replicate: {failures}')
@@ -0,0 +1,250 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import random
+import statistics
+from pathlib import Path
+
+import loggers
+
+HISTORY_FILE = 'build_history.json'
+
+# expected build duration (in minutes) for images without any build history
+DEFAULT_DURATION = 180
+
+# number of recent builds per image used to estimate the next build duration
+HISTORY_SAMPLES = 5
+
+POLICIES = ['longest', 'fifo']
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+
+history_file = storage / HISTORY_FILE
+
+
+def _load_history() -> dict:
+    if not history_file.is_file():
+        return {}
+    try:
+        with open(history_file, 'r') as f:
+            return json.load(f)
+    except (json.decoder.JSONDecodeError, OSError):
+        log.warning(f'Ignoring unreadable build history {history_file}')
+        return {}
+
+
+def expected_duration(name, history=None, default=DEFAULT_DURATION) -> float:
+    '''Returns the expected build duration (in minutes) for an image from its recent build history'''
+    history = _load_history() if history is None else history
+    durations = history.get(name, [])[-HISTORY_SAMPLES:]
+    return statistics.median(durations) if durations else default
+
+
+def record_duration(name, minutes):
+    '''Adds a build duration (in minutes) to the image's build history'''
+    history = _load_history()
+    history.setdefault(name, []).append(round(minutes, 2))
+    history[name] = history[name][-HISTORY_SAMPLES * 4:]
+
+    storage.mkdir(parents=True, exist_ok=True)
+    temp = history_file.with_suffix(f'.{os.getpid()}.tmp')
+    with open(temp, 'w') as f:
+        json.dump(history, f, indent=4, sort_keys=True)
+    os.replace(temp, history_file)
+
+
+def job(name, region=None, priority=0, duration=None, history=None, default=DEFAULT_DURATION, after=None) -> dict:
+    '''Creates a job to schedule, using the image's build history for the expected duration if none is provided.
+    The job doesn't start until the jobs named in after (i.e. the builders of its base layers) have finished'''
+    return {
+        'name': name,
+        'region': region.lower() if region else None,
+        'priority': priority,
+        'duration': duration if duration is not None else expected_duration(name, history, default),
+        'after': list(after) if after else []
+    }
+
+
+def _paths(jobs) -> dict:
+    '''Returns the expected duration of each job plus the longest chain of jobs that run after it by name'''
+    paths = {}
+
+    def _path(job):
+        if job['name'] not in paths:
+            after = [_path(j) for j in jobs if job['name'] in j.get('after', [])]
+            paths[job['name']] = job['duration'] + max(after, default=0)
+        return paths[job['name']]
+
+    for job in jobs:
+        _path(job)
+    return paths
+
+
+def order(jobs, policy='longest') -> list:
+    '''Orders jobs for dispatch. longest: highest priority first, then longest expected duration (including the jobs
+    that run after it) first. fifo: as provided'''
+    if policy == 'fifo':
+        return list(jobs)
+    if policy == 'longest':
+        paths = _paths(jobs)
+        return sorted(jobs, key=lambda j: (-j['priority'], -paths[j['name']], j['name']))
+    raise ValueError(f'unknown scheduling policy {policy}, must be one of {POLICIES}')
+
+
+def _can_start(job, running, max_concurrent=None, region_caps=None, finished=None) -> bool:
+    if any(name not in (finished or []) for name in job.get('after', [])):
+        return False
+    if max_concurrent and len(running) >= max_concurrent:
+        return False
+    if region_caps and job['region'] in region_caps:
+        return sum(1 for r in running if r['region'] == job['region']) < region_caps[job['region']]
+    return True
+
+
+def _next(pending, running, max_concurrent=None, region_caps=None, finished=None) -> list:
+    '''Removes and returns the pending jobs (in order) that can start given the jobs that are running (and finished)'''
+    started = []
+    for job in list(pending):
+        if _can_start(job, running + started, max_concurrent, region_caps, finished):
+            pending.remove(job)
+            started.append(job)
+    return started
+
+
+def _validate(jobs, region_caps):
+    names = [j['name'] for j in jobs]
+    for job in jobs:
+        if region_caps and region_caps.get(job['region'], 1) < 1:
+            raise ValueError(f'region cap for {job["region"]} must be at least 1 to run {job["name"]}')
+        for name in job.get('after', []):
+            if name not in names:
+                raise ValueError(f'{job["name"]} runs after {name} but there is no job named {name}')
+
+    # every job has to be able to start once the jobs it runs after finish
+    finished = []
+    pending = list(jobs)
+    while pending:
+        ready = [j for j in pending if all(name in finished for name in j.get('after', []))]
+        if not ready:
+            raise ValueError(f'jobs run after each other: {[j["name"] for j in pending]}')
+        for job in ready:
+            pending.remove(job)
+            finished.append(job['name'])
+
+
+async def run(jobs, worker, max_concurrent=None, region_caps=None, policy='longest') -> dict:
+    '''Runs worker(job) for each job, dispatching in policy order while respecting the concurrency and
+    per-region limits. Returns a dict of job name -> worker result'''
+    _validate(jobs, region_caps)
+
+    pending = order(jobs, policy)
+    running = {}
+    results = {}
+
+    while pending or running:
+        for job in _next(pending, list(running.values()), max_concurrent, region_caps, results):
+            log.info(f'Starting {job["name"]} (expected {job["duration"]:.0f} minutes, {len(pending)} waiting)')
+            running[asyncio.ensure_future(worker(job))] = job
+
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+
+        for task in done:
+            job = running.pop(task)
+            results[job['name']] = task.result()
+
+    return results
+
+
+def simulate(jobs, max_concurrent=None, region_caps=None, policy='longest') -> dict:
+    '''Replays jobs with their actual durations (or the expected duration if actual isn't set) and returns the
+    makespan and when each job starts and finishes (in minutes)'''
+    _validate(jobs, region_caps)
+
+    pending = order(jobs, policy)
+    running = []  # heap of (finish, name)
+    by_name = {j['name']: j for j in jobs}
+    timeline = {}
+    now = 0.0
+
+    finished = []
+
+    while pending or running:
+        for job in _next(pending, [by_name[n] for _, n in running], max_concurrent, region_caps, finished):
+            finish = now + job.get('actual', job['duration'])
+            timeline[job['name']] = {'start': now, 'finish': finish}
+            heapq.heappush(running, (finish, job['name']))
+
+        now, name = heapq.heappop(running)
+        finished.append(name)
+        while running and running[0][0] == now:
+            finished.append(heapq.heappop(running)[1])
+
+    return {'policy': policy, 'makespan': now, 'jobs': timeline}
+
+
+def parse_caps(values) -> dict:
+    '''Parses region=count values into a dict of region caps'''
+    caps = {}
+    for value in values or []:
+        region, cap = value.split('=')
+        caps[region.strip().lower()] = int(cap)
+    return caps
+
+
+def parse_priorities(values) -> dict:
+    '''Parses name=priority values into a dict of image priorities'''
+    priorities = {}
+    for value in values or []:
+        name, priority = value.split('=')
+        priorities[name.strip()] = int(priority)
+    return priorities
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Simulate scheduling a set of image builds to compare scheduling policies offline')
+    parser.add_argument('--jobs', '-j', help='path to a json file with a list of jobs ({"name", "duration", "actual", "region", "priority"}). '
+                        'duration is the expected duration used to order jobs, actual is the duration used in the simulation. if not specified, random jobs are generated')
+    parser.add_argument('--count', '-n', type=int, default=40, help='number of random jobs to generate when --jobs is not specified')
+    parser.add_argument('--seed', type=int, default=0, help='seed for generating random jobs')
+    parser.add_argument('--max-concurrent', '-m', type=int, default=8, help='maximum number of builds to run at once')
+    parser.add_argument('--region-cap', nargs='*', help='maximum number of builds to run at once in a region in the form region=count')
+
+    args = parser.parse_args()
+
+    jobs = []
+
+    if args.jobs:
+        with open(args.jobs, 'r') as f:
+            for j in json.load(f):
+                jobs.append(job(j['name'], j.get('region'), j.get('priority', 0), j.get('duration', DEFAULT_DURATION)))
+                if 'actual' in j:
+                    jobs[-1]['actual'] = j['actual']
+    else:
+        rand = random.Random(args.seed)
+        regions = ['eastus', 'westus', 'westeurope']
+        for i in range(args.count):
+            expected = rand.choice([45, 60, 90, 120, 180, 240])
+            jobs.append(job(f'Image{i}', rand.choice(regions), 0, expected))
+            jobs[-1]['actual'] = expected * rand.uniform(0.8, 1.25)
+
+    caps = parse_caps(args.region_cap)
+
+    print('')
+    for policy in POLICIES:
+        result = simulate(jobs, args.max_concurrent, caps, policy)
+        print(f'{policy:>8}: makespan {result["makespan"]:.0f} minutes')
+    print('')
@@ -0,0 +1,112 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+from collections import deque
+
+import loggers
+
+# maximum number of bytes of a single line held in memory at once, longer lines are forwarded in pieces
+STREAM_LIMIT = 64 * 1024
+
+# number of stderr lines kept to return to the caller (i.e. for error messages)
+STDERR_TAIL_LINES = 200
+
+log = loggers.getLogger(__name__)
+
+
+def _log_sink(name):
+    prefix = f'[{name}] ' if name else ''
+
+    def _sink(stream, line):
+        log.info(f'{prefix}{line}')
+
+    return _sink
+
+
+async def _read_lines(reader, on_line):
+    '''Reads a stream line by line without ever holding more than STREAM_LIMIT bytes of a line'''
+    while True:
+        try:
+            line = await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:  # eof, forward whatever is left
+            if e.partial:
+                on_line(e.partial)
+            return
+        except asyncio.LimitOverrunError as e:  # line is longer than the limit, forward the part we have
+            line = await reader.readexactly(e.consumed)
+        on_line(line)
+
+
+async def run_async(args, name=None, capture=False, sink=None, env=None):
+    '''Runs a command, forwarding its stdout and stderr line by line to sink(stream, line) as they arrive (by default
+    they're logged, prefixed with name, and if sink is False they aren't forwarded). Returns the exit code, stdout (if
+    capture is True, otherwise None), and the last STDERR_TAIL_LINES lines of stderr'''
+    sink = _log_sink(name) if sink is None else sink
+    stdout = [] if capture else None
+    stderr = deque(maxlen=STDERR_TAIL_LINES)
+
+    def _on_stdout(data):
+        if capture:
+            stdout.append(data)
+        if sink is not False:
+            sink('stdout', data.decode(errors='replace').rstrip('\r\n'))
+
+    def _on_stderr(data):
+        line = data.decode(errors='replace').rstrip('\r\n')
+        stderr.append(line)
+        if sink is not False:
+            sink('stderr', line)
+
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                limit=STREAM_LIMIT, env=env)
+
+    await asyncio.gather(_read_lines(proc.stdout, _on_stdout), _read_lines(proc.stderr, _on_stderr))
+    returncode = await proc.wait()
+
+    return returncode, b''.join(stdout).decode() if capture else None, '\n'.join(stderr)
+
+
+if __name__ == '__main__':
+
+    import resource
+    import sys
+    import time
+
+    def _peak_rss_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    counts = {'lines': 0, 'bytes': 0}
+
+    def _count(stream, line):
+        counts['lines'] += 1
+        counts['bytes'] += len(line)
+
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+    # write size_mb of 100 byte lines, then a single line 4 times the size of the limit, then a line to stderr
+    script = (f'import sys\nline = "x" * 99 + "\\n"\nchunk = line * 10000\n'
+              f'for _ in range({size_mb} * 1024 * 1024 // len(chunk)): sys.stdout.write(chunk)\n'
+              f'sys.stdout.write("y" * {STREAM_LIMIT * 4} + "\\n")\nsys.stderr.write("done\\n")\n')
+
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+
+    returncode, stdout, stderr = asyncio.run(run_async([sys.executable, '-c', script], sink=_count))
+
+    elapsed = time.perf_counter() - start
+    growth = _peak_rss_mb() - baseline
+
+    print('')
+    print(f'streamed {counts["bytes"] / 1024 / 1024:.0f}MB in {counts["lines"]} lines in {elapsed:.1f}s')
+    print(f'peak rss grew by {growth:.1f}MB')
+    print('')
+
+    if returncode != 0 or stdout is not None or stderr != 'done':
+        raise ValueError(f'unexpected result: {returncode}, {stdout}, {stderr}')
+    if counts['bytes'] < size_mb * 1024 * 1024 * 0.95:
+        raise ValueError(f'only {counts["bytes"]} bytes were streamed')
+    if growth > 32:
+        raise ValueError(f'peak rss grew by {growth:.1f}MB while streaming {size_mb}MB')
@@ -5,12 +5,20 @@
 
 import os
 import sys
+from collections import OrderedDict
 from pathlib import Path
 
 import loggers
 
+# maximum number of parsed files to keep in the cache
+CACHE_SIZE = 128
+
+QUOTES = '\'"'
+
 log = loggers.getLogger(__name__)
 
+_cache = OrderedDict()
+
 
 def error_exit(message):
     log.error(message)
@@ -58,63 +66,125 @@ def validate(path, obj, required=None, allowed=None):
     return True
 
 
-def parse(path, required=None, allowed=None) -> dict:
-    '''simple yaml parser, only supports a single level of nesting and arrays that use the '-' notation'''
-    obj = {}
-    with open(path, 'r') as yaml:
-        parent_key = None
+def _tokenize(text, path=None) -> list:
+    '''Returns a (line number, indent, is array item, key, value) token for each line that isn't blank or a comment'''
+    tokens = []
+    for number, line in enumerate(text.splitlines(), 1):
+        content = line.lstrip(' ')
+        if not content or content[0] == '#':  # ignore empty lines and comments
+            continue
 
-        for line in yaml:
-            if line.strip() == '' or line.lstrip().startswith('#'):  # ignore empty lines and comments
-                continue
+        indent = len(line) - len(content)
+        item = content[0] == '-' and (len(content) == 1 or content[1] in ' \t')
 
-            if line.lstrip().startswith('-'):  # array item
-                if not parent_key:
-                    error_exit(f'array item found without parent key\n{line}')
+        if item:  # array item (ex: - value || - key: value), indented to the column of the value after the '-'
+            rest = content[1:].lstrip()
+            if not rest:
+                error_exit(f'yaml file at {path} has an empty array item on line {number}\n{line}')
+            indent += len(content) - len(rest)
+            content = rest
 
-                if parent_key not in obj:
-                    obj[parent_key] = []
+        key, sep, value = content.partition(':')
 
-                item = line.split('-')[1].strip()
+        if sep and (not item or not value or value[0] == ' '):  # key: value || key: || - key: value (but not - http://...)
+            key, value = key.rstrip(), value.strip()
+        elif item:  # simple array item
+            key, value = None, content.rstrip()
+        elif content.isspace():
+            continue
+        elif content[0] == '\t':
+            error_exit(f'yaml file at {path} uses tabs for indentation on line {number}\n{line}')
+        else:
+            error_exit(f'line does not contain a colon or is misformatted\n{line}')
 
-                if ':' in item:  # object array (ex: - name: value)
-                    s_key, s_value = [s.strip() for s in item.split(':')]
-                    # if the array is empty or the last item in the array already has the key, add a new item
-                    if len(obj[parent_key]) == 0 or s_key in obj[parent_key][-1]:
-                        obj[parent_key].append({})
+        if value and value[0] in QUOTES and value[-1] == value[0] and len(value) > 1:  # quoted string
+            value = value[1:-1]
 
-                    obj[parent_key][-1][s_key] = s_value
-                else:  # simple array (ex: - value)
-                    obj[parent_key].append(item)
+        tokens.append((number, indent, item, key, value))
 
-            elif ':' in line:  # key: value || key: { ... } || key: [ ... ]
+    return tokens
 
-                key, value = [s.strip() for s in line.split(':')]
 
-                if line.replace(line.lstrip(), '') != '':  # key is indented (property of an object)
+def _parse_block(tokens, i, indent, path):
+    '''Parses the tokens starting at i that make up an object or array at the indent, returns it and the next index'''
+    if tokens[i][2]:  # array
+        result = []
+        while i < len(tokens) and tokens[i][1] == indent and tokens[i][2]:
+            number, _, _, key, value = tokens[i]
+            if key is None:  # simple array item
+                result.append(value)
+                i += 1
+            else:  # object array item, the rest of the object's properties are at the same indent as the first
+                obj, i = _parse_object(tokens, i, indent, path, first_item=True)
+                result.append(obj)
+        return result, i
 
-                    if not parent_key:
-                        error_exit(f'line appears to be a property of an object but no key found in previous lines\n{line}')
-                    if not value:
-                        error_exit(f'line appears to be a property of an object but no value found\n{line}')
+    return _parse_object(tokens, i, indent, path)
 
-                    if parent_key not in obj:
-                        obj[parent_key] = {}
 
-                    if isinstance(obj[parent_key], list):
-                        obj[parent_key][-1][key] = value
-                    elif isinstance(obj[parent_key], dict):
-                        obj[parent_key][key] = value
+def _parse_object(tokens, i, indent, path, first_item=False):
+    obj = {}
+    while i < len(tokens) and tokens[i][1] == indent and (first_item or not tokens[i][2]):
+        number, _, _, key, value = tokens[i]
+        if key is None:
+            error_exit(f'yaml file at {path} has an array item where a property was expected on line {number}')
+        first_item = False
+        i += 1
+
+        if value:  # simple key/value pair
+            obj[key] = value
+        elif i < len(tokens) and tokens[i][1] > indent:  # nested object or array
+            obj[key], i = _parse_block(tokens, i, tokens[i][1], path)
+        # else: key with no value and no children is ignored
+
+    if i < len(tokens) and tokens[i][1] > indent:
+        error_exit(f'yaml file at {path} has unexpected indentation on line {tokens[i][0]}')
+
+    return obj, i
+
+
+def _copy(obj):
+    '''Copies parsed yaml (only dicts, lists, and strings) much faster than copy.deepcopy'''
+    if isinstance(obj, dict):
+        return {k: _copy(v) if v.__class__ is not str else v for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_copy(v) if v.__class__ is not str else v for v in obj]
+    return obj
 
-                elif not value:  # object or array, save the key for later
-                    parent_key = key
 
-                else:  # simple key/value pair
-                    obj[key] = value
-                    parent_key = None
+def _parse_file(path) -> dict:
+    with open(path, 'r') as yaml:
+        tokens = _tokenize(yaml.read(), path)
 
-            else:
-                error_exit(f'line does not contain a colon or is misformatted\n{line}')
+    if not tokens:
+        return {}
+
+    if tokens[0][1] != 0 or tokens[0][2]:
+        error_exit(f'yaml file at {path} must contain an object at the root')
+
+    obj, i = _parse_object(tokens, 0, 0, path)
+
+    if i < len(tokens):
+        error_exit(f'yaml file at {path} has unexpected indentation on line {tokens[i][0]}')
+
+    return obj
+
+
+def parse(path, required=None, allowed=None) -> dict:
+    '''simple yaml parser, supports nested objects, arrays that use the '-' notation, and string values.
+    parsed files are cached (by path, modified time, and size) for the life of the process'''
+    stat = os.stat(path)
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+
+    if key in _cache:
+        _cache.move_to_end(key)
+    else:
+        _cache[key] = _parse_file(path)
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    # callers modify the object (i.e. merging common properties) so always return a copy
+    obj = _copy(_cache[key])
 
     validate(path, obj, required, allowed)
 
@@ -0,0 +1,168 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import os
+import random
+import re
+import time
+
+import loggers
+
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+
+THROTTLED_CODES = ['TooManyRequests', 'SubscriptionRequestsThrottled', 'ResourceRequestsThrottled', 'RequestRateTooLarge']
+TRANSIENT_CODES = ['InternalServerError', 'ServiceUnavailable', 'GatewayTimeout', 'BadGateway']
+
+# only the top level error of the az cli's stderr is classified, the codes of inner errors (i.e. those of the resources
+# in a failed deployment) are indented under 'Exception Details' and aren't matched
+ERROR_CODE_PATTERN = re.compile(r'^ERROR: \((\w+)\)|^Code: (\w+)', re.MULTILINE)
+RETRY_AFTER_PATTERN = re.compile(r'retry[- ]after\D{0,3}(\d+(?:\.\d+)?)', re.IGNORECASE)
+
+# concurrency window (number of calls allowed in flight) limits
+INITIAL_WINDOW = int(os.environ.get('BUILDER_AZ_CONCURRENCY', '8'))
+MIN_WINDOW = 1
+MAX_WINDOW = int(os.environ.get('BUILDER_AZ_MAX_CONCURRENCY', '32'))
+
+MAX_RETRIES = int(os.environ.get('BUILDER_AZ_MAX_RETRIES', '6'))
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+log = loggers.getLogger(__name__)
+
+
+def error_code(message):
+    '''Returns the code of the top level error in az cli stderr, or None'''
+    match = ERROR_CODE_PATTERN.search(message) if message else None
+    return (match.group(1) or match.group(2)) if match else None
+
+
+def classify(message, status=None, code=None):
+    '''Returns THROTTLED or TRANSIENT if the error (az cli stderr or arm status and code) should be retried, otherwise None'''
+    if status == 429:
+        return THROTTLED
+    if status in [500, 502, 503, 504]:
+        return TRANSIENT
+    code = code or error_code(message)
+    if code in THROTTLED_CODES:
+        return THROTTLED
+    if code in TRANSIENT_CODES:
+        return TRANSIENT
+    return None
+
+
+def retry_after(message):
+    '''Returns the number of seconds in a retry after hint in the error message, or None'''
+    match = RETRY_AFTER_PATTERN.search(message) if message else None
+    return float(match.group(1)) if match else None
+
+
+class RetryableError(Exception):
+    '''Raised by a call to the controller to have it retried'''
+
+    def __init__(self, kind, message, delay=None):
+        self.kind = kind
+        self.delay = delay
+        super().__init__(message)
+
+
+class Controller:
+    '''Limits the number of calls in flight with an additive-increase/multiplicative-decrease window and retries
+    throttled and transient failures with jittered exponential backoff that honours retry after hints'''
+
+    def __init__(self, window=INITIAL_WINDOW, min_window=MIN_WINDOW, max_window=MAX_WINDOW,
+                 max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.in_flight = 0
+        self.counters = {'calls': 0, 'retries': 0, 'throttled': 0, 'transient': 0, 'failed': 0,
+                         'increases': 0, 'decreases': 0}
+
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._condition = None
+        self._loop = None
+
+    def _get_condition(self):
+        # created lazily (and again for each new event loop) so the controller can be created outside of an event loop
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+            self.in_flight = 0
+        return self._condition
+
+    async def _acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < self.window)
+            self.in_flight += 1
+
+    async def _release(self):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def _on_success(self):
+        self._successes += 1
+        if self._successes >= self.window and self.window < self.max_window:  # one more per window of successes
+            self._successes = 0
+            self.window += 1
+            self.counters['increases'] += 1
+
+    def _on_throttled(self):
+        self._successes = 0
+        # calls that were already in flight get throttled together, so only decrease once for them
+        if time.monotonic() - self._last_decrease < self.base_delay:
+            return
+        window = max(self.min_window, self.window // 2)
+        if window < self.window:
+            self._last_decrease = time.monotonic()
+            log.warning(f'az calls are being throttled, reducing concurrency from {self.window} to {window}')
+            self.window = window
+            self.counters['decreases'] += 1
+
+    def _delay(self, attempt, hint=None):
+        backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = random.uniform(backoff / 2, backoff)  # jitter so retries don't arrive together
+        return max(delay, hint) if hint else delay
+
+    async def call(self, fn, *args):
+        '''Awaits fn(*args) within the concurrency window, retrying when it raises a RetryableError'''
+        self.counters['calls'] += 1
+        attempt = 0
+
+        while True:
+            await self._acquire()
+            try:
+                result = await fn(*args)
+                self._on_success()
+                return result
+            except RetryableError as e:
+                self.counters[e.kind] += 1
+                if e.kind == THROTTLED:
+                    self._on_throttled()
+                if attempt >= self.max_retries:
+                    self.counters['failed'] += 1
+                    raise
+                delay = self._delay(attempt, e.delay)
+                log.warning(f'Retrying {e.kind} az call in {delay:.1f} seconds (attempt {attempt + 1} of {self.max_retries})')
+            finally:
+                await self._release()
+
+            self.counters['retries'] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        '''Returns the controller counters and current concurrency window'''
+        return dict(self.counters, window=self.window, in_flight=self.in_flight)
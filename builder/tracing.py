@@ -0,0 +1,203 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import argparse
+import asyncio
+import atexit
+import contextvars
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import loggers
+
+# set to false to stop recording spans and writing the trace file
+TRACE = os.environ.get('BUILDER_TRACE', 'true').lower() not in ['0', 'false', 'no']
+
+# shared by the orchestrator and the builder containers it deploys so their traces can be merged
+trace_id = os.environ.get('BUILDER_TRACE_ID', None) or uuid.uuid4().hex
+
+log = loggers.getLogger(__name__)
+
+# indicates if the script is running in the docker container
+in_builder = os.environ.get('ACI_IMAGE_BUILDER', False)
+
+repo = Path('/mnt/repo') if in_builder else Path(__file__).resolve().parent.parent
+storage = Path('/mnt/storage') if in_builder else repo / '.local' / 'storage'
+
+# written next to the log file
+trace_file = storage / f'trace_{loggers.timestamp}.json'
+
+_pid = os.getpid()
+_enabled = False
+_events = []
+_lanes = {}
+_lock = threading.Lock()
+_current = contextvars.ContextVar('trace_span', default=None)
+
+# span timestamps are wall clock microseconds (so traces from different machines line up) measured with perf_counter
+_epoch = time.time() * 1e6
+_perf = time.perf_counter()
+
+
+def _now() -> float:
+    return _epoch + (time.perf_counter() - _perf) * 1e6
+
+
+def _lane() -> int:
+    '''Returns the trace thread id for the current async task (or thread), spans in one task always nest'''
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    key = id(task) if task else threading.get_ident()
+    with _lock:
+        lane = _lanes.get(key, None)
+        if lane is None:
+            lane = _lanes[key] = len(_lanes) + 1
+            name = loggers.current('image') or (task.get_name() if task else threading.current_thread().name)
+            _events.append({'ph': 'M', 'name': 'thread_name', 'pid': _pid, 'tid': lane, 'args': {'name': name}})
+    return lane
+
+
+@contextmanager
+def span(name, **fields):
+    '''Records the time spent in the context as a span named after the phase (i.e. az, packer build). The fields
+    (and the image from the log context) are added to the span, yields the fields so more can be added'''
+    fields = {k: v for k, v in fields.items() if v is not None}
+    if not _enabled:
+        yield fields
+        return
+
+    image = loggers.current('image')
+    if image and 'image' not in fields:
+        fields['image'] = image
+
+    lane = _lane()
+    token = _current.set(fields)
+    start = _now()
+    try:
+        yield fields
+    except BaseException as e:
+        fields.setdefault('error', str(e.code if isinstance(e, SystemExit) else e) or type(e).__name__)
+        raise
+    finally:
+        _events.append({'name': name, 'cat': name.split()[0], 'ph': 'X', 'ts': start, 'dur': _now() - start,
+                        'pid': _pid, 'tid': lane, 'args': fields})
+        _current.reset(token)
+
+
+def annotate(**fields):
+    '''Adds fields (i.e. exit_code) to the innermost span of the current context'''
+    current = _current.get()
+    if current is not None:
+        current.update(fields)
+
+
+def events() -> list:
+    '''Returns the spans recorded so far'''
+    return [e for e in _events if e['ph'] == 'X']
+
+
+def trace(name=None) -> dict:
+    '''Returns the recorded spans as a chrome trace (open in chrome://tracing or ui.perfetto.dev)'''
+    name = name if name else f'{Path(sys.argv[0]).stem} ({socket.gethostname()})'
+    metadata = [{'ph': 'M', 'name': 'process_name', 'pid': _pid, 'tid': 0, 'args': {'name': name}}]
+    return {'traceEvents': metadata + list(_events), 'displayTimeUnit': 'ms', 'otherData': {'traceId': trace_id}}
+
+
+def save(path=None) -> Path:
+    '''Writes the chrome trace to the path (by default next to the log file)'''
+    path = Path(path) if path else trace_file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_suffix(f'.{_pid}.tmp')
+    with open(temp, 'w') as f:
+        json.dump(trace(), f)
+    os.replace(temp, path)
+    return path
+
+
+def summary(spans=None) -> list:
+    '''Returns the count, total, mean, and max duration (in seconds) of each phase, longest total first'''
+    phases = {}
+    for e in spans if spans is not None else events():
+        phases.setdefault(e['name'], []).append(e['dur'] / 1e6)
+    rows = [{'phase': n, 'count': len(d), 'total': sum(d), 'mean': sum(d) / len(d), 'max': max(d)} for n, d in phases.items()]
+    return sorted(rows, key=lambda r: -r['total'])
+
+
+def summary_lines(spans=None) -> list:
+    '''Returns the lines of a table of the time spent in each phase. Phases run concurrently so totals can exceed the wall time'''
+    rows = summary(spans)
+    width = max([len('phase')] + [len(r['phase']) for r in rows])
+    lines = [f'{"phase":<{width}}  {"count":>6}  {"total s":>9}  {"mean s":>8}  {"max s":>8}']
+    for r in rows:
+        lines.append(f'{r["phase"]:<{width}}  {r["count"]:>6}  {r["total"]:>9.2f}  {r["mean"]:>8.2f}  {r["max"]:>8.2f}')
+    return lines
+
+
+def merge(traces) -> dict:
+    '''Merges chrome traces (i.e. from the orchestrator and its builder containers), giving each its own process'''
+    merged = {'traceEvents': [], 'displayTimeUnit': 'ms', 'otherData': {'traceId': None}}
+    for i, t in enumerate(traces, start=1):
+        tid = t.get('otherData', {}).get('traceId', None)
+        if merged['otherData']['traceId'] is None:
+            merged['otherData']['traceId'] = tid
+        elif tid != merged['otherData']['traceId']:
+            log.warning(f'Merging traces with different trace ids {merged["otherData"]["traceId"]} and {tid}')
+        # pids from different machines (or containers) can collide
+        merged['traceEvents'].extend(dict(e, pid=i) for e in t['traceEvents'])
+    return merged
+
+
+def _finish():
+    if not events():
+        return
+    if in_builder and not storage.is_dir():
+        log.warning(f'Not saving the trace because {storage} is missing')
+    else:
+        log.info(f'Saved trace {trace_id} to {save()}')
+    log.info('Time spent in each phase:')
+    for line in summary_lines():
+        log.info(line)
+
+
+def enable():
+    '''Starts recording spans and saves the trace when the process exits. Only called by the scripts that
+    write traces (build.py and builder.py) so other processes that import the builder modules don't'''
+    global _enabled
+    if not TRACE or _enabled:
+        return
+    _enabled = True
+    # registered after loggers (imported above) so the summary is logged before the listener stops
+    atexit.register(_finish)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Merge the chrome traces of a build (i.e. from the orchestrator and the builder containers) and print the time spent in each phase')
+    parser.add_argument('traces', nargs='+', help='paths of the trace files')
+    parser.add_argument('--output', '-o', help='path to write the merged trace to')
+
+    args = parser.parse_args()
+
+    traces = []
+    for path in args.traces:
+        with open(path, 'r') as f:
+            traces.append(json.load(f))
+
+    merged = merge(traces)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(merged, f)
+
+    print('\n'.join(summary_lines([e for e in merged['traceEvents'] if e['ph'] == 'X'])))
@@ -0,0 +1,98 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+'''Benchmarks the builder's arm transport against the fake arm endpoint (and optionally az cli start-up time)'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+tools = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(tools / 'fakes'))
+sys.path.insert(0, str(tools.parent / 'builder'))
+
+import arm_server  # noqa: E402
+
+SUBSCRIPTION = '00000000-0000-0000-0000-000000000000'
+
+
+def _gallery_resources(count):
+    gallery = f'/subscriptions/{SUBSCRIPTION}/resourceGroups/Bench-Gallery/providers/Microsoft.Compute/galleries/Bench'
+    resources = {f'/subscriptions/{SUBSCRIPTION}/resourcegroups/Bench-Gallery': {'location': 'eastus'}}
+    for i in range(count):
+        resources[f'{gallery}/images/Image{i}'] = {'location': 'eastus', 'properties': {'osType': 'Windows'}}
+        if i % 2:  # every other image already has the version
+            resources[f'{gallery}/images/Image{i}/versions/1.0.0'] = {'location': 'eastus'}
+    return resources
+
+
+def _profile_dir():
+    config_dir = Path(tempfile.mkdtemp(prefix='azconfig'))
+    profile = {'subscriptions': [{'id': SUBSCRIPTION, 'name': 'bench', 'isDefault': True, 'state': 'Enabled'}]}
+    with open(config_dir / 'azureProfile.json', 'w') as f:
+        json.dump(profile, f)
+    return config_dir
+
+
+def bench_arm(count, latency):
+    server = arm_server.serve(latency=latency, resources=_gallery_resources(count))
+
+    os.environ['BUILDER_ARM_ENDPOINT'] = server.endpoint
+    os.environ['BUILDER_ARM_TOKEN'] = 'fake'
+    os.environ['AZURE_CONFIG_DIR'] = str(_profile_dir())
+
+    import azure as az  # pylint: disable=import-outside-toplevel
+    import arm  # pylint: disable=import-outside-toplevel
+
+    gallery = {'name': 'Bench', 'resourceGroup': 'Bench-Gallery', 'subscription': SUBSCRIPTION}
+    images = [{'name': f'Image{i}', 'version': '1.0.0', 'gallery': gallery, 'subscription': SUBSCRIPTION,
+               'publisher': 'Bench', 'offer': 'Bench', 'sku': f'sku{i}', 'os': 'Windows', 'description': 'bench'}
+              for i in range(count + count // 10)]  # some images don't have a definition yet
+
+    start = time.perf_counter()
+    az.get_sub()
+    for image in images:
+        az.ensure_image_def_version(image)
+    elapsed = time.perf_counter() - start
+
+    server.shutdown()
+
+    stats = arm.stats()
+    return {'images': len(images), 'seconds': elapsed, 'requests': stats['requests'],
+            'connections': stats['connections'], 'ms_per_request': elapsed * 1000 / max(stats['requests'], 1)}
+
+
+def bench_az_startup(count):
+    az = shutil.which('az')
+    if not az:
+        return None
+    start = time.perf_counter()
+    for _ in range(count):
+        subprocess.run([az, 'version'], capture_output=True, check=True)
+    elapsed = time.perf_counter() - start
+    return {'processes': count, 'seconds': elapsed, 'ms_per_process': elapsed * 1000 / count}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the arm transport against a local fake arm endpoint')
+    parser.add_argument('--images', '-n', type=int, default=100, help='number of image definitions in the fake gallery')
+    parser.add_argument('--latency', '-l', type=float, default=0.0, help='seconds the fake endpoint waits before answering')
+    parser.add_argument('--az-startup', type=int, default=0, help='also time this many az cli process start-ups (requires az)')
+
+    args = parser.parse_args()
+
+    results = {'arm': bench_arm(args.images, args.latency)}
+
+    if args.az_startup:
+        results['az'] = bench_az_startup(args.az_startup)
+
+    print(json.dumps(results, indent=4))
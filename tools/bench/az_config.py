@@ -0,0 +1,81 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+'''Runs concurrent async az calls against the fake az cli while it locks the token cache of its config directory,
+with every call sharing one config directory and with the builder's pool of config directory copies'''
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+tools = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(tools.parent / 'builder'))
+
+
+def _profile(path, cache_kb):
+    '''Creates a config directory that looks like a logged in az cli profile'''
+    path.mkdir(parents=True)
+    (path / 'azureProfile.json').write_text(json.dumps({'subscriptions': [{'id': 'bench', 'isDefault': True}]}))
+    (path / 'config').write_text('[core]\noutput = json\n')
+    (path / 'msal_token_cache.json').write_text(json.dumps({'AccessToken': {'token': 'x' * cache_kb * 1024}}))
+    for d in ['cliextensions', 'bin', 'logs']:
+        (path / d).mkdir()
+
+
+async def _run(count, pooled, source):
+    import azconfig  # pylint: disable=import-outside-toplevel
+    import azure as az  # pylint: disable=import-outside-toplevel
+
+    az._configs = azconfig.Pool(source) if pooled else None
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[az.cli_async(['group', 'show', '-n', 'Bench'], log_command=False) for _ in range(count)])
+    elapsed = time.perf_counter() - start
+
+    return {'pooled': pooled, 'calls': count, 'succeeded': sum(1 for r in results if r), 'seconds': round(elapsed, 3),
+            'calls_per_second': round(count / elapsed, 1), 'configs': az.config_stats()}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare concurrent async az calls sharing one config directory with the pool of config directory copies')
+    parser.add_argument('--calls', '-n', type=int, default=64, help='number of concurrent az calls')
+    parser.add_argument('--lock', type=float, default=0.1, help='seconds the fake az cli holds the lock on the token cache of its config directory')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds the fake az cli takes to answer each call (without the lock)')
+    parser.add_argument('--window', '-w', type=int, default=16, help='number of calls in flight at once')
+    parser.add_argument('--cache-kb', type=int, default=64, help='size of the token cache copied into each config directory')
+
+    args = parser.parse_args()
+
+    state = Path(tempfile.mkdtemp(prefix='fake-az'))
+    source = state / 'azure'
+    _profile(source, args.cache_kb)
+
+    os.environ['PATH'] = f'{tools / "fakes"}{os.pathsep}{os.environ["PATH"]}'
+    os.environ['FAKE_AZ_STATE'] = str(state / 'az')
+    os.environ['FAKE_AZ_LATENCY'] = str(args.latency)
+    os.environ['FAKE_AZ_PROFILE_LOCK'] = str(args.lock)
+    os.environ['AZURE_CONFIG_DIR'] = str(source)
+    os.environ['BUILDER_AZ_TRANSPORT'] = 'cli'
+    os.environ['BUILDER_AZ_CONCURRENCY'] = str(args.window)
+    os.environ['BUILDER_AZ_MAX_CONCURRENCY'] = str(args.window)
+    os.environ['BUILDER_LOG_LEVEL'] = 'WARNING'
+
+    try:
+        import azure as az  # pylint: disable=import-outside-toplevel
+        az.cli(['group', 'create', '-n', 'Bench', '-l', 'eastus'])
+
+        shared = asyncio.run(_run(args.calls, False, source))
+        pooled = asyncio.run(_run(args.calls, True, source))
+
+        print(json.dumps({'shared': shared, 'pooled': pooled, 'speedup': round(shared['seconds'] / pooled['seconds'], 2)}, indent=4))
+    finally:
+        shutil.rmtree(state)
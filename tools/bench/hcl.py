@@ -0,0 +1,75 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+'''Times reading the packer variables of many images with the builder's hcl parser, and with packer inspect
+(if packer is on the PATH), checking both find the same variables'''
+
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+tools = Path(__file__).resolve().parent.parent
+repo = tools.parent
+sys.path.insert(0, str(repo / 'builder'))
+
+import hcl  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def _images(root, count) -> list:
+    '''Creates count image directories, each with the repo's variable file plus a variable of its own'''
+    source = (repo / 'images' / 'VSCodeBox' / 'variable.pkr.hcl').read_text()
+    dirs = []
+    for i in range(count):
+        image_dir = Path(root) / f'Image{i}'
+        image_dir.mkdir()
+        (image_dir / 'variable.pkr.hcl').write_text(f'{source}\nvariable "image{i}" {{\n  type    = number\n  default = {i}\n}}\n')
+        dirs.append(image_dir)
+    return dirs
+
+
+def _inspect(image_dir) -> list:
+    proc = subprocess.run(['packer', 'inspect', '-machine-readable', str(image_dir)], capture_output=True, text=True)
+    return [v.strip().split('var.')[1].split(':')[0] for v in proc.stdout.split('\\n') if v.startswith('var.')]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Time reading packer variables with the hcl parser and packer inspect')
+    parser.add_argument('--images', '-n', type=int, default=200, help='number of images')
+
+    args = parser.parse_args()
+
+    results = {'images': args.images}
+
+    with tempfile.TemporaryDirectory() as temp:
+        dirs = _images(temp, args.images)
+
+        start = time.perf_counter()
+        parsed = [hcl.variables(d) for d in dirs]
+        results['hcl_cold_ms'] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        for d in dirs:
+            hcl.variables(d)
+        results['hcl_cached_ms'] = (time.perf_counter() - start) * 1000
+
+        results['variables_per_image'] = len(parsed[0])
+
+        if shutil.which('packer'):
+            start = time.perf_counter()
+            inspected = [_inspect(d) for d in dirs]
+            results['packer_inspect_ms'] = (time.perf_counter() - start) * 1000
+            results['differ'] = sum(1 for p, i in zip(parsed, inspected) if sorted(p) != sorted(i))
+        else:
+            results['packer_inspect_ms'] = None  # packer isn't installed
+
+    print(json.dumps(results, indent=4))
+
+    sys.exit(1 if results.get('differ', 0) else 0)
@@ -0,0 +1,135 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+'''Compares writing log lines directly to a slow handler (the previous loggers) with the builder's queued logging
+pipeline: the per-line cost to the caller, how long the event loop stalls while async tasks log, and the cost of
+logging large payloads below the active level'''
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+tools = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(tools.parent / 'builder'))
+
+import loggers  # noqa: E402 pylint: disable=wrong-import-position
+
+
+class SlowStream:
+    '''A stream that takes latency seconds per write, like a file on a network mount (i.e. azure files)'''
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.writes = 0
+
+    def write(self, text):
+        time.sleep(self.latency)
+        self.writes += 1
+
+    def flush(self):
+        pass
+
+
+def _handler(latency):
+    handler = logging.StreamHandler(SlowStream(latency))
+    handler.setFormatter(logging.Formatter(loggers.TEXT_FORMAT, datefmt=loggers.DATE_FORMAT, style='{'))
+    return handler
+
+
+def _direct_logger(latency):
+    logger = logging.getLogger('bench.direct')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(_handler(latency))
+    return logger
+
+
+def per_line(logger, lines) -> float:
+    '''Returns the average time (in microseconds) a caller spends logging a line'''
+    start = time.perf_counter()
+    for i in range(lines):
+        logger.info(f'line {i}')
+    return (time.perf_counter() - start) / lines * 1e6
+
+
+async def _stall(logger, tasks, lines, tick=0.01) -> float:
+    '''Returns the longest (in milliseconds) a 10ms timer was late while tasks log lines'''
+    worst = 0.0
+    done = False
+
+    async def _ticker():
+        nonlocal worst
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(tick)
+            worst = max(worst, time.perf_counter() - start - tick)
+
+    async def _task(n):
+        for i in range(lines):
+            logger.info(f'task {n} line {i}')
+            await asyncio.sleep(0)
+
+    ticker = asyncio.ensure_future(_ticker())
+    await asyncio.gather(*[_task(n) for n in range(tasks)])
+    done = True
+    await ticker
+    return worst * 1000
+
+
+def payloads(logger, count, size) -> dict:
+    '''Returns the time (in milliseconds) to log count payloads at debug while the level is info, eagerly and lazily'''
+    payload = {f'key{i}': {'value': i, 'items': list(range(10))} for i in range(size)}
+    logger.setLevel(logging.INFO)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        for line in json.dumps(payload, indent=4).splitlines():
+            logger.debug(line)
+    eager = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for _ in range(count):
+        logger.debug(loggers.Json(payload))
+    lazy = (time.perf_counter() - start) * 1000
+
+    logger.setLevel(logging.DEBUG)
+    return {'eager': eager, 'lazy': lazy}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare direct and queued logging to a slow log file')
+    parser.add_argument('--latency', type=float, default=0.001, help='seconds each write to the log file takes')
+    parser.add_argument('--lines', '-n', type=int, default=1000, help='number of lines to log')
+    parser.add_argument('--tasks', '-t', type=int, default=10, help='number of async tasks logging at once')
+
+    args = parser.parse_args()
+
+    queued_handler = _handler(args.latency)
+    loggers.start(handlers=[queued_handler])
+
+    direct = _direct_logger(args.latency)
+    queued = loggers.getLogger('bench.queued')
+
+    results = {'latency': args.latency, 'lines': args.lines, 'tasks': args.tasks}
+
+    results['per_line_us'] = {'direct': per_line(direct, args.lines), 'queued': per_line(queued, args.lines)}
+
+    lines_per_task = max(1, args.lines // args.tasks)
+    results['loop_stall_ms'] = {'direct': asyncio.run(_stall(direct, args.tasks, lines_per_task)),
+                                'queued': asyncio.run(_stall(queued, args.tasks, lines_per_task))}
+
+    results['payloads_below_level_ms'] = payloads(queued, 20, 200)
+
+    start = time.perf_counter()
+    loggers.stop()
+    results['drain_ms'] = (time.perf_counter() - start) * 1000
+    results['queued_writes'] = queued_handler.stream.writes
+
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,236 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+'''Runs the orchestrator end to end (image.all, build.main, build.main_async, and the builder entry point) against
+synthetic repositories with the fake az and packer on the PATH, and reports the wall time, number of subprocesses,
+peak RSS, and time per image of each run. Results are saved as json so runs can be compared across commits'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+tools = Path(__file__).resolve().parent.parent
+repo = tools.parent
+
+SCENARIOS = ['image.all', 'build.main', 'build.main_async', 'builder']
+
+PARAMS = {'identityId': 'bench', 'repository': 'https://github.com/contoso/images'}
+
+# each scenario runs in its own python process (in the synthetic repository's builder directory)
+DRIVERS = {
+    'image.all': '''
+import image as img
+img.all(img.get_gallery(), img.get_common(), 'bench', ensure_azure=True)
+''',
+    'build.main': '''
+import json, os
+import build, image as img
+build.main(img.get_gallery(), img.get_common(), None, json.loads(os.environ['BENCH_PARAMS']), 'bench')
+''',
+    'build.main_async': '''
+import asyncio, json, os
+import build, image as img
+asyncio.run(build.main_async(img.get_gallery(), img.get_common(), None, json.loads(os.environ['BENCH_PARAMS']), 'bench'))
+''',
+    'builder': '''
+import asyncio, os, sys
+import builder, image as img
+results = asyncio.run(builder.main_async(img.image_names(), img.get_gallery(), img.get_common(), 'bench',
+                                         skip_build=False, parallelism=int(os.environ['BENCH_PARALLELISM'])))
+sys.exit(1 if any(r['exitCode'] for r in results) else 0)
+'''
+}
+
+TEMPLATE = '''packer {{
+  required_plugins {{
+    windows-update = {{
+      version = "0.14.1"
+      source  = "github.com/rgl/windows-update"
+    }}
+  }}
+}}
+
+source "azure-arm" "vm" {{
+  subscription_id = var.subscription
+  location        = var.location
+}}
+
+build {{
+  sources = ["source.azure-arm.vm"]
+
+  provisioner "powershell" {{
+    scripts = [
+{scripts}
+    ]
+  }}
+}}
+'''
+
+
+def synthetic_repo(root, images, scripts) -> Path:
+    '''Creates a repository with the builder, the repo's gallery and common image properties, scripts scripts,
+    and images images that each reference all the scripts'''
+    root = Path(root)
+    shutil.copytree(repo / 'builder', root / 'builder', ignore=shutil.ignore_patterns('__pycache__'))
+    shutil.copy(repo / 'gallery.yml', root / 'gallery.yml')
+
+    (root / 'images').mkdir()
+    shutil.copy(repo / 'images' / 'images.yml', root / 'images' / 'images.yml')
+
+    (root / 'scripts').mkdir()
+    for s in range(scripts):
+        (root / 'scripts' / f'Script{s}.ps1').write_text(f'Write-Host "script {s}"\n')
+
+    # the synthetic images start from the marketplace image in TEMPLATE, not VSCodeBox's base layer
+    image_yml = (repo / 'images' / 'VSCodeBox' / 'image.yml').read_text().replace('sku: win11-vscode', 'sku: {sku}')
+    image_yml = ''.join(line for line in image_yml.splitlines(keepends=True) if not line.startswith('base:'))
+    variables = (repo / 'images' / 'VSCodeBox' / 'variable.pkr.hcl').read_text()
+    template = TEMPLATE.format(scripts=',\n'.join(f'      "${{path.root}}/../../scripts/Script{s}.ps1"' for s in range(scripts)))
+
+    for i in range(images):
+        image_dir = root / 'images' / f'Image{i}'
+        image_dir.mkdir()
+        (image_dir / 'image.yml').write_text(image_yml.format(sku=f'bench-{i}'))
+        (image_dir / 'variable.pkr.hcl').write_text(variables)
+        (image_dir / 'build.pkr.hcl').write_text(template)
+
+    return root
+
+
+def _calls(state) -> int:
+    '''Returns the number of commands the fake az or packer ran (the fake packer also logs each plugin it installs)'''
+    log = Path(state) / 'calls.log'
+    lines = log.read_text().splitlines() if log.is_file() else []
+    return sum(1 for line in lines if not line.split(' ', 2)[-1].startswith('install '))
+
+
+def _rss_mb(rusage) -> float:
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    return rusage.ru_maxrss / (1024 * 1024 if platform.system() == 'Darwin' else 1024)
+
+
+def run(scenario, root, images, az_latency=0.0, packer_seconds=0.0, parallelism=4) -> dict:
+    '''Runs a scenario with fresh fake az and packer state, returns its measurements'''
+    root = Path(root)
+    shutil.rmtree(root / '.local', ignore_errors=True)
+
+    state = Path(tempfile.mkdtemp(prefix='bench-state'))
+    env = dict(os.environ, PATH=f'{tools / "fakes"}{os.pathsep}{os.environ["PATH"]}',
+               FAKE_AZ_STATE=str(state / 'az'), FAKE_AZ_LATENCY=str(az_latency),
+               FAKE_AZ_SUBSCRIPTION='e5f715ae-6c72-4a5c-87c8-495590c34828',
+               FAKE_PACKER_STATE=str(state / 'packer'), FAKE_PACKER_BUILD_SECONDS=str(packer_seconds),
+               PACKER_PLUGIN_PATH=str(state / 'plugins'), BUILDER_AZ_TRANSPORT='cli', BUILDER_POLL_INTERVAL='1',
+               BENCH_PARAMS=json.dumps(PARAMS), BENCH_PARALLELISM=str(parallelism))
+    env.pop('ACI_IMAGE_BUILDER', None)
+
+    try:
+        subprocess.run(['az', 'group', 'create', '-n', 'Contoso-Gallery', '-l', 'eastus'], env=env, check=True, capture_output=True)
+        setup_calls = _calls(state / 'az')
+
+        with open(state / 'output.log', 'w') as output:
+            start = time.perf_counter()
+            proc = subprocess.Popen([sys.executable, '-c', DRIVERS[scenario]], cwd=root / 'builder', env=env,
+                                    stdout=output, stderr=subprocess.STDOUT)
+            _, status, rusage = os.wait4(proc.pid, 0)
+            wall = time.perf_counter() - start
+
+        exit_code = os.waitstatus_to_exitcode(status)
+        az_calls = _calls(state / 'az') - setup_calls
+        packer_calls = _calls(state / 'packer')
+
+        result = {
+            'scenario': scenario,
+            'images': images,
+            'exit_code': exit_code,
+            'wall_s': round(wall, 3),
+            'per_image_ms': round(wall / max(1, images) * 1000, 2),
+            'subprocesses': az_calls + packer_calls,
+            'az_calls': az_calls,
+            'packer_calls': packer_calls,
+            'peak_rss_mb': round(_rss_mb(rusage), 1)
+        }
+
+        if exit_code != 0:
+            result['output'] = (state / 'output.log').read_text().splitlines()[-10:]
+
+        return result
+
+    finally:
+        shutil.rmtree(state, ignore_errors=True)
+
+
+def _commit() -> str:
+    proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo, capture_output=True, text=True)
+    return proc.stdout.strip() if proc.returncode == 0 else 'unknown'
+
+
+def compare(previous, current) -> list:
+    '''Returns lines comparing the wall time of the runs in two results files'''
+    before = {(r['scenario'], r['images']): r for r in previous['results']}
+    lines = [f'{"scenario":<18} {"images":>6} {"before s":>9} {"after s":>9} {"change":>8}']
+    for r in current['results']:
+        b = before.get((r['scenario'], r['images']), None)
+        if b:
+            change = (r['wall_s'] - b['wall_s']) / b['wall_s'] * 100 if b['wall_s'] else 0
+            lines.append(f'{r["scenario"]:<18} {r["images"]:>6} {b["wall_s"]:>9.2f} {r["wall_s"]:>9.2f} {change:>+7.1f}%')
+    return lines
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the orchestrator end to end against synthetic repositories with the fake az and packer')
+    parser.add_argument('--images', '-n', type=int, nargs='+', default=[1, 10, 50], help='numbers of images in the synthetic repositories (1 to 1000)')
+    parser.add_argument('--scripts', '-m', type=int, default=10, help='number of scripts each image references')
+    parser.add_argument('--scenarios', '-s', nargs='+', choices=SCENARIOS, default=SCENARIOS, help='scenarios to run')
+    parser.add_argument('--az-latency', type=float, default=0.0, help='seconds the fake az cli takes to answer each command')
+    parser.add_argument('--packer-seconds', type=float, default=0.0, help='seconds each fake packer build takes')
+    parser.add_argument('--parallelism', type=int, default=4, help='number of images the builder entry point builds at once')
+    parser.add_argument('--output', '-o', help='path of the results json file (default: orchestration_<commit>.json)')
+    parser.add_argument('--compare', '-c', help='path of a previous results json file to compare with')
+
+    args = parser.parse_args()
+
+    if any(n < 1 or n > 1000 for n in args.images):
+        parser.error('--images must be between 1 and 1000')
+
+    commit = _commit()
+
+    results = {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'scripts': args.scripts, 'az_latency': args.az_latency, 'packer_seconds': args.packer_seconds,
+                   'parallelism': args.parallelism},
+        'results': []
+    }
+
+    for count in args.images:
+        with tempfile.TemporaryDirectory(prefix='bench-repo') as temp:
+            root = synthetic_repo(temp, count, args.scripts)
+            for scenario in args.scenarios:
+                result = run(scenario, root, count, args.az_latency, args.packer_seconds, args.parallelism)
+                results['results'].append(result)
+                print(json.dumps(result), flush=True)
+
+    output = Path(args.output if args.output else f'orchestration_{commit}.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    print(f'Saved results to {output}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print('\n'.join(compare(json.load(f), results)))
+
+    sys.exit(1 if any(r['exit_code'] for r in results['results']) else 0)
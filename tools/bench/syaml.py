@@ -0,0 +1,154 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+'''Checks the builder's yaml parser produces the same output as the legacy line parser for the repo's yaml files,
+then times both (and the cached parser) on large synthetic files'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+tools = Path(__file__).resolve().parent.parent
+repo = tools.parent
+sys.path.insert(0, str(repo / 'builder'))
+
+import syaml  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def legacy_parse(path) -> dict:
+    '''The original single level syaml parser, kept here to compare against'''
+    obj = {}
+    with open(path, 'r') as yaml:
+        parent_key = None
+
+        for line in yaml:
+            if line.strip() == '' or line.lstrip().startswith('#'):
+                continue
+
+            if line.lstrip().startswith('-'):
+                if not parent_key:
+                    raise ValueError(f'array item found without parent key\n{line}')
+
+                if parent_key not in obj:
+                    obj[parent_key] = []
+
+                item = line.split('-')[1].strip()
+
+                if ':' in item:
+                    s_key, s_value = [s.strip() for s in item.split(':')]
+                    if len(obj[parent_key]) == 0 or s_key in obj[parent_key][-1]:
+                        obj[parent_key].append({})
+
+                    obj[parent_key][-1][s_key] = s_value
+                else:
+                    obj[parent_key].append(item)
+
+            elif ':' in line:
+
+                key, value = [s.strip() for s in line.split(':')]
+
+                if line.replace(line.lstrip(), '') != '':
+
+                    if not parent_key:
+                        raise ValueError(f'line appears to be a property of an object but no key found in previous lines\n{line}')
+                    if not value:
+                        raise ValueError(f'line appears to be a property of an object but no value found\n{line}')
+
+                    if parent_key not in obj:
+                        obj[parent_key] = {}
+
+                    if isinstance(obj[parent_key], list):
+                        obj[parent_key][-1][key] = value
+                    elif isinstance(obj[parent_key], dict):
+                        obj[parent_key][key] = value
+
+                elif not value:
+                    parent_key = key
+
+                else:
+                    obj[key] = value
+                    parent_key = None
+
+            else:
+                raise ValueError(f'line does not contain a colon or is misformatted\n{line}')
+
+    return obj
+
+
+def repo_files() -> list:
+    '''Returns all the gallery, images, and image yaml files in the repo'''
+    files = [f for f in repo.glob('gallery.y*ml')] + [f for f in (repo / 'images').glob('images.y*ml')]
+    files += sorted((repo / 'images').glob('*/image.y*ml'))
+    return files
+
+
+def synthetic(path, lines):
+    '''Writes a yaml file with about the number of lines using only the syntax the legacy parser supports'''
+    with open(path, 'w') as f:
+        written, i = 0, 0
+        while written < lines:
+            f.write(f'# block {i}\n')
+            f.write(f'description{i}: Windows 11 Enterprise + M365 Apps + VSCode {i}\n')
+            f.write(f'version{i}: 1.0.{i}\n')
+            f.write(f'locations{i}:\n  - eastus\n  - westus\n  - westeurope\n')
+            f.write(f'settings{i}:\n  publisher: Contoso\n  offer: DevBox\n  sku: win11-{i}\n')
+            f.write(f'scripts{i}:\n  - name: install\n    path: install.ps1\n  - name: setup\n    path: setup.ps1\n\n')
+            written += 18
+            i += 1
+
+
+def _time(fn, path, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(path)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def check() -> int:
+    '''Compares the output of both parsers for the repo's yaml files, returns the number that differ'''
+    differ = 0
+    for path in repo_files():
+        legacy, new = legacy_parse(path), syaml.parse(path)
+        if legacy != new:
+            differ += 1
+            print(f'DIFFERENT {path.relative_to(repo)}\n  legacy: {json.dumps(legacy)}\n  syaml:  {json.dumps(new)}')
+    return differ
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare the yaml parser with the legacy parser')
+    parser.add_argument('--lines', '-l', type=int, default=12000, help='number of lines in the synthetic yaml file')
+    parser.add_argument('--repeat', '-r', type=int, default=5, help='number of times to parse the synthetic file')
+
+    args = parser.parse_args()
+
+    differ = check()
+    print(f'\ncompared {len(repo_files())} repo yaml files, {differ} differ')
+
+    with tempfile.TemporaryDirectory() as temp:
+        path = Path(temp) / 'large.yml'
+        synthetic(path, args.lines)
+
+        if legacy_parse(path) != syaml._parse_file(path):  # pylint: disable=protected-access
+            differ += 1
+            print('DIFFERENT synthetic file')
+
+        legacy = _time(legacy_parse, path, args.repeat)
+        uncached = _time(syaml._parse_file, path, args.repeat)  # pylint: disable=protected-access
+        syaml.parse(path)
+        cached = _time(syaml.parse, path, args.repeat)
+
+        print(f'\nparsing {args.lines} lines ({os.path.getsize(path) / 1024:.0f}KB)')
+        print(f'  legacy:   {legacy:8.2f}ms')
+        print(f'  syaml:    {uncached:8.2f}ms')
+        print(f'  cached:   {cached:8.2f}ms')
+        print('')
+
+    sys.exit(1 if differ else 0)
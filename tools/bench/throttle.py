@@ -0,0 +1,60 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+'''Runs concurrent async az calls against the fake az cli while it throttles, and reports how the builder adapted'''
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+tools = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(tools.parent / 'builder'))
+
+
+async def _run(count):
+    import azure as az  # pylint: disable=import-outside-toplevel
+
+    az.cli(['group', 'create', '-n', 'Bench', '-l', 'eastus'])
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[az.cli_async(['group', 'show', '-n', 'Bench']) for _ in range(count)])
+    elapsed = time.perf_counter() - start
+
+    return {'calls': count, 'succeeded': sum(1 for r in results if r), 'seconds': elapsed, 'controller': az.throttle_stats()}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run concurrent async az calls against a throttling fake az cli')
+    parser.add_argument('--calls', '-n', type=int, default=100, help='number of concurrent az calls')
+    parser.add_argument('--limit', '-l', type=int, default=4, help='number of concurrent calls above which the fake az cli throttles')
+    parser.add_argument('--rate', '-r', type=float, default=0.0, help='probability that the fake az cli throttles any call')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='seconds the fake az cli asks callers to wait before retrying')
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds the fake az cli takes to answer each call')
+    parser.add_argument('--window', '-w', type=int, default=16, help='initial concurrency window')
+
+    args = parser.parse_args()
+
+    state = tempfile.mkdtemp(prefix='fake-az')
+
+    os.environ['PATH'] = f'{tools / "fakes"}{os.pathsep}{os.environ["PATH"]}'
+    os.environ['FAKE_AZ_STATE'] = state
+    os.environ['FAKE_AZ_LATENCY'] = str(args.latency)
+    os.environ['FAKE_AZ_THROTTLE_LIMIT'] = str(args.limit)
+    os.environ['FAKE_AZ_THROTTLE_RATE'] = str(args.rate)
+    os.environ['FAKE_AZ_RETRY_AFTER'] = str(args.retry_after)
+    os.environ['BUILDER_AZ_TRANSPORT'] = 'cli'
+    os.environ['BUILDER_AZ_CONCURRENCY'] = str(args.window)
+
+    try:
+        print(json.dumps(asyncio.run(_run(args.calls)), indent=4))
+    finally:
+        shutil.rmtree(state)
@@ -4,11 +4,18 @@
 # ------------------------------------
 
 import argparse
-import os
+import sys
 from pathlib import Path
 
 from packaging.version import parse  # pylint: disable=unresolved-import
 
+toolspath = Path(__file__).resolve().parent
+imgspath = Path(toolspath.parent / 'images')
+
+sys.path.insert(0, str(toolspath.parent / 'builder'))
+
+import catalog  # noqa: E402 pylint: disable=wrong-import-position
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--major', action='store_true', help='bump major version')
 parser.add_argument('--minor', action='store_true', help='bump minor version')
@@ -25,26 +32,19 @@ if major and minor:
 images = args.images
 allimages = not images
 
-toolspath = Path(__file__).resolve().parent
-imgspath = Path(toolspath.parent / 'images')
+imgfiles = catalog.scan(imgspath)
 
-paths = []
+if not allimages:
+    baddirs = [i for i in images if i not in imgfiles]
+    if baddirs:
+        raise ValueError('directories not found under /images: [ {} ]'.format(', '.join(baddirs)))
 
-for imgdir, dirs, files in os.walk(imgspath):
-    if imgspath.samefile(imgdir):
-        if not allimages:
-            baddirs = [i for i in images if i not in dirs]
-            if baddirs:
-                raise ValueError('directories not found under /images: [ {} ]'.format(', '.join(baddirs)))
-    else:
-        imgname = Path(imgdir).name
-        if allimages or imgname in images:
-            # print('bumping version in {}'.format(imgname))
-            paths.extend([Path(imgdir) / f for f in files if f.lower() == 'image.yml' or f.lower() == 'image.yaml'])
+paths = [path for imgname, path in imgfiles.items() if allimages or imgname in images]
 
 for path in paths:
 
     version = None
+    layer = False
 
     image = Path(path).parent.name
 
@@ -52,7 +52,12 @@ for path in paths:
         for line in f:
             if line.startswith('version: '):
                 version = line.split('version: ')[1].strip()
-                break
+            elif line.startswith('layer: '):
+                layer = line.split('layer: ')[1].strip().lower() in ['1', 'true', 'yes']
+
+    if not version and layer:
+        print(f'skipping {image} because its versions are keyed by its content')
+        continue
 
     if not version:
         raise ValueError(f'no version found for {image}')
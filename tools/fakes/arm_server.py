@@ -0,0 +1,183 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+'''A minimal in-memory Azure Resource Manager endpoint for testing and benchmarking the builder offline'''
+
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# the last segment of a path that lists the resources under its parent
+COLLECTIONS = ['resourcegroups', 'galleries', 'images', 'versions', 'deployments']
+
+# resources created with a PUT to these collections return a long-running operation
+ASYNC_COLLECTIONS = ['images', 'versions', 'deployments']
+
+
+class ArmState:
+    '''Resources keyed by their (lower case) id, plus request counters'''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.resources = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'connections': 0}
+
+    def seed(self, resources):
+        for resource_id, resource in resources.items():
+            self.put(resource_id, resource)
+
+    def put(self, resource_id, body):
+        parts = resource_id.strip('/').split('/')
+        resource = dict(body)
+        resource['id'] = resource_id
+        resource['name'] = parts[-1]
+        resource.setdefault('properties', {})
+        resource['properties'].setdefault('provisioningState', 'Succeeded')
+        with self.lock:
+            self.resources[resource_id.lower()] = resource
+        return resource
+
+    def get(self, resource_id):
+        with self.lock:
+            return self.resources.get(resource_id.lower(), None)
+
+    def list(self, collection_id):
+        prefix = collection_id.lower() + '/'
+        with self.lock:
+            return [r for k, r in self.resources.items() if k.startswith(prefix) and '/' not in k[len(prefix):]]
+
+    def delete(self, resource_id):
+        with self.lock:
+            return self.resources.pop(resource_id.lower(), None)
+
+
+def _handler(state):
+
+    class ArmHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            with state.lock:
+                state.stats['connections'] += 1
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, body=None, headers=None):
+            data = json.dumps(body).encode() if body is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _not_found(self, path):
+            self._reply(404, {'error': {'code': 'ResourceNotFound', 'message': f'The resource {path} was not found.'}})
+
+        def _begin(self):
+            with state.lock:
+                state.stats['requests'] += 1
+            if state.latency:
+                time.sleep(state.latency)
+            return urlsplit(self.path).path.rstrip('/')
+
+        def do_GET(self):
+            path = self._begin()
+
+            if path == '/fake/stats':
+                return self._reply(200, dict(state.stats))
+
+            if path.startswith('/fake/operations/'):
+                return self._reply(200, {'status': 'Succeeded'})
+
+            resource = state.get(path)
+            if resource:
+                return self._reply(200, resource)
+
+            if path.split('/')[-1].lower() in COLLECTIONS:
+                return self._reply(200, {'value': state.list(path)})
+
+            self._not_found(path)
+
+        def do_PUT(self):
+            path = self._begin()
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length)) if length else {}
+
+            existed = state.get(path) is not None
+            resource = state.put(path, body)
+
+            if not existed and path.split('/')[-2].lower() in ASYNC_COLLECTIONS:
+                operation = f'http://{self.headers["Host"]}/fake/operations/{uuid.uuid4()}'
+                return self._reply(201, resource, {'Azure-AsyncOperation': operation, 'Retry-After': '0'})
+
+            self._reply(200 if existed else 201, resource)
+
+        def do_PATCH(self):
+            path = self._begin()
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length)) if length else {}
+
+            resource = state.get(path)
+            if not resource:
+                return self._not_found(path)
+
+            resource = dict(resource)
+            resource.update(body)
+            self._reply(200, state.put(path, resource))
+
+        def do_DELETE(self):
+            path = self._begin()
+            self._reply(200 if state.delete(path) else 204)
+
+    return ArmHandler
+
+
+def serve(port=0, latency=0.0, resources=None):
+    '''Starts the fake endpoint on a background thread and returns the server (server.state holds the resources)'''
+    state = ArmState(latency)
+    if resources:
+        state.seed(resources)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), _handler(state))
+    server.daemon_threads = True
+    server.state = state
+    server.endpoint = f'http://127.0.0.1:{server.server_address[1]}'
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run a fake Azure Resource Manager endpoint. '
+                                     'Point the builder at it with BUILDER_ARM_ENDPOINT=http://127.0.0.1:<port> and BUILDER_ARM_TOKEN=fake')
+    parser.add_argument('--port', '-p', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--latency', '-l', type=float, default=0.0, help='seconds to wait before answering each request')
+    parser.add_argument('--seed', '-s', help='path to a json file mapping resource ids to resources to start with')
+
+    args = parser.parse_args()
+
+    resources = None
+    if args.seed:
+        with open(args.seed, 'r') as f:
+            resources = json.load(f)
+
+    server = serve(args.port, args.latency, resources)
+    print(f'Fake arm endpoint listening on {server.endpoint}')
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,12 +1,24 @@
 import argparse
+import asyncio
 import json
+import random
 import shutil
-import subprocess
 import sys
+import time
 from uuid import UUID
 
 RESOURCE_NOT_FOUND = 'Code: ResourceNotFound'
 
+# stop requests that are throttled (or fail transiently) are retried this many times
+MAX_RETRIES = 4
+RETRYABLE = ['TooManyRequests', '429', 'ServiceUnavailable', 'InternalServerError', 'GatewayTimeout']
+
+# power states of a box that has stopped
+STOPPED_STATES = ['stopped', 'deallocated', 'hibernated']
+
+# minimum seconds between progress lines
+PROGRESS_INTERVAL = 2
+
 
 def error_exit(message):
     print(f'ERROR: {message}')
@@ -40,118 +52,302 @@ def _parse_az_command(command):
     return args
 
 
-def _az(command, log_command=True):
-    '''Run an az cli command and return the result as a dict or None if the resource was not found.'''
+async def _az_async(command, log_command=False):
+    '''Run an az cli command, returns a tuple of the result as a dict (or None if the resource was not found) and the
+    error message if the command failed. Throttled and transient failures are retried with jittered backoff'''
     args = _parse_az_command(command)
-    try:
-        if log_command:
-            print(f'Running az cli command: {" ".join(args)}')
-        proc = subprocess.run(args, capture_output=True, check=True, text=True)
-        return None if proc.returncode == 0 and not proc.stdout else json.loads(proc.stdout)
-    except subprocess.CalledProcessError as e:
-        if e.stderr and RESOURCE_NOT_FOUND in e.stderr:
-            return None
-        error_exit(e.stderr if e.stderr else 'azure cli command failed')
-    except json.decoder.JSONDecodeError:
-        error_exit('{}: {}'.format('Could not decode response json', proc.stderr if proc.stderr else proc.stdout if proc.stdout else proc))
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--dev-center', '-dc', dest='devcenter', required=True, help='the devcenter to operate on')
-parser.add_argument('--projects', '-p', nargs='*', help='names of projects to stop running boxes. if not specified all projects will be included')
-parser.add_argument('--pools', nargs='*', help='names of pools to stop running boxes. if not specified all pools will be included')
-parser.add_argument('--users', '-u', nargs='*', help='ids of users to stop running boxes. if not specified all users will be included')
-args = parser.parse_args()
-
-devcenter = args.devcenter
-
-project_names = [p for p in args.projects] if args.projects else None
-pool_names = [p for p in args.pools] if args.pools else None
-user_ids = [u for u in args.users] if args.users else None
-
-if user_ids:
-    for user_id in user_ids:
-        if not _is_valid_uuid(user_id):
-            error_exit(f"'{user_id}' is not a valid uuid")
-
-# get all projects in the devcenter
-print(f'Getting projects in DevCenter: {devcenter} ...')
-projects = _az(f'devcenter dev project list -dc {devcenter}', log_command=False)
-
-# make sure we got a list of projects
-if not projects or len(projects) == 0:
-    print(f'WARNING: No projects found in devcenter: {devcenter}. Make sure you have at least Reader role on the projects.')
-    sys.exit(0)
-
-# filter projects by name (if specified)
-if project_names:
-    projects = [p for p in projects if p['name'] in project_names]
-    # ensure we have at least one project
-    if len(projects) == 0:
-        print(f'No projects found in devcenter {devcenter} matching names: {project_names}. Make sure you typed the names correctly and have at least Reader role on the projects.')
-        sys.exit(1)
-    # ensure we found all the projects we were looking for
-    for name in project_names:
-        if name not in [p['name'] for p in projects]:
-            print(f'No projects found in devcenter {devcenter} matching name: {name}. Make sure you typed the name correctly and have at least Reader role on the project.')
-            sys.exit(1)
+    if log_command:
+        print(f'Running az cli command: {" ".join(args)}')
 
-print(f' found {len(projects)} {"project" if len(projects) == 1 else "projects"}: {[n["name"] for n in projects]}')
+    for attempt in range(MAX_RETRIES + 1):
+        proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate()
+        stdout, stderr = stdout.decode(), stderr.decode()
 
-# would be ideal to create an odata query based in the projects/pools/users
-# but it doesn't look like the --filter argment is respected by the dataplane
-# get all dev-boxes in the devcenter
-all_boxes = _az(f'devcenter dev dev-box list -dc {devcenter}', log_command=False)
+        if proc.returncode == 0:
+            try:
+                return (json.loads(stdout) if stdout else None), None
+            except json.decoder.JSONDecodeError:
+                return None, f'Could not decode response json: {stderr if stderr else stdout}'
 
-if not all_boxes or len(all_boxes) == 0:
-    print(f'WARNING: No boxes found in devcenter: {devcenter}. Make sure you have the DevCenter Project Admin role on the projects.')
-    sys.exit(0)
+        if stderr and RESOURCE_NOT_FOUND in stderr:
+            return None, None
 
-for project in projects:
-    print('')
-    print(f'Getting boxes in {project["name"]} ...')
+        if attempt < MAX_RETRIES and stderr and any(r in stderr for r in RETRYABLE):
+            await asyncio.sleep(random.uniform(0, 2 ** attempt))
+            continue
 
-    # filter boxes for the project
-    project_boxes = [b for b in all_boxes if b['projectName'] == project['name']]
+        return None, stderr.strip() if stderr else 'azure cli command failed'
 
-    if not project_boxes or len(project_boxes) == 0:
-        print(f'WARNING: No boxes found in project: {project["name"]}. If this is incorrect, make sure you have the DevCenter Project Admin role on the project.')
-        continue
 
-    # filter boxes by users (if specified)
-    if user_ids:
-        project_boxes = [b for b in project_boxes if b['user'] in user_ids]
-        if len(project_boxes) == 0:
-            print(f' no boxes found matching users: {user_ids}')
+async def _az_or_exit(command):
+    '''Run an az cli command and return the result, exits if the command fails'''
+    result, error = await _az_async(command)
+    if error:
+        error_exit(error)
+    return result
+
+
+def _plural(count, singular, plural):
+    return f'{count} {singular if count == 1 else plural}'
+
+
+def _key(box):
+    return (box['projectName'], box['user'], box['name'])
+
+
+def index(boxes, project_names, pool_names=None, user_ids=None) -> dict:
+    '''Groups the boxes by project in one pass over the list. Returns a dict of project name to the number of boxes
+    in the project (total), the boxes matching the pools and users (matched), and the matched boxes that are running'''
+    pools = set(pool_names) if pool_names else None
+    users = set(user_ids) if user_ids else None
+
+    projects = {name: {'total': 0, 'matched': [], 'running': []} for name in project_names}
+
+    for box in boxes:
+        project = projects.get(box['projectName'], None)
+        if project is None:
             continue
+        project['total'] += 1
+        if (users is None or box['user'] in users) and (pools is None or box['poolName'] in pools):
+            project['matched'].append(box)
+            if box['powerState'].lower() == 'running':
+                project['running'].append(box)
+
+    return projects
+
+
+class Progress:
+    '''Counts the boxes that stopped or failed and prints a progress line at most every PROGRESS_INTERVAL seconds'''
+
+    def __init__(self, total):
+        self.total = total
+        self.submitted = 0
+        self.stopped = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self._printed = 0
+
+    def show(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._printed < PROGRESS_INTERVAL:
+            return
+        self._printed = now
+        elapsed = now - self.start
+        done = self.stopped + self.failed
+        rate = done / elapsed if elapsed else 0
+        print(f' {done}/{self.total} done ({self.stopped} stopped, {self.failed} failed, {self.submitted} submitted) '
+              f'in {elapsed:.0f}s, {rate:.1f} boxes/s', flush=True)
+
+
+async def stop(devcenter, box, result, limit, progress, no_wait=False):
+    '''Stops a box (or submits the stop with --no-wait) and records the outcome in the result'''
+    command = ['devcenter', 'dev', 'dev-box', 'stop', '-dc', devcenter, '--project', box['projectName'],
+               '--user-id', box['user'], '-n', box['name']] + (['--no-wait'] if no_wait else [])
+
+    async with limit:
+        _, error = await _az_async(command)
+
+    if error:
+        result['status'] = 'failed'
+        result['error'] = error
+        progress.failed += 1
+    elif no_wait:
+        result['status'] = 'submitted'
+        progress.submitted += 1
+    else:
+        result['status'] = 'stopped'
+        progress.stopped += 1
+
+    progress.show()
+
+
+async def poll(devcenter, results, limit, progress, interval, timeout):
+    '''Lists the boxes of each project with submitted stops (one call per project) until every box has stopped or
+    the timeout elapses. Boxes still stopping at the timeout are left as submitted'''
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        pending = {k: r for k, r in results.items() if r['status'] == 'submitted'}
+        if not pending:
+            return
+
+        await asyncio.sleep(min(interval, max(0, deadline - time.monotonic())))
+
+        projects = sorted(set(k[0] for k in pending))
+
+        async def _list(project):
+            async with limit:
+                return project, await _az_async(['devcenter', 'dev', 'dev-box', 'list', '-dc', devcenter, '--project', project])
+
+        for project, (boxes, error) in await asyncio.gather(*[_list(p) for p in projects]):
+            if error:
+                print(f' WARNING: Failed to get the boxes in {project}: {error}')
+                continue
+
+            found = set()
+            for box in boxes or []:
+                key = _key(box)
+                found.add(key)
+                result = pending.get(key, None)
+                if result and box['powerState'].lower() in STOPPED_STATES:
+                    result['status'] = 'stopped'
+                    progress.submitted -= 1
+                    progress.stopped += 1
+
+            # boxes deleted while stopping don't need to be stopped
+            for key, result in pending.items():
+                if key[0] == project and key not in found:
+                    result['status'] = 'deleted'
+                    progress.submitted -= 1
+                    progress.stopped += 1
+
+        progress.show()
+
+
+async def main_async(devcenter, project_names=None, pool_names=None, user_ids=None, parallelism=16, no_wait=False,
+                     poll_interval=30, timeout=3600) -> dict:
+    '''Stops the running boxes matching the projects, pools, and users, at most parallelism at once. Returns the
+    result (status and error) of each box'''
+
+    # get the projects and the boxes in the devcenter at the same time
+    print(f'Getting projects and boxes in DevCenter: {devcenter} ...')
+
+    # would be ideal to create an odata query based in the projects/pools/users
+    # but it doesn't look like the --filter argment is respected by the dataplane
+    projects, all_boxes = await asyncio.gather(_az_or_exit(['devcenter', 'dev', 'project', 'list', '-dc', devcenter]),
+                                               _az_or_exit(['devcenter', 'dev', 'dev-box', 'list', '-dc', devcenter]))
+
+    # make sure we got a list of projects
+    if not projects or len(projects) == 0:
+        print(f'WARNING: No projects found in devcenter: {devcenter}. Make sure you have at least Reader role on the projects.')
+        sys.exit(0)
+
+    # filter projects by name (if specified)
+    if project_names:
+        found = set(p['name'] for p in projects)
+        # ensure we found all the projects we were looking for
+        for name in project_names:
+            if name not in found:
+                print(f'No projects found in devcenter {devcenter} matching name: {name}. Make sure you typed the name correctly and have at least Reader role on the project.')
+                sys.exit(1)
+        projects = [p for p in projects if p['name'] in project_names]
+
+    print(f' found {_plural(len(projects), "project", "projects")}: {[n["name"] for n in projects]}')
 
-    # filter boxes by pools (if specified)
-    if pool_names:
-        project_boxes = [b for b in project_boxes if b['poolName'] in pool_names]
-        if len(project_boxes) == 0:
-            print(f' no boxes found matching pools: {pool_names}')
+    if not all_boxes or len(all_boxes) == 0:
+        print(f'WARNING: No boxes found in devcenter: {devcenter}. Make sure you have the DevCenter Project Admin role on the projects.')
+        sys.exit(0)
+
+    print(f' found {_plural(len(all_boxes), "box", "boxes")}')
+
+    indexed = index(all_boxes, [p['name'] for p in projects], pool_names, user_ids)
+
+    to_stop = []
+
+    for name, project in indexed.items():
+        print('')
+        print(f'{name}:')
+
+        if project['total'] == 0:
+            print(f' WARNING: No boxes found in project: {name}. If this is incorrect, make sure you have the DevCenter Project Admin role on the project.')
             continue
 
-    corect_grammer = " matching specified pools/users" if user_ids or pool_names else ""
-    print(f' found {len(project_boxes)} {"box" if len(project_boxes) == 1 else "boxes"}{corect_grammer}: {[b["name"] for b in project_boxes]}')
+        if not project['matched']:
+            print(f' no boxes found matching specified pools/users')
+            continue
+
+        corect_grammer = ' matching specified pools/users' if user_ids or pool_names else ''
+        print(f' found {_plural(len(project["matched"]), "box", "boxes")}{corect_grammer}')
+
+        skipped = len(project['matched']) - len(project['running'])
+        if skipped:
+            corect_grammer = "box because it isn't" if skipped == 1 else "boxes because they aren't"
+            print(f' skipping {skipped} {corect_grammer} running')
+
+        if project['running']:
+            print(f' stopping {_plural(len(project["running"]), "box", "boxes")}')
+            to_stop.extend(project['running'])
+
+    print('')
+
+    results = {_key(b): {'name': b['name'], 'project': b['projectName'], 'pool': b['poolName'], 'user': b['user'],
+                         'status': 'pending', 'error': None} for b in to_stop}
+
+    if not results:
+        return results
+
+    print(f'Stopping {_plural(len(results), "box", "boxes")} ({parallelism} at a time{", without waiting" if no_wait else ""}) ...')
+
+    limit = asyncio.Semaphore(max(1, parallelism))
+    progress = Progress(len(results))
+
+    await asyncio.gather(*[stop(devcenter, b, results[_key(b)], limit, progress, no_wait) for b in to_stop])
+
+    if no_wait and progress.submitted:
+        progress.show(force=True)
+        print(f'Waiting for {_plural(progress.submitted, "box", "boxes")} to stop (checking every {poll_interval}s) ...')
+        await poll(devcenter, results, limit, progress, poll_interval, timeout)
 
-    not_running = [b for b in project_boxes if b['powerState'].lower() != 'running']
-    if not_running and len(not_running) > 0:
-        corect_grammer = "box because it isn't" if len(not_running) == 1 else "boxes because they aren't"
-        print(f' skipping {len(not_running)} {corect_grammer} running: {[b["name"] for b in not_running]}')
+    progress.show(force=True)
 
-    # filter out boxes that are not running
-    project_boxes = [b for b in project_boxes if b['powerState'].lower() == 'running']
+    return results
 
-    # if we still have boxes to stop, stop them
-    if len(project_boxes) > 0:
-        print(f' stopping {len(project_boxes)} {"box" if len(project_boxes) == 1 else "boxes"}')
 
-        for box in project_boxes:
-            print(f' stopping {box["name"]}...')
-            _az(f'devcenter dev dev-box stop -dc {devcenter} --project {box["projectName"]} --user-id {box["user"]} -n {box["name"]}', log_command=False)
-            print(f' {box["name"]} stopped')
-        print(f' done')
+def report_lines(results) -> list:
+    '''Returns the lines of a report of the number of boxes in each status and the boxes that failed'''
+    statuses = {}
+    for r in results.values():
+        statuses.setdefault(r['status'], []).append(r)
 
-print('')
-print('Done')
+    lines = [f'{"status":<10}  {"boxes":>6}']
+    for status, boxes in sorted(statuses.items()):
+        lines.append(f'{status:<10}  {len(boxes):>6}')
+
+    for r in statuses.get('failed', []):
+        lines.append(f'failed to stop {r["name"]} ({r["project"]}/{r["user"]}): {r["error"].splitlines()[0]}')
+
+    for r in statuses.get('submitted', []):
+        lines.append(f'timed out waiting for {r["name"]} ({r["project"]}/{r["user"]}) to stop')
+
+    return lines
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dev-center', '-dc', dest='devcenter', required=True, help='the devcenter to operate on')
+    parser.add_argument('--projects', '-p', nargs='*', help='names of projects to stop running boxes. if not specified all projects will be included')
+    parser.add_argument('--pools', nargs='*', help='names of pools to stop running boxes. if not specified all pools will be included')
+    parser.add_argument('--users', '-u', nargs='*', help='ids of users to stop running boxes. if not specified all users will be included')
+    parser.add_argument('--parallelism', type=int, default=16, help='maximum number of az commands to run at once')
+    parser.add_argument('--no-wait', action='store_true', help='submit every stop without waiting, then poll the boxes until they have stopped')
+    parser.add_argument('--poll-interval', type=int, default=30, help='seconds between checks of the boxes when using --no-wait')
+    parser.add_argument('--timeout', type=int, default=3600, help='seconds to wait for the boxes to stop when using --no-wait')
+    parser.add_argument('--report', help='path of a json file to write the result of each box to')
+    args = parser.parse_args()
+
+    user_ids = [u for u in args.users] if args.users else None
+
+    if user_ids:
+        for user_id in user_ids:
+            if not _is_valid_uuid(user_id):
+                error_exit(f"'{user_id}' is not a valid uuid")
+
+    results = asyncio.run(main_async(args.devcenter, args.projects, args.pools, user_ids, args.parallelism,
+                                     args.no_wait, args.poll_interval, args.timeout))
+
+    print('')
+    for line in report_lines(results):
+        print(line)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(list(results.values()), f, indent=4)
+        print(f'Saved report to {args.report}')
+
+    print('')
+    print('Done')
+
+    if any(r['status'] in ['failed', 'submitted'] for r in results.values()):
+        sys.exit(1)